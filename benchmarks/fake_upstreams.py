@@ -0,0 +1,219 @@
+"""
+Local stand-ins for the upstream services of the backend, with configurable
+latency and payload sizes: DD-API, FEWS capabilities, hydroengine, shoreline
+GeoJSON box files and the google storage (GCS) listing API.
+"""
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+START_TIME = datetime(2019, 3, 22)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real upstreams
+
+    # set per server, see FakeUpstream
+    latency = 0.0
+    sizes = {}
+
+    def respond(self, content):
+        time.sleep(self.latency)
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        content = self.get(url.path, {key: values[-1] for key, values in parse_qs(url.query).items()})
+        if content is None:
+            return self.not_found()
+        self.respond(content)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+        content = self.post(urlsplit(self.path).path, data)
+        if content is None:
+            return self.not_found()
+        self.respond(content)
+
+    def get(self, path, params):
+        return None
+
+    def post(self, path, data):
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+def location(code):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [4.0, 52.0]},
+        "properties": {"locationId": code, "locationCode": code, "name": code},
+    }
+
+
+class DDApiHandler(FakeUpstreamHandler):
+    def get(self, path, params):
+        paging = {"next": None, "prev": None, "maxPageSize": 100, "minPageSize": 1}
+        if path.endswith("/locations"):
+            results = [location("diva_id__{}".format(i)) for i in range(self.sizes["locations"])]
+            return {"paging": paging, "results": results}
+
+        if path.endswith("/timeseries"):
+            events = [
+                {
+                    "timeStamp": (START_TIME + timedelta(minutes=10 * i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "value": i * 0.01,
+                }
+                for i in range(self.sizes["events"])
+            ]
+            code = params.get("locationCode", "diva_id__0")
+            return {
+                "paging": paging,
+                "provider": {"name": "Deltares", "apiVersion": "2.0"},
+                "results": [
+                    {
+                        "location": location(code),
+                        "observationType": {"id": params.get("observationTypeId")},
+                        "startTime": events[0]["timeStamp"] if events else None,
+                        "endTime": events[-1]["timeStamp"] if events else None,
+                        "events": events,
+                    }
+                ],
+            }
+        return None
+
+
+class FewsHandler(FakeUpstreamHandler):
+    def get(self, path, params):
+        times = [
+            (START_TIME + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            for i in range(self.sizes["times"])
+        ]
+        return {"layers": [{"name": "bench_layer", "times": times}]}
+
+
+class HydroengineHandler(FakeUpstreamHandler):
+    def post(self, path, data):
+        return {
+            "dataset": data.get("dataset"),
+            "url": "https://earthengine.googleapis.com/map/{}/{{z}}/{{x}}/{{y}}".format(data.get("dataset")),
+            "date": "2019-03-22T00:00:00",
+            "min": data.get("min", 0),
+            "max": data.get("max", 1),
+            "token": "",
+        }
+
+
+class ShorelineHandler(FakeUpstreamHandler):
+    def get(self, path, params):
+        # /shoreline-monitor/features/<box>/<section>/BOX_<box>_<section>.json
+        *_, box, section, _ = path.split("/")
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": [[4.0, 52.0], [4.1, 52.1]]},
+                "properties": {
+                    "transect_id": "BOX_{}_{}_{}".format(box, section, number),
+                    "country_name": "Netherlands",
+                    "continent": "Europe",
+                    "flag_sandy": "True",
+                    "change_rate": 0.5,
+                    "change_rate_unc": 0.1,
+                    "dt": [year + 0.5 for year in range(self.sizes["dates"])],
+                    "distances": [float(year) for year in range(self.sizes["dates"])],
+                },
+            }
+            for number in range(self.sizes["transects"])
+        ]
+        return {"type": "FeatureCollection", "features": features}
+
+
+class GoogleStorageHandler(FakeUpstreamHandler):
+    def get(self, path, params):
+        # /storage/v1/b/<bucket>/o?prefix=<folder>&delimiter=/
+        if not path.startswith("/storage/v1/b/"):
+            return None
+        prefixes = [
+            "{}glossis-current-{}/".format(
+                params.get("prefix", ""),
+                (START_TIME + timedelta(hours=i)).strftime("%Y%m%d%H%M%S"),
+            )
+            for i in range(self.sizes["tilesets"])
+        ]
+        start_offset = params.get("startOffset")
+        if start_offset is not None:
+            prefixes = [prefix for prefix in prefixes if prefix >= start_offset]
+        return {"prefixes": prefixes}
+
+
+HANDLERS = {
+    "dd-api": DDApiHandler,
+    "fewsWms": FewsHandler,
+    "hydroengine": HydroengineHandler,
+    "dd-api-shoreline": ShorelineHandler,
+    "googlestorage": GoogleStorageHandler,
+}
+
+DEFAULT_SIZES = {
+    "locations": 500,  # DD-API locations
+    "events": 500,  # DD-API timeseries events
+    "times": 100,  # FEWS layer times
+    "transects": 1000,  # transects per shoreline box
+    "dates": 35,  # dates per shoreline transect
+    "tilesets": 50,  # flowmap tileset folders
+}
+
+
+class FakeUpstream:
+    """A fake upstream server on a free local port, served from a daemon thread."""
+
+    def __init__(self, protocol, latency=0.0, sizes=None):
+        """
+        :param protocol: upstream protocol, see HANDLERS
+        :param latency: seconds added to every response
+        :param sizes: payload sizes, see DEFAULT_SIZES
+        """
+        handler = type(
+            HANDLERS[protocol].__name__,
+            (HANDLERS[protocol],),
+            {"latency": latency, "sizes": dict(DEFAULT_SIZES, **(sizes or {}))},
+        )
+        self.protocol = protocol
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_upstreams(latency=0.0, sizes=None):
+    """
+    Start a fake server for every upstream protocol
+    :return: dict of protocol: FakeUpstream
+    """
+    return {protocol: FakeUpstream(protocol, latency, sizes) for protocol in HANDLERS}
@@ -0,0 +1,217 @@
+"""
+Load test of the backend against local fake upstreams.
+
+Starts a fake server for every upstream (see fake_upstreams.py), points the
+dataset configuration at them, serves the application on a local port and
+drives its endpoints at the given concurrency levels. Reports throughput and
+latency percentiles per scenario, optionally as json to compare runs. Exits
+with status 1 when any request of a scenario failed.
+
+    python benchmarks/run.py --concurrency 1 8 32 --requests 500 --latency 50
+    python benchmarks/run.py --setting CACHE_TYPE=null --json no_cache.json
+"""
+import argparse
+import ast
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+
+from fake_upstreams import DEFAULT_SIZES, start_upstreams
+
+TIME_WINDOW = "startTime=2019-03-22T00:00:00Z&endTime=2019-03-26T00:00:00Z"
+
+SCENARIOS = {
+    "datasets": lambda i, sizes: "/datasets",
+    "locations": lambda i, sizes: "/locations?datasetId=wl",
+    "timeseries": lambda i, sizes: "/timeseries?datasetId=wl&locationId=diva_id__{}&{}".format(
+        i % sizes["locations"], TIME_WINDOW
+    ),
+    "shoreline": lambda i, sizes: "/timeseries?datasetId=sm&locationId=BOX_{:03d}_000_{}".format(
+        100 + i % 4, i % sizes["transects"]
+    ),
+    "batch": lambda i, sizes: "/timeseries/batch?datasetIds=wl&{}&{}".format(
+        "&".join("locationIds=diva_id__{}".format((i + n) % sizes["locations"]) for n in range(10)),
+        TIME_WINDOW,
+    ),
+}
+
+
+def write_settings(settings, directory):
+    """
+    Write application settings to a config file
+    :param settings: list of KEY=VALUE, values are python literals or strings
+    :return: path of the config file
+    """
+    path = os.path.join(directory, "benchmark_settings.cfg")
+    with open(path, "w") as f:
+        f.write("SHORELINE_CACHE_DIR = {!r}\n".format(os.path.join(directory, "shoreline_cache")))
+        f.write("LOG_DIR = {!r}\n".format(directory))
+        for setting in settings:
+            key, value = setting.split("=", 1)
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                pass
+            f.write("{} = {!r}\n".format(key, value))
+    return path
+
+
+def point_to_upstreams(providers_datasets, upstreams):
+    """
+    Replace the upstream hosts in the dataset configuration by the fake upstreams,
+    and add a FEWS dataset (the configuration has none)
+    """
+    for access in providers_datasets.DATASETS["access"].values():
+        for service in access.values():
+            fake = upstreams.get(service.get("protocol"))
+            if fake is not None and service.get("url"):
+                url = urlsplit(service["url"])
+                service["url"] = service["url"].replace(
+                    "{}://{}".format(url.scheme, url.netloc), fake.url, 1
+                )
+
+    gcs = upstreams["googlestorage"].url
+    providers_datasets.GOOGLE_STORAGE_URL = gcs + "/"
+    providers_datasets.GOOGLE_STORAGE_LIST_URL = gcs + "/storage/v1/b/{bucket}/o"
+
+    providers_datasets.DATASETS["access"]["bench_fews"] = {
+        "rasterService": {
+            "url": upstreams["fewsWms"].url + "/FewsWebServices/wms?request=GetCapabilities&format=application/json",
+            "featureinfo_url": upstreams["fewsWms"].url + "/FewsWebServices/wms",
+            "name": "bench_layer",
+            "protocol": "fewsWms",
+            "parameters": {"urlTemplate": upstreams["fewsWms"].url + "/FewsWebServices/wms?time=##TIME##"},
+        },
+        "dataService": {"url": "", "name": "", "protocol": "", "parameters": {}},
+    }
+    providers_datasets.DATASETS["info"]["datasets"].append({"id": "bench_fews", "name": "Benchmark FEWS"})
+
+
+def percentile(values, p):
+    # nearest rank
+    index = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def drive(base_url, scenario, sizes, concurrency, count):
+    """
+    Send `count` requests of a scenario with `concurrency` clients
+    :return: dict with throughput, errors and latency percentiles (ms)
+    """
+    make_path = SCENARIOS[scenario]
+    counter = iter(range(count))
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client():
+        session = requests.Session()
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                resp = session.get(base_url + make_path(i, sizes), timeout=60)
+                resp.content
+                ok = resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors.append(i)
+
+    threads = [threading.Thread(target=client) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": count,
+        "errors": len(errors),
+        "throughput": count / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p90": percentile(latencies, 90) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "max": latencies[-1] * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency")
+    parser.add_argument("--warmup", type=int, default=10, help="requests per scenario before measuring")
+    parser.add_argument("--latency", type=float, default=50, help="upstream latency in milliseconds")
+    for name, default in DEFAULT_SIZES.items():
+        parser.add_argument("--" + name, type=int, default=default, help="payload size")
+    parser.add_argument(
+        "--setting", action="append", default=[], metavar="KEY=VALUE",
+        help="application setting, e.g. CACHE_TYPE=null or UPSTREAM_POOL_SIZE=2",
+    )
+    parser.add_argument("--json", help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    sizes = {name: getattr(args, name) for name in DEFAULT_SIZES}
+    upstreams = start_upstreams(args.latency / 1000.0, sizes)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # the application reads its settings on import
+        os.environ["DGDS_BACKEND_SETTINGS"] = write_settings(args.setting, directory)
+        sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+        from werkzeug.serving import make_server
+        from dgds_backend import app, providers_datasets
+
+        point_to_upstreams(providers_datasets, upstreams)
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no access log
+        server = make_server("127.0.0.1", 0, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = "http://127.0.0.1:{}".format(server.server_port)
+
+        results = []
+        print("{:<12}{:>6}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "scenario", "conc", "reqs", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms"
+        ))
+        for scenario in args.scenarios:
+            if args.warmup:
+                drive(base_url, scenario, sizes, 1, args.warmup)
+            for concurrency in args.concurrency:
+                result = drive(base_url, scenario, sizes, concurrency, args.requests)
+                results.append(result)
+                print("{scenario:<12}{concurrency:>6}{requests:>8}{errors:>8}{throughput:>10.1f}"
+                      "{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{max:>10.1f}".format(**result))
+
+        server.shutdown()
+
+    for upstream in upstreams.values():
+        upstream.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
+
+    failed = sorted({result["scenario"] for result in results if result["errors"]})
+    if failed:
+        print("FAILED: requests of {} returned errors".format(", ".join(failed)), file=sys.stderr)
+
+    return results
+
+
+if __name__ == "__main__":
+    sys.exit(1 if any(result["errors"] for result in main()) else 0)
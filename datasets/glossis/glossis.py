@@ -16,6 +16,7 @@ import google.cloud.logging
 
 from utils import (
     cd,
+    AGGREGATES,
     fm_to_tiff,
     list_blobs,
     upload_to_gee,
@@ -87,6 +88,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--skip-cleanup", dest='skip_cleanup', default=False, action='store_true'
     )
+    parser.add_argument(
+        "--aggregate", dest='aggregate', default="median", choices=AGGREGATES,
+        help="aggregate of the face values around a mesh node"
+    )
+    parser.add_argument(
+        "--mesh-cache", dest='mesh_cache', default="tmp/mesh_cache/",
+        help="directory of the triangulated mesh cache, keep it between runs to skip the triangulation"
+    )
+    parser.add_argument(
+        "--processes", dest='processes', default=1, type=int,
+        help="worker processes rasterizing the netcdf subgrids, 0 for one per cpu"
+    )
 
     args = parser.parse_args()
     logging.info(args.bucket)
@@ -126,6 +139,9 @@ if __name__ == "__main__":
             output_fn="glossis_waterlevel",
             nodata=-9999,
             extra_bands=1,  # for astronomical tide
+            aggregate=args.aggregate,
+            mesh_cache=args.mesh_cache,
+            processes=args.processes,
         )
 
         # Update third band in rasters
@@ -153,6 +169,9 @@ if __name__ == "__main__":
             filter="currents",
             output_fn="glossis_currents",
             nodata=-9999,
+            aggregate=args.aggregate,
+            mesh_cache=args.mesh_cache,
+            processes=args.processes,
         )
 
         # these assets are needed by the flowmap
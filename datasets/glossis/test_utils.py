@@ -0,0 +1,144 @@
+import unittest
+
+import numpy as np
+from matplotlib.tri import LinearTriInterpolator, Triangulation
+
+try:
+    import utils
+except ImportError:  # needs the packages of environment.yml
+    utils = None
+
+
+def straddling_mesh(columns=12, rows=6):
+    """
+    Faces (1 based, as in D-Flow FM) of a regular mesh from 174 to 186
+    degrees east, with the nodes east of 180 at -180 and beyond, like a
+    GTSM subgrid straddling the antimeridian. Alternating squares and
+    pairs of triangles.
+    """
+    lon = np.linspace(174, 186, columns + 1)
+    lon = np.where(lon >= 180, lon - 360, lon)  # 180 itself is at -180
+    x, y = np.meshgrid(lon, np.linspace(-3, 3, rows + 1))
+
+    faces = []
+    for j in range(rows):
+        for i in range(columns):
+            a = j * (columns + 1) + i + 1
+            b, c, d = a + 1, a + columns + 2, a + columns + 1
+            if (i + j) % 2:
+                faces.append([a, b, c, d, np.nan, np.nan])
+            else:
+                faces.append([a, b, c, np.nan, np.nan, np.nan])
+                faces.append([a, c, d, np.nan, np.nan, np.nan])
+    return np.array(faces), x.ravel(), y.ravel()
+
+
+def fix_antimeridian_loop(x, y, triangles):
+    """The previous implementation of fix_antimeridian, one triangle at a time."""
+    triangles_x = x[triangles]
+    crossing = (triangles_x < -90).any(axis=1) & (triangles_x > 90).any(axis=1)
+    unique_points = {p: i for (i, p) in enumerate(zip(x, y))}
+    for it, triangle in enumerate(triangles):
+        if not crossing[it]:
+            continue
+        for ip, point in enumerate(triangle):
+            if x[point] < 0:
+                p = x[point] + 360, y[point]
+                if p not in unique_points:
+                    x = np.append(x, p[0])
+                    y = np.append(y, p[1])
+                    unique_points[p] = len(x) - 1
+                triangle[ip] = unique_points[p]
+    return x, y, triangles
+
+
+@unittest.skipIf(utils is None, "requires the glossis environment (environment.yml)")
+class AntimeridianTestCase(unittest.TestCase):
+    def setUp(self):
+        faces, self.x, self.y = straddling_mesh()
+        self.triangles = utils.dflowgrid2tri(faces)["triangles"]
+
+    def test_fix_antimeridian(self):
+        x, y, triangles = utils.fix_antimeridian(self.x, self.y, self.triangles.copy())
+
+        # no triangle spans the world anymore
+        triangles_x = x[triangles]
+        self.assertLess((triangles_x.max(axis=1) - triangles_x.min(axis=1)).max(), 2)
+
+        # western nodes are moved once, the original nodes are kept
+        self.assertTrue(np.array_equal(x[: len(self.x)], self.x))
+        new = np.column_stack((x[len(self.x):], y[len(self.x):]))
+        self.assertEqual(len(new), len(np.unique(new, axis=0)))
+        self.assertTrue((new[:, 0] >= 180).all())
+
+        # triangles east of 180 only are kept
+        eastern = (self.x[self.triangles] < 0).all(axis=1)
+        self.assertTrue(eastern.any())
+        self.assertTrue(np.array_equal(triangles[eastern], self.triangles[eastern]))
+
+    def test_fix_antimeridian_as_loop(self):
+        x, y, triangles = utils.fix_antimeridian(self.x, self.y, self.triangles.copy())
+        expected = fix_antimeridian_loop(self.x, self.y, self.triangles.copy())
+
+        self.assertTrue(np.array_equal(x, expected[0]))
+        self.assertTrue(np.array_equal(y, expected[1]))
+        self.assertTrue(np.array_equal(triangles, expected[2]))
+
+    def test_existing_nodes_are_used(self):
+        # a node at 180 east, the moved position of the node at -180
+        x = np.append(self.x, 180.0)
+        y = np.append(self.y, self.y[6])
+        at_180 = np.flatnonzero((self.x == -180) & (self.y == self.y[6]))
+        self.assertEqual(len(at_180), 1)
+
+        _, _, triangles = utils.fix_antimeridian(x, y, self.triangles.copy())
+        expected = fix_antimeridian_loop(x, y, self.triangles.copy())[2]
+
+        self.assertTrue(np.array_equal(triangles, expected))
+        self.assertIn(len(x) - 1, triangles)
+        self.assertTrue(np.isin(at_180, triangles).all())  # still used by eastern triangles
+
+    def test_no_crossing(self):
+        x = self.x + 360 * (self.x < 0)  # 174 to 186 east
+        triangles = self.triangles.copy()
+
+        fixed_x, fixed_y, fixed_triangles = utils.fix_antimeridian(x, self.y, triangles)
+
+        self.assertTrue(np.array_equal(fixed_x, x))
+        self.assertTrue(np.array_equal(fixed_triangles, self.triangles))
+
+
+@unittest.skipIf(utils is None, "requires the glossis environment (environment.yml)")
+class NodeDataTestCase(unittest.TestCase):
+    def test_aggregate_node_data(self):
+        faces, x, y = straddling_mesh()
+        mesh = utils.build_mesh(faces, x, y)
+        face_data = np.random.default_rng(1).normal(size=len(faces))
+        face_data[3] = np.nan
+
+        node_data = utils.aggregate_node_data(face_data, mesh)
+
+        triangles = utils.dflowgrid2tri(faces)
+        triangles, face_index = triangles["triangles"], triangles["index"]
+        _, _, triangles = utils.fix_antimeridian(x, y, triangles)
+        for node in range(len(mesh["x"])):
+            values = face_data[face_index][(triangles == node).any(axis=1)]
+            expected = np.median(values) if len(values) else -9999
+            np.testing.assert_equal(node_data[node], expected)
+
+    def test_interpolate(self):
+        faces, x, y = straddling_mesh()
+        mesh = dict(utils.build_mesh(faces, x, y), dir=None)
+        node_data = np.arange(len(mesh["x"]), dtype=float)
+        px = np.array([175.3, 179.95, 180.0, -179.95, -175.2, 0.0])
+        py = np.array([0.1, -2.5, 1.0, 2.9, 0.0, 0.0])
+
+        values = utils.interpolate(utils.load_interpolator(mesh, px, py, "test"), node_data)
+
+        triangulation = Triangulation(mesh["x"], mesh["y"], mesh["triangles"])
+        expected = LinearTriInterpolator(triangulation, node_data)(px, py)
+        np.testing.assert_allclose(values, np.ma.filled(expected, np.nan))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,7 @@
+import functools
+import hashlib
 import logging
+import multiprocessing
 import subprocess
 from datetime import datetime
 from contextlib import contextmanager
@@ -7,14 +10,17 @@ from os import environ
 from os.path import basename, exists, join
 import subprocess
 import json
+import shutil
+import tempfile
 
 import ee
 import netCDF4
 import numpy as np
 import rasterio
 from google.cloud import storage
-from matplotlib.tri import LinearTriInterpolator, Triangulation
+from matplotlib.tri import Triangulation
 from rasterio.transform import from_bounds
+from scipy import sparse
 
 PIPE = subprocess.PIPE
 
@@ -294,6 +300,316 @@ def dflowgrid2tri(mesh2d_face_nodes):
     return {"triangles": tri - 1, "index": index}
 
 
+AGGREGATES = ("median", "mean", "max")
+
+
+def node_face_adjacency(triangles, face_index, n_nodes):
+    """Build the node to face adjacency of a triangulated mesh, once per mesh.
+
+    The adjacency is in CSR form: the faces around node i are
+    faces[indptr[i]:indptr[i + 1]]. A face is listed once for every
+    triangle of that face the node is part of.
+
+    :param triangles: node indices of the triangles (triangles, 3)
+    :param face_index: original face of each triangle (triangles,)
+    :param n_nodes: number of nodes of the mesh
+    :return: dict with indptr (n_nodes + 1,) and faces
+    """
+    nodes = triangles.ravel()
+    faces = np.repeat(face_index, triangles.shape[1])
+
+    order = np.argsort(nodes, kind="stable")
+    counts = np.bincount(nodes, minlength=n_nodes)
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    return {"indptr": indptr, "faces": faces[order]}
+
+
+def aggregate_node_data(face_data, adjacency, method="median", nodata=-9999):
+    """Assign each node a value from the faces around it.
+
+    A missing (masked or nan) face value makes the value of its nodes nan,
+    nodes without faces get nodata.
+
+    :param face_data: value per face
+    :param adjacency: node to face adjacency, see node_face_adjacency
+    :param method: median, mean or max of the face values
+    :param nodata: value of nodes without faces
+    :return: value per node
+    """
+    if method not in AGGREGATES:
+        raise ValueError(
+            "Unknown aggregate {}, use one of {}.".format(method, ", ".join(AGGREGATES))
+        )
+
+    indptr = adjacency["indptr"]
+    counts = np.diff(indptr)
+    node_data = np.zeros(len(counts))
+    node_data.fill(nodata)
+
+    values = np.ma.filled(np.asanyarray(face_data), np.nan)[adjacency["faces"]]
+    if len(values) == 0:
+        return node_data
+
+    # reduceat needs non-empty segments, nodes without faces have none
+    has_faces = counts > 0
+    starts = indptr[:-1][has_faces]
+    counts = counts[has_faces]
+
+    if method == "mean":
+        node_data[has_faces] = np.add.reduceat(values.astype(np.float64), starts) / counts
+    elif method == "max":
+        node_data[has_faces] = np.maximum.reduceat(values, starts)
+    else:
+        # one row of face values per node, padded with inf, sorted per row.
+        # Nodes have few faces (~6), so this is much faster than a segmented sort.
+        rows = np.repeat(np.arange(len(starts)), counts)
+        columns = np.arange(len(values)) - np.repeat(starts, counts)
+        table = np.full((len(starts), counts.max()), np.inf, dtype=values.dtype)
+        table[rows, columns] = values
+        table.sort(axis=1)
+
+        rows = np.arange(len(starts))
+        low = table[rows, (counts - 1) // 2]
+        high = table[rows, counts // 2]
+        median = np.where(counts % 2 == 1, low, (low + high) / 2)
+        median[np.logical_or.reduceat(np.isnan(values), starts)] = np.nan
+        node_data[has_faces] = median
+
+    return node_data
+
+
+def fix_antimeridian(x, y, triangles):
+    """Fix triangles crossing over from -180 to 180.
+
+    The western nodes (x < 0) of a crossing triangle are replaced by new
+    nodes at the other side of the antimeridian (x + 360), so the triangle
+    keeps its shape. A new node is created once for all triangles sharing
+    it, or an existing node at that position is used. The triangles are
+    modified in place.
+
+    :return: x, y with the new nodes appended, triangles
+    """
+    triangles_x = x[
+        triangles.astype(np.int64)
+    ]  # all x coordinates for each triangle dim(:, 3)
+    # axis 1 has three triangle nodes
+    left = (triangles_x < -90).any(axis=1)
+    # axis 1 has three triangle nodes
+    right = (triangles_x > +90).any(axis=1)
+    crossing = np.flatnonzero(left & right)
+    if len(crossing) == 0:
+        return x, y, triangles
+
+    # Western nodes of the crossing triangles and their position when moved
+    # to the "right", in triangle order
+    rows = np.repeat(crossing, triangles.shape[1])
+    columns = np.tile(np.arange(triangles.shape[1]), len(crossing))
+    western = triangles_x[rows, columns] < 0
+    rows, columns = rows[western], columns[western]
+    nodes = triangles[rows, columns]
+    moved = np.column_stack((x[nodes] + 360, y[nodes]))
+
+    # Unique moved positions, in order of first use
+    points, first, inverse = np.unique(
+        moved, axis=0, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first)
+    points, inverse = points[order], np.argsort(order)[inverse.ravel()]
+
+    # Use existing nodes at a moved position (the last one, if duplicated)
+    candidates = np.flatnonzero(x >= points[:, 0].min())
+    keys = np.concatenate((np.column_stack((x[candidates], y[candidates])), points))
+    _, group = np.unique(keys, axis=0, return_inverse=True)
+    group = group.ravel()
+    existing = np.full(len(keys), -1, dtype=np.int64)
+    np.maximum.at(existing, group[: len(candidates)], candidates)
+    index = existing[group[len(candidates):]]
+
+    # Append the other positions as new nodes
+    new = index < 0
+    index[new] = len(x) + np.arange(np.count_nonzero(new))
+    x = np.concatenate((x, points[new, 0]))
+    y = np.concatenate((y, points[new, 1]))
+
+    triangles[rows, columns] = index[inverse]
+
+    return x, y, triangles
+
+
+# Arrays of a triangulated mesh, as stored in the mesh cache
+MESH_ARRAYS = ("triangles", "face_index", "x", "y", "indptr", "faces")
+
+# Change when build_mesh changes, invalidates the cached meshes
+MESH_VERSION = 1
+
+
+def build_mesh(mesh2d_face_nodes, x, y):
+    """Triangulate a D-Flow FM mesh, fix the antimeridian crossings
+    and build the node to face adjacency.
+
+    :param mesh2d_face_nodes: nodes of the faces (faces, nodes=6)
+    :param x: x coordinates of the nodes
+    :param y: y coordinates of the nodes
+    :return: dict of MESH_ARRAYS
+    """
+    tridata = dflowgrid2tri(mesh2d_face_nodes)
+    triangles, face_index = tridata["triangles"], tridata["index"]
+
+    x, y, triangles = fix_antimeridian(np.ma.getdata(x), np.ma.getdata(y), triangles)
+    adjacency = node_face_adjacency(triangles, face_index, len(x))
+
+    return {
+        "triangles": triangles,
+        "face_index": face_index,
+        "x": x,
+        "y": y,
+        "indptr": adjacency["indptr"],
+        "faces": adjacency["faces"],
+    }
+
+
+def mesh_key(mesh2d_face_nodes, x, y):
+    """Hash of the mesh variables, the key of a mesh in the cache."""
+    key = hashlib.sha256(str(MESH_VERSION).encode())
+    for array in (mesh2d_face_nodes, x, y):
+        data = np.ascontiguousarray(np.ma.getdata(array))
+        key.update("{}{}".format(data.dtype.str, data.shape).encode())
+        key.update(data.tobytes())
+        key.update(np.ascontiguousarray(np.ma.getmaskarray(array)).tobytes())
+    return key.hexdigest()
+
+
+def save_arrays(directory, arrays):
+    """Save arrays as .npy files in a new directory.
+
+    The files are written to a temporary directory first, renamed to the
+    directory when complete, so concurrent runs can share a cache.
+
+    :param directory: directory to create
+    :param arrays: dict of name: array
+    """
+    parent = os.path.dirname(os.path.normpath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    for name, array in arrays.items():
+        np.save(join(tmp_dir, name + ".npy"), array)
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir)  # saved by another run in the meantime
+
+
+def load_arrays(directory, names):
+    """Memory-map the .npy files saved by save_arrays."""
+    return {
+        name: np.load(join(directory, name + ".npy"), mmap_mode="r")
+        for name in names
+    }
+
+
+def load_mesh(mesh2d_face_nodes, x, y, cache_dir=None):
+    """Get a triangulated mesh (see build_mesh) from the cache, or build and cache it.
+
+    The GTSM mesh does not change between runs, a cached mesh is stored as
+    .npy files in cache_dir/<mesh_key> and memory-mapped when loaded.
+
+    :param cache_dir: cache directory, don't cache when None
+    :return: dict of MESH_ARRAYS, and the cache directory of the mesh (or None) as dir
+    """
+    if cache_dir is None:
+        return dict(build_mesh(mesh2d_face_nodes, x, y), dir=None)
+
+    key = mesh_key(mesh2d_face_nodes, x, y)
+    mesh_dir = join(cache_dir, key)
+    if exists(mesh_dir):
+        logger.info("Using cached mesh {}".format(key))
+        return dict(load_arrays(mesh_dir, MESH_ARRAYS), dir=mesh_dir)
+
+    mesh = build_mesh(mesh2d_face_nodes, x, y)
+    save_arrays(mesh_dir, mesh)
+    logger.info("Cached mesh {}".format(key))
+
+    return dict(mesh, dir=mesh_dir)
+
+
+# Arrays of the interpolation from mesh nodes to raster cells
+INTERPOLATION_ARRAYS = ("nodes", "weights", "inside")
+
+
+def interpolation_weights(mesh, px, py):
+    """Find the triangle containing each point and the barycentric
+    weights of its three nodes, as used by a LinearTriInterpolator.
+
+    :param mesh: triangulated mesh, see build_mesh
+    :param px: x coordinates of the points
+    :param py: y coordinates of the points
+    :return: dict of INTERPOLATION_ARRAYS, nodes and weights are (points, 3),
+        inside is False for points outside the mesh
+    """
+    triangulation = Triangulation(mesh["x"], mesh["y"], mesh["triangles"])
+    triangle = triangulation.get_trifinder()(px, py)
+    inside = triangle >= 0
+
+    nodes = np.zeros((len(px), 3), dtype=np.int64)
+    nodes[inside] = triangulation.triangles[triangle[inside]]
+    x0, x1, x2 = (triangulation.x[nodes[:, i]] for i in range(3))
+    y0, y1, y2 = (triangulation.y[nodes[:, i]] for i in range(3))
+
+    weights = np.zeros((len(px), 3))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+        weights[:, 0] = ((y1 - y2) * (px - x2) + (x2 - x1) * (py - y2)) / det
+        weights[:, 1] = ((y2 - y0) * (px - x2) + (x0 - x2) * (py - y2)) / det
+    weights[:, 2] = 1 - weights[:, 0] - weights[:, 1]
+    weights[~inside] = 0
+
+    return {"nodes": nodes, "weights": weights, "inside": inside}
+
+
+def load_interpolator(mesh, px, py, grid_key):
+    """Get the interpolation from mesh nodes to points as a sparse matrix,
+    stored with the mesh in its cache directory.
+
+    :param mesh: triangulated mesh, see load_mesh
+    :param px: x coordinates of the points
+    :param py: y coordinates of the points
+    :param grid_key: unique name of the points, as part of the cache file names
+    :return: dict with the sparse matrix (points, nodes) and inside
+    """
+    if mesh["dir"] is None:
+        arrays = interpolation_weights(mesh, px, py)
+    else:
+        weights_dir = join(mesh["dir"], "interpolation_{}".format(grid_key))
+        if exists(weights_dir):
+            arrays = load_arrays(weights_dir, INTERPOLATION_ARRAYS)
+        else:
+            arrays = interpolation_weights(mesh, px, py)
+            save_arrays(weights_dir, arrays)
+
+    n_points = len(arrays["nodes"])
+    matrix = sparse.csr_matrix(
+        (
+            np.ravel(arrays["weights"]),
+            np.ravel(arrays["nodes"]),
+            np.arange(0, 3 * n_points + 1, 3),
+        ),
+        shape=(n_points, len(mesh["x"])),
+    )
+    return {"matrix": matrix, "inside": np.asarray(arrays["inside"])}
+
+
+def interpolate(interpolator, node_data):
+    """Interpolate node values to the points of an interpolator (see load_interpolator).
+
+    :return: values at the points, nan outside the mesh
+    """
+    values = interpolator["matrix"].dot(node_data)
+    values[~interpolator["inside"]] = np.nan
+    return values
+
+
 def download_netcdfs_from_bucket(bucketname, prefixname, tmpdir, parameter):
     """Download all .nc files with parameter in name from bucket with prefix to tmpdir."""
 
@@ -320,6 +636,206 @@ def download_netcdfs_from_bucket(bucketname, prefixname, tmpdir, parameter):
     return local_files
 
 
+# Raster of the GLOSSIS geotiffs, need 0.05 degree resolution for ground pixel,
+# ~5.555km (at equator)
+DEGREE_RESOLUTION = 0.05
+MINX, MAXX, MINY, MAXY = -180, 180, -90, 90
+
+
+def raster_cells():
+    """x, y coordinates of the middle of the raster cells."""
+    x = np.arange(MINX + DEGREE_RESOLUTION / 2, MAXX, DEGREE_RESOLUTION)
+    y = np.arange(MINY + DEGREE_RESOLUTION / 2, MAXY, DEGREE_RESOLUTION)
+    return x, y
+
+
+def cell_range(cells, minimum, maximum):
+    """Slice of the (sorted) cells between minimum and maximum."""
+    inside = np.flatnonzero((minimum <= cells) & (cells <= maximum))
+    if len(inside) == 0:
+        return slice(0, 0)
+    return slice(inside[0], inside[-1] + 1)
+
+
+def rasterize_subgrid(local_file, timesteps, variables, nodata, aggregate, mesh_cache):
+    """Interpolate the variables of a subgrid netcdf to the raster, per timestep.
+
+    Yields a dict per timestep with the time, the analysis_time and
+    metadata of the file, the window (rows, columns) of the raster
+    covered by the subgrid and the rasters of the variables in the window
+    (nan outside the mesh).
+    """
+    x, y = raster_cells()
+    nc = netCDF4.Dataset(local_file, "r")
+
+    # Get the corresponding timestep
+    metadata = nc.__dict__
+    date_created = datetime.strptime(
+        metadata["date_created"], "%Y-%m-%d %H:%M:%S %Z"
+    )
+    metadata["date_created"] = datetime.strftime(
+        date_created, "%Y-%m-%dT%H:%M:%S")
+    analysis_time = netCDF4.num2date(
+        nc.variables["analysis_time"][:], units=nc.variables["analysis_time"].units
+    )[0]
+
+    # Setup mask, the window of the raster within the bounds of the nodes
+    node_x = nc.variables["Mesh_node_x"][:]
+    node_y = nc.variables["Mesh_node_y"][:]
+    window = (
+        cell_range(y, node_y.min(), node_y.max()),
+        cell_range(x, node_x.min(), node_x.max()),
+    )
+    xv, yv = np.meshgrid(x[window[1]], y[window[0]])
+    logger.info(
+        "Mask has {:.2f}% of total raster.".format(
+            xv.size / (len(x) * len(y)) * 100
+        )
+    )
+
+    # Retrieve mesh structure as triangles, from the cache if possible
+    mesh = load_mesh(nc.variables["Mesh_face_nodes"][:], node_x, node_y, mesh_cache)
+    face_index = mesh["face_index"]
+    adjacency = {"indptr": mesh["indptr"], "faces": mesh["faces"]}
+
+    # Create interpolation from the nodes to the masked raster cells,
+    # from the cache if possible. Ignore errors for now.
+    grid_key = "{}_{}_{}_{}_{}".format(DEGREE_RESOLUTION, MINX, MAXX, MINY, MAXY)
+    try:
+        interpolator = load_interpolator(mesh, xv.ravel(), yv.ravel(), grid_key)
+    except Exception as e:
+        logger.info(
+            "File {} has an invalid mesh ({}), output will have holes.".format(
+                local_file, e
+            )
+        )
+        interpolator = None
+
+    # Loop over variables (those with mesh_face/time dims)
+    for ti, time in enumerate(timesteps):
+        logger.info(
+            "Processing {} timestep {}. Current time {}".format(
+                local_file, time, datetime.now()
+            )
+        )
+        rasters = {}
+        for variable in variables:
+            empty = np.empty(xv.shape)
+            empty.fill(np.nan)
+            rasters[variable] = empty
+            if interpolator is None:
+                continue
+
+            # Retrieve variable and filter for crossing faces
+            data_var = nc.variables[variable][ti, :]  # first timestep
+            # plt.tripcolor(x, y, triangles, facecolors=data_var[face_index], edgecolors='k')
+
+            # Assign the nodes of triangles the values from the faces of the
+            # triangles. Current interpolation only works with nodes.
+            # TODO Use interpolation in assigning values.
+            # Aggregate the surrounding face values (can become nan)
+            node_data = aggregate_node_data(data_var, adjacency, aggregate, nodata)
+
+            # Interpolate
+            rasters[variable] = interpolate(interpolator, node_data).reshape(xv.shape)
+
+        yield {
+            "time": time,
+            "analysis_time": analysis_time,
+            "metadata": metadata,
+            "window": window,
+            "rasters": rasters,
+        }
+
+    nc.close()
+
+
+def rasterize_subgrid_to_files(local_file, timesteps, variables, nodata, aggregate, mesh_cache, out_dir):
+    """Run rasterize_subgrid in a worker process, the rasters are saved as
+    .npy files in out_dir instead of being sent back to the parent process.
+
+    :return: list of the timestep dicts, with the file of each raster
+    """
+    steps = []
+    for ti, step in enumerate(rasterize_subgrid(
+        local_file, timesteps, variables, nodata, aggregate, mesh_cache
+    )):
+        for vi, (variable, raster) in enumerate(step["rasters"].items()):
+            fn = join(out_dir, "{}_{}_{}.npy".format(basename(local_file), ti, vi))
+            np.save(fn, raster)
+            step["rasters"][variable] = fn
+        steps.append(step)
+    return steps
+
+
+def write_tiff(output_fn, step, extra_bands):
+    """Write the rasters of a subgrid timestep (see rasterize_subgrid) into
+    the geotiff of the timestep.
+
+    The first subgrid creates the geotiff with its metadata, later subgrids
+    are merged into it (maximum of the values).
+
+    :return: file name of the geotiff
+    """
+    tiff_fn = "{}_{}.tif".format(
+        output_fn, step["time"].strftime("%Y%m%d%H%M%S"))
+    x, y = raster_cells()
+    nx, ny = len(x), len(y)
+    window, rasters = step["window"], step["rasters"]
+
+    if exists(tiff_fn):
+
+        dst = rasterio.open(tiff_fn, "r+")
+
+        # Write all variables to bands
+        for i, (key, value) in enumerate(rasters.items()):
+            # merge raster with previous rasters
+            rraster = dst.read(i + 1)
+            rraster[window] = np.nanmax(
+                (value, rraster[window]), axis=0
+            )
+            dst.write_band(i + 1, rraster)
+        dst.close()
+
+    else:
+        # Create TIFF
+        transform = from_bounds(MINX, MAXY, MAXX, MINY, nx, ny)
+        dst = rasterio.open(
+            tiff_fn,
+            "w",
+            driver="GTiff",
+            height=ny,
+            width=nx,
+            count=len(rasters.keys()) + extra_bands,
+            dtype="float64",
+            crs="epsg:4326",
+            transform=transform,
+            tiled=True,
+            compress="deflate",
+        )
+
+        # Write all variables to bands
+        for i, (key, value) in enumerate(rasters.items()):
+            raster = np.empty((ny, nx))
+            raster.fill(np.nan)
+            raster[window] = value
+            dst.write_band(i + 1, raster)
+            dst.update_tags(i + 1, name=key)
+
+        # Get time data and add metadata and close file
+        time_meta = {
+            "system_time_start": step["time"].strftime(
+                "%Y-%m-%dT%H:%M:%S"
+            ),  # don't use : in key names
+            "analysis_time": step["analysis_time"].strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        dst.update_tags(**step["metadata"])
+        dst.update_tags(**time_meta)
+        dst.close()
+
+    return tiff_fn
+
+
 def fm_to_tiff(
     bucketname,
     prefixname,
@@ -329,8 +845,22 @@ def fm_to_tiff(
     output_fn="glossis_currents",
     nodata=-9999,
     extra_bands=0,
+    aggregate="median",
+    mesh_cache=None,
+    processes=1,
 ):
-    """Convert FM netcdfs in bucket into geotiffs for each timestep."""
+    """Convert FM netcdfs in bucket into geotiffs for each timestep.
+
+    Node values are the median, mean or max (aggregate) of the surrounding
+    face values, mean and max are faster than the median. The triangulated
+    meshes and their interpolation to the raster are kept in the mesh_cache
+    directory, if given, see load_mesh and load_interpolator.
+
+    With processes > 1 (or 0 for one per cpu) the subgrids are rasterized in
+    a pool of worker processes, a worker handles a single subgrid so its
+    memory is released afterwards. The rasters are merged in the order of
+    the files, the geotiffs are identical to those of a single process.
+    """
 
     # Get list of netcdfs files from bucket
     netcdfs = download_netcdfs_from_bucket(
@@ -345,6 +875,7 @@ def fm_to_tiff(
     timesteps = netCDF4.num2date(
         nc.variables["time"][:], units=nc.variables["time"].units
     )
+    nc.close()
     logger.info(
         "{} timesteps of which only the first six will be processed.".format(
             len(timesteps)
@@ -355,207 +886,45 @@ def fm_to_tiff(
     timesteps = timesteps[0:6]
     tiff_files = []
 
-    # Determine raster and cell coordinates
-    # need 0.05 degree resolution for ground pixel, ~5.555km (at equator)
-    degree_resolution = 0.05
-    minx, maxx, miny, maxy = -180, 180, -90, 90
-    # set x, y to the middle of raster cells
-    x = np.arange(minx + degree_resolution / 2, maxx, degree_resolution)
-    y = np.arange(miny + degree_resolution / 2, maxy, degree_resolution)
-    nx = len(x)
-    ny = len(y)
-    xv, yv = np.meshgrid(x, y)
-
     # Loop over all files (world is divided into 16 subgrids)
-    for netcdf in netcdfs:
-        fn = basename(netcdf)
-        local_file = join(tmpdir, fn)
-        nc = netCDF4.Dataset(local_file, "r")
-
-        # Retrieve mesh structure and convert to triangles
-        mesh2d_face_nodes = nc.variables["Mesh_face_nodes"][:]
-        tridata = dflowgrid2tri(mesh2d_face_nodes)
-        triangles, face_index = tridata["triangles"], tridata["index"]
-
-        # Get the corresponding timestep
-        metadata = nc.__dict__
-        date_created = datetime.strptime(
-            metadata["date_created"], "%Y-%m-%d %H:%M:%S %Z"
-        )
-        metadata["date_created"] = datetime.strftime(
-            date_created, "%Y-%m-%dT%H:%M:%S")
-        analysis_time = netCDF4.num2date(
-            nc.variables["analysis_time"][:], units=nc.variables["analysis_time"].units
-        )[0]
-
-        # Determine triangles crossing over from -180 to 180
-        # and remove these from the triangulation
-        # TODO Add new nodes with flipped x coords and keep crossing triangles
-        x = nc.variables["Mesh_node_x"][:]
-        y = nc.variables["Mesh_node_y"][:]
-
-        # Setup mask
-        min_x, max_x = x.min(), x.max()
-        min_y, max_y = y.min(), y.max()
-        mask = (min_x <= xv) & (xv <= max_x) & (min_y <= yv) & (yv <= max_y)
-        logger.info(
-            "Mask has {:.2f}% of total raster.".format(
-                np.count_nonzero(mask) / (nx * ny) * 100
-            )
-        )
-
-        triangles_x = x[
-            triangles.astype(np.int64)
-        ]  # all x coordinates for each triangle dim(:, 3)
-        # axis 1 has three triangle nodes
-        left = (triangles_x < -90).any(axis=1)
-        # axis 1 has three triangle nodes
-        right = (triangles_x > +90).any(axis=1)
-        crossing = np.array([left & right]).squeeze()
-
-        # Combine x, y so we won't duplicate points later
-        unique_points = {x: i for (i, x) in enumerate(zip(x, y))}
-
-        # For each triangle, check whether it's invalid
-        # and if so, fix it by creating a new point at the
-        # other side of the antimeridian and assigning it
-        # to the triangle.
-        for it, crossing_triangle in enumerate(triangles):
-
-            # We can index directly and skip these checks
-            # but then we lose the reference to the
-            # original we want to replace later
-            if not crossing[it]:  # ignore valid triangles
-                continue
-
-            for ip, point in enumerate(crossing_triangle):
-                if x[point] < 0:  # only fix by moving points to the "right"
-
-                    # Create new point and find its index
-                    p = x[point] + 360, y[point]
-                    if p not in unique_points:
-                        x = np.append(x, p[0])
-                        y = np.append(y, p[1])
-                        pidx = len(x) - 1  # index of appended point
-                        unique_points[p] = pidx
-                    else:
-                        pidx = unique_points[p]  # index of appended point
-
-                    crossing_triangle[ip] = pidx
-
-                else:
-                    continue
-
-            # Replace old triangle
-            triangles[it] = crossing_triangle
-
-        # Create interpolation and use it for interpolation
-        # on all grid nodes. Ignore errors for now.
-        triangulation = Triangulation(x, y, triangles)
-
-        # Loop over variables (those with mesh_face/time dims)
-        for ti, time in enumerate(timesteps):
-            logger.info(
-                "Processing {} timestep {}. Current time {}".format(
-                    netcdf, time, datetime.now()
-                )
+    local_files = [join(tmpdir, basename(netcdf)) for netcdf in netcdfs]
+    processes = min(processes or os.cpu_count(), len(local_files))
+    arguments = {
+        "timesteps": timesteps,
+        "variables": variables,
+        "nodata": nodata,
+        "aggregate": aggregate,
+        "mesh_cache": mesh_cache,
+    }
+
+    if processes == 1:
+        for local_file in local_files:
+            for step in rasterize_subgrid(local_file, **arguments):
+                tiff_files.append(write_tiff(output_fn, step, extra_bands))
+
+        return tiff_files
+
+    logger.info("Rasterizing {} subgrids with {} processes.".format(len(local_files), processes))
+    out_dir = tempfile.mkdtemp(dir=tmpdir)
+    # spawn, don't fork the open netcdf (hdf5) state of this process
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(processes, maxtasksperchild=1) as pool:
+            subgrids = pool.imap(
+                functools.partial(rasterize_subgrid_to_files, out_dir=out_dir, **arguments),
+                local_files,
             )
-            rasters = {}
-            for variable in variables:
-                empty = np.empty((ny, nx))
-                empty.fill(np.nan)
-                rasters[variable] = empty
-
-                # Retrieve variable and filter for crossing faces
-                data_var = nc.variables[variable][ti, :]  # first timestep
-                face_data = data_var[face_index]
-                # plt.tripcolor(x, y, triangles, facecolors=face_data, edgecolors='k')
-
-                # Assign the nodes of triangles the values from the faces of the
-                # triangles. Current interpolation only works with nodes.
-                # TODO Use interpolation in assigning values.
-                node_data_dict = {}  # dict of node:[]
-                for i, triangle in enumerate(triangles):
-                    for node in triangle:
-                        # Assign face value to node
-                        z = face_data[i]
-
-                        # nodes are shared by many triangles (~6)
-                        if node in node_data_dict:
-                            node_data_dict[node].append(z)
-                        else:
-                            node_data_dict[node] = [z]
-
-                # Take max of surrounding face values (can become nan)
-                node_data = np.zeros(x.shape)
-                node_data.fill(nodata)
-                for node, surrounding_face_values in node_data_dict.items():
-                    node_data[node] = np.median(surrounding_face_values)
-
-                try:
-                    interp = LinearTriInterpolator(triangulation, node_data)
-                except Exception as e:
-                    logger.info(
-                        "File {} has an invalid mesh ({}), output will have holes.".format(
-                            local_file, e
-                        )
-                    )
-                    continue
-
-                # Interpolate
-                raster = interp(xv[mask], yv[mask])
-                rasters[variable][mask] = raster
-
-            # Get time data and make file name
-            time_meta = {
-                "system_time_start": time.strftime(
-                    "%Y-%m-%dT%H:%M:%S"
-                ),  # don't use : in key names
-                "analysis_time": analysis_time.strftime("%Y-%m-%dT%H:%M:%S"),
-            }
-            tiff_fn = "{}_{}.tif".format(
-                output_fn, time.strftime("%Y%m%d%H%M%S"))
-            tiff_files.append(tiff_fn)
-
-            if exists(tiff_fn):
-
-                dst = rasterio.open(tiff_fn, "r+")
-
-                # Write all variables to bands
-                for i, (key, value) in enumerate(rasters.items()):
-                    # merge raster with previous rasters
-                    rraster = dst.read(i + 1)
-                    rraster[mask] = np.nanmax(
-                        (value[mask], rraster[mask]), axis=0
-                    )
-                    dst.write_band(i + 1, rraster)
-                dst.close()
-
-            else:
-                # Create TIFF
-                transform = from_bounds(minx, maxy, maxx, miny, nx, ny)
-                dst = rasterio.open(
-                    tiff_fn,
-                    "w",
-                    driver="GTiff",
-                    height=ny,
-                    width=nx,
-                    count=len(rasters.keys()) + extra_bands,
-                    dtype="float64",
-                    crs="epsg:4326",
-                    transform=transform,
-                    tiled=True,
-                    compress="deflate",
-                )
-
-                # Write all variables to bands
-                for i, (key, value) in enumerate(rasters.items()):
-                    dst.write_band(i + 1, value)
-                    dst.update_tags(i + 1, name=key)
-
-                # Add metadata and close file
-                dst.update_tags(**metadata)
-                dst.update_tags(**time_meta)
-                dst.close()
+            # merge in the order of the files, as a single process does
+            for steps in subgrids:
+                for step in steps:
+                    files = step["rasters"]
+                    step["rasters"] = {
+                        variable: np.load(fn) for variable, fn in files.items()
+                    }
+                    tiff_files.append(write_tiff(output_fn, step, extra_bands))
+                    for fn in files.values():
+                        os.remove(fn)
+    finally:
+        shutil.rmtree(out_dir)
 
     return tiff_files
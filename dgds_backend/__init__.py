@@ -0,0 +1,4 @@
+import time
+
+# start of the package import, the startup time is reported by /status
+IMPORT_STARTED = time.perf_counter()
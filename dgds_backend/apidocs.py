@@ -0,0 +1,40 @@
+"""API documentation (swagger) generated on first use."""
+import threading
+
+from flask_apispec.extension import FlaskApiSpec
+
+
+class LazyFlaskApiSpec(FlaskApiSpec):
+    """
+    FlaskApiSpec that only documents the registered views when the swagger
+    specification is first requested, instead of at import. Every worker
+    start skips converting the schemas of all views.
+    """
+
+    def __init__(self, app=None, document_options=True):
+        self._documented = False
+        self._lock = threading.Lock()
+        super().__init__(app, document_options)
+
+    def _defer(self, callable, *args, **kwargs):
+        with self._lock:
+            if self._documented:
+                return callable(*args, **kwargs)
+            self._deferred.append(lambda: callable(*args, **kwargs))
+
+    def init_app(self, app):
+        # the deferred registrations run on the first swagger request
+        deferred, self._deferred = self._deferred, []
+        super().init_app(app)
+        self._deferred = deferred
+
+    def document(self):
+        with self._lock:
+            if not self._documented:
+                for deferred in self._deferred:
+                    deferred()
+                self._documented = True
+
+    def swagger_json(self):
+        self.document()
+        return super().swagger_json()
@@ -1,36 +1,48 @@
 import json
-from copy import copy
+from copy import copy, deepcopy
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 
 import requests
 from flask import Flask, url_for, redirect, make_response
-from flask import request, jsonify, Response, abort
+from flask import request, jsonify, Response, abort, g
 from apispec import APISpec
 from flask_apispec import use_kwargs, marshal_with, doc
 from webargs.flaskparser import use_args
 from apispec.ext.marshmallow import MarshmallowPlugin
-from flask_apispec.extension import FlaskApiSpec
 from flask_cors import CORS
 from flask_caching import Cache
 from marshmallow import fields, validate
-
-from dgds_backend import error_handler
+from requests.exceptions import RequestException
+from werkzeug.exceptions import HTTPException
+
+from dgds_backend import IMPORT_STARTED, error_handler, metrics, providers_datasets, upstream
+from dgds_backend.apidocs import LazyFlaskApiSpec
+from dgds_backend.catalog import CatalogRefresher
+from dgds_backend.compression import CompressedResponses
+from dgds_backend.metrics import RequestMetrics
+from dgds_backend.profiler import RequestProfiler
 from dgds_backend.providers_timeseries import PiServiceDDL, dd_shoreline
 from dgds_backend.providers_datasets import (
+    clear_fews_capabilities,
     get_service_url,
     get_fews_url,
     get_hydroengine_url,
     DATASETS,
     get_google_storage_url,
 )
-from dgds_backend.schemas import DatasetSchema, TimeSerieSchema
+from dgds_backend.schemas import DatasetSchema, TimeSerieBatchSchema, TimeSerieSchema
+from dgds_backend.shoreline import ShorelineCache
+from dgds_backend.singleflight import SingleFlight, flight_stats
+from dgds_backend.timeseries_cache import TimeseriesCache
 
+IMPORTS_DONE = time.perf_counter()
 
 app = Flask(__name__)
 CORS(app)
-cache = Cache(app, config={"CACHE_TYPE": "simple"})
 app.config.update(
     {
         "APISPEC_SPEC": APISpec(
@@ -42,7 +54,8 @@ app.config.update(
         "APISPEC_SWAGGER_URL": "/swagger/",
     }
 )
-docs = FlaskApiSpec(app)
+# the views are documented on the first swagger request
+docs = LazyFlaskApiSpec(app)
 
 # Configuration load
 app.config.from_object("dgds_backend.default_settings")
@@ -53,6 +66,42 @@ except (RuntimeError, FileNotFoundError) as e:
         "Could not load config from environment variables"
     )  # logging not set yet [could not read config]
 
+# Upstream connection pools
+upstream.configure(app.config)
+providers_datasets.configure(app.config)
+
+# Local cache of the static shoreline box files
+shoreline_cache = ShorelineCache(
+    app.config["SHORELINE_CACHE_DIR"], app.config["SHORELINE_CACHE_MAX_AGE"]
+)
+
+# Cache shared by the catalog and the memoized dataset lookups, see CACHE_TYPE
+cache = Cache(app)
+
+# DD-API responses, aligned on the forecast cycles of the datasets
+timeseries_cache = TimeseriesCache(cache)
+
+# Compressed responses with ETags and conditional GET
+compressed = CompressedResponses(app)
+
+# Request counts, latency and in-flight requests per route, see /metrics
+RequestMetrics(app)
+
+# Sampling profiler of live requests, only registered when enabled
+RequestProfiler(app)
+
+
+# All upstream requests of an incoming request share a deadline
+@app.before_request
+def set_upstream_deadline():
+    upstream.set_deadline(app.config["UPSTREAM_REQUEST_DEADLINE"])
+
+
+@app.teardown_request
+def clear_upstream_deadline(exception=None):
+    upstream.set_deadline(None)
+
+
 # only catch error if we're not in debug mode
 if not app.debug:
     app.register_blueprint(error_handler.error_handler)
@@ -72,6 +121,17 @@ if not app.debug:
     app.logger.addHandler(file_handler)
 
 
+def refresh_interval(service_url_data):
+    """
+    Refresh cadence of a dataset, used to align and expire cached timeseries
+    :param service_url_data: dataService of the dataset
+    :return: seconds
+    """
+    return service_url_data.get(
+        "refreshInterval", app.config["TIMESERIES_CACHE_CYCLE"]
+    )
+
+
 @app.route("/locations", methods=["GET", "POST"])
 @use_kwargs(
     {
@@ -91,16 +151,31 @@ def locations(**input):
         service_url_data["url"],
         service_url_data["name"],
         service_url_data["protocol"],
-        service_url_data["parameters"],
     )
 
     # Query PiService
     pi = PiServiceDDL(observation_type_id, data_url, request.url_root)
-    content = pi.get_locations(input)
+    content = timeseries_cache.get_locations(
+        pi, input, refresh_interval(service_url_data)
+    )
 
     return jsonify(content)
 
 
+def timeseries_version(autoPaging, **input):
+    """
+    Version of a cached timeseries response, for its ETag
+    :param autoPaging: streamed responses are not versioned
+    :param input: timeseries request parameters
+    :return: version or None
+    """
+    service_url_data = get_service_url(input["datasetId"], "dataService")
+    if autoPaging or service_url_data["protocol"] != "dd-api":
+        return None
+    pi = PiServiceDDL(service_url_data["name"], service_url_data["url"], request.url_root)
+    return timeseries_cache.version(pi, input)
+
+
 @app.route("/timeseries", methods=["GET", "POST"])
 @use_kwargs(
     {
@@ -110,12 +185,71 @@ def locations(**input):
         "locationId": fields.Str(required=True),
         "startTime": fields.Str(),
         "endTime": fields.Str(),
+        "autoPaging": fields.Bool(missing=False),
     }
 )
 @marshal_with(TimeSerieSchema(many=True))
-def timeseries(**input):
+@compressed.conditional(timeseries_version)
+def timeseries(autoPaging, **input):
     """
-    Timeseries query
+    Timeseries query. With autoPaging, all DD-API pages are followed by the
+    backend and streamed as a single response.
+    """
+    if autoPaging:
+        service_url_data = get_service_url(input["datasetId"], "dataService")
+        if service_url_data["protocol"] == "dd-api":
+            pi = PiServiceDDL(
+                service_url_data["name"], service_url_data["url"], request.url_root
+            )
+            pages = pi.iter_timeseries_pages(
+                input, app.config["TIMESERIES_AUTOPAGING_MAX_PAGES"]
+            )
+            # fetch the first page before streaming, so its errors get a proper status
+            first = next(pages)
+            return Response(stream_timeseries(first, pages), mimetype="application/json")
+
+    return jsonify(timeseries_content(input, request.url_root))
+
+
+def stream_timeseries(first, pages):
+    """
+    Stream DD-API pages as a single timeseries response, with the results of all
+    pages. An upstream error after the first page ends the results and is
+    reported in the "error" field.
+    :param first: first DD-API page
+    :param pages: generator of the next pages
+    :return: generator of json chunks
+    """
+    yield '{{"provider": {}, "results": ['.format(json.dumps(first.get("provider")))
+
+    separator = ""
+    error = None
+    page = first
+    try:
+        while page is not None:
+            for result in page.get("results", []):
+                yield separator + json.dumps(result)
+                separator = ", "
+            page = next(pages, None)
+    except Exception as e:
+        logging.error("Timeseries paging failed: {}".format(e))
+        error = {"name": "Bad Gateway", "description": str(e)}
+    finally:
+        pages.close()
+
+    paging = {"next": None, "prev": None}
+    if error is not None:
+        yield '], "paging": {}, "error": {}}}'.format(json.dumps(paging), json.dumps(error))
+    else:
+        yield '], "paging": {}}}'.format(json.dumps(paging))
+
+
+def timeseries_content(input, url_root):
+    """
+    Get the timeseries of a single dataset and location
+    :param input: timeseries request parameters, with datasetId and locationId
+    :param url_root: root url of this service, used in the paging links
+    :return: timeseries content
     """
     # Get dataset identification
     service_url_data = get_service_url(input["datasetId"], "dataService")
@@ -127,14 +261,20 @@ def timeseries(**input):
 
     # Query PiService
     if protocol == "dd-api":
-        pi = PiServiceDDL(observation_type_id, data_url, request.url_root)
-        content = pi.get_timeseries(input)
+        pi = PiServiceDDL(observation_type_id, data_url, url_root)
+        content = timeseries_cache.get_timeseries(
+            pi, input, refresh_interval(service_url_data)
+        )
 
     # Specific endpoint for DD like shoreline data
     elif protocol == "dd-api-shoreline":
         transect = input.get("locationId", None)
         content = dd_shoreline(
-            data_url, transect, observation_type_id, input["datasetId"]
+            data_url,
+            transect,
+            observation_type_id,
+            input["datasetId"],
+            cache=shoreline_cache,
         )
 
     # Specific endpoint for static images
@@ -143,36 +283,193 @@ def timeseries(**input):
 
     else:
         error = "Unknown protocol in configuration."
-        raise HTTPException(error)
         logging.error(error)
+        abort(500, error)
 
-    return jsonify(content)
+    return content
+
+
+@app.route("/timeseries/batch", methods=["GET", "POST"])
+@use_kwargs(
+    {
+        "datasetIds": fields.List(
+            fields.Str(validate=validate.OneOf(DATASETS["access"].keys())),
+            required=True,
+            validate=validate.Length(min=1),
+        ),
+        "locationIds": fields.List(
+            fields.Str(), required=True, validate=validate.Length(min=1)
+        ),
+        "startTime": fields.Str(),
+        "endTime": fields.Str(),
+    }
+)
+@marshal_with(TimeSerieBatchSchema)
+def timeseries_batch(datasetIds, locationIds, **window):
+    """
+    Timeseries query for every combination of datasetIds and locationIds, fetched
+    concurrently. Results are in request order, failed items report their error inline.
+    """
+    items = [
+        dict(window, datasetId=dataset_id, locationId=location_id)
+        for dataset_id in datasetIds
+        for location_id in locationIds
+    ]
+    if len(items) > app.config["TIMESERIES_BATCH_MAX_ITEMS"]:
+        abort(
+            422,
+            "At most {} timeseries per batch, got {}.".format(
+                app.config["TIMESERIES_BATCH_MAX_ITEMS"], len(items)
+            ),
+        )
+
+    url_root = request.url_root
+    remaining = upstream.remaining()
+
+    def fetch(input):
+        result = {"datasetId": input["datasetId"], "locationId": input["locationId"]}
+        try:
+            with app.app_context(), upstream.deadline(remaining):
+                result["content"] = timeseries_content(dict(input), url_root)
+            result["status"] = 200
+        except HTTPException as e:
+            result["status"] = e.code
+            result["error"] = {"name": e.name, "description": e.description}
+        except RequestException as e:
+            result["status"] = 503 if isinstance(e, upstream.UpstreamUnavailable) else 502
+            result["error"] = {"name": "UpstreamError", "description": str(e)}
+        except Exception as e:
+            logging.error(
+                "Timeseries of {} at {} failed: {}".format(
+                    input["datasetId"], input["locationId"], e
+                )
+            )
+            result["status"] = 500
+            result["error"] = {"name": "UnexpectedException", "description": str(e)}
+        return result
+
+    workers = min(app.config["TIMESERIES_BATCH_MAX_WORKERS"], len(items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch, items))
+
+    return jsonify({"results": results})
+
+
+def datasets_version():
+    """
+    Version of the catalog served in the background refresh mode, for its ETag
+    :return: version or None
+    """
+    if app.config["DATASETS_REFRESH"] != "background":
+        return None
+    return catalog.version()
 
 
 @app.route("/datasets", methods=["GET"])
+@compressed.conditional(datasets_version)
 # cache this request so it returns the same result for 6 hours.
-@cache.cached(timeout=6 * 60 * 60, key_prefix="datasets")
+# a degraded catalog is not cached, so missing datasets are retried next request.
+@cache.cached(
+    timeout=6 * 60 * 60,
+    key_prefix="datasets",
+    unless=lambda: app.config["DATASETS_REFRESH"] == "background",
+    response_filter=lambda rv: not g.get("datasets_degraded", False),
+)
 @marshal_with(DatasetSchema(many=True))
 def datasets():
     """
     Get datasets, populated with applicable urls for each dataset. Cached on 6hr intervals,
     based on time between new GLOSSIS files created
     """
-    # TODO: move this out of here and into a task (with celery or something)
+    # serve the last good catalog, it is rebuilt in the background
+    if app.config["DATASETS_REFRESH"] == "background":
+        return jsonify(catalog.get())
+
+    # we have datasetinfo from the json file
+    # also get more information by calling the /dataset url
+    degraded = resolve_datasets(DATASETS["info"]["datasets"])
+    g.datasets_degraded = bool(degraded)
+
+    #  all of the above is inline, so we can return the original object.
+    return jsonify(DATASETS["info"])
 
-    # Loop over datasets
-    for datasetinfo in DATASETS["info"]["datasets"]:
+
+def resolve_datasets(datasets_info, resolve=None):
+    """
+    Resolve the upstream information of all datasets concurrently, with a bounded
+    worker pool and a global deadline. Datasets that fail or miss the deadline
+    are marked as degraded (keeping any information of a previous resolve).
+    :param datasets_info: list of dataset info dicts, updated inline
+    :param resolve: function resolving a single dataset, defaults to `dataset`
+    :return: list of degraded dataset ids
+    """
+    # the workers share the deadline of the incoming request, if any
+    resolve = upstream.with_deadline(resolve or dataset)
+    # new refresh cycle, all FEWS datasets share a single capabilities fetch
+    clear_fews_capabilities()
+    executor = ThreadPoolExecutor(max_workers=app.config["DATASETS_MAX_WORKERS"])
+    futures = {
+        executor.submit(resolve, datasetinfo["id"], None): datasetinfo
+        for datasetinfo in datasets_info
+    }
+    done, _ = wait(futures, timeout=app.config["DATASETS_TIMEOUT"])
+    # don't wait for slow upstreams, they finish (and get memoized) in the background
+    executor.shutdown(wait=False)
+
+    degraded = []
+    for future, datasetinfo in futures.items():
         id = datasetinfo["id"]
+        if future in done and future.exception() is None:
+            # update the dataset with relevant info from the Url
+            datasetinfo.update(future.result())
+            datasetinfo.pop("degraded", None)
+            continue
 
-        # we have datasetinfo from the json file
-        # also get more information by calling the /dataset url
-        data = dataset(id, None)
+        if future in done:
+            logging.error(
+                "Dataset id {} could not be resolved: {}".format(id, future.exception())
+            )
+        else:
+            future.cancel()
+            logging.error(
+                "Dataset id {} not resolved within {} seconds".format(
+                    id, app.config["DATASETS_TIMEOUT"]
+                )
+            )
+        datasetinfo["degraded"] = True
+        degraded.append(id)
 
-        # update the dataset with relevant info from the Url
-        datasetinfo.update(data)
+    return degraded
 
-    #  all of the above is inline, so we can return the original object.
-    return jsonify(DATASETS["info"])
+
+def build_catalog(previous=None):
+    """
+    Build a new dataset catalog from the upstreams, without touching the one
+    being served. Degraded datasets keep their information from the previous catalog.
+    :param previous: previous catalog or None
+    :return: catalog, whether all datasets were resolved
+    """
+    new_catalog = deepcopy(DATASETS["info"])
+    # bypass the memoization, the catalog is rebuilt because it's outdated
+    degraded = resolve_datasets(new_catalog["datasets"], resolve=dataset.uncached)
+
+    if previous is not None and degraded:
+        previous_datasets = {d["id"]: d for d in previous["datasets"]}
+        for datasetinfo in new_catalog["datasets"]:
+            if datasetinfo["id"] in degraded and datasetinfo["id"] in previous_datasets:
+                datasetinfo.update(previous_datasets[datasetinfo["id"]])
+                datasetinfo["degraded"] = True
+
+    return new_catalog, not degraded
+
+
+catalog = CatalogRefresher(
+    build_catalog,
+    timeout=app.config["DATASETS_REFRESH_TIMEOUT"],
+    refresh_ahead=app.config["DATASETS_REFRESH_AHEAD"],
+    retry_interval=app.config["DATASETS_REFRESH_RETRY"],
+    store=cache,
+)
 
 
 @app.route("/datasets/<string:datasetId>/<path:imageId>", methods=["GET"])
@@ -181,13 +478,23 @@ def datasets():
         "min": fields.Float(required=False),
         "max": fields.Float(required=False),
         "band": fields.Str(required=False),
+        "flowmapStartTime": fields.DateTime(required=False),
+        "flowmapEndTime": fields.DateTime(required=False),
+        "flowmapFrames": fields.Int(required=False, validate=validate.Range(min=1)),
     }
 )
 def dataset_url(*args, **kwargs):
     return dataset(*args, **kwargs)
 
 
+# concurrent misses of the same dataset share a single upstream lookup
+dataset_flight = SingleFlight("dataset")
+
+
 @cache.memoize(timeout=6 * 60 * 60)
+@dataset_flight.coalesce(
+    key=lambda datasetId, imageId, **kwargs: (datasetId, imageId, tuple(sorted(kwargs.items())))
+)
 def dataset(datasetId, imageId, **kwargs):
     service_url_data = get_service_url(datasetId, "rasterService")
     access_url = service_url_data["url"]
@@ -196,6 +503,11 @@ def dataset(datasetId, imageId, **kwargs):
     protocol = service_url_data["protocol"]
     parameters = copy(service_url_data["parameters"])
 
+    # Flowmap time window parameters are not passed on to the raster service
+    start_time = kwargs.pop("flowmapStartTime", None)
+    end_time = kwargs.pop("flowmapEndTime", None)
+    frames = kwargs.pop("flowmapFrames", None)
+
     # Add any additional parameters given in request
     parameters.update(kwargs)
 
@@ -227,7 +539,13 @@ def dataset(datasetId, imageId, **kwargs):
 
         if protocol == "googlestorage":
             flowmap_data = get_google_storage_url(
-                datasetId, name, access_url, parameters
+                datasetId,
+                name,
+                access_url,
+                parameters,
+                start_time=start_time,
+                end_time=end_time,
+                frames=frames,
             )
         else:
             logging.error(
@@ -242,6 +560,74 @@ def dataset(datasetId, imageId, **kwargs):
     return dataset_dict
 
 
+@app.route("/status", methods=["GET"])
+def status():
+    """
+    Upstream connection pool, circuit breaker, hedging and coalescing statistics,
+    and the startup time of this process, for monitoring.
+    """
+    return jsonify(
+        {
+            "pools": upstream.pool_stats(),
+            "breakers": upstream.breaker_stats(),
+            "hedges": upstream.hedge_stats(),
+            "flights": flight_stats(),
+            "startup": STARTUP,
+        }
+    )
+
+
+def cache_metrics():
+    """
+    Metrics of the Flask-Caching cache and of the coalesced upstream lookups
+    :return: list of metrics
+    """
+    operations = metrics.Counter(
+        "dgds_cache_operations_total",
+        "Cache lookups (hits, misses), sets and rejected (too large) values.",
+        ("result",),
+    )
+    hit_ratio = metrics.Gauge("dgds_cache_hit_ratio", "Cache hits per lookup.")
+    stats = getattr(cache.cache, "stats", dict)()
+    for result, count in stats.items():
+        operations.inc(result, amount=count)
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    if lookups:
+        hit_ratio.set(value=stats["hits"] / lookups)
+
+    coalesced = metrics.Counter(
+        "dgds_coalesced_calls_total",
+        "Calls of coalesced lookups, and calls that shared an in-flight call.",
+        ("flight", "result"),
+    )
+    for name, flight in flight_stats().items():
+        coalesced.inc(name, "called", amount=flight["calls"])
+        coalesced.inc(name, "shared", amount=flight["shared"])
+
+    breaker_trips = metrics.Counter(
+        "dgds_upstream_breaker_trips_total", "Circuit breaker trips per upstream host.", ("host",)
+    )
+    breaker_open = metrics.Gauge(
+        "dgds_upstream_breaker_open", "Whether the circuit breaker of an upstream host is open.", ("host",)
+    )
+    for host, breaker in upstream.breaker_stats().items():
+        breaker_trips.inc(host, amount=breaker["trips"])
+        breaker_open.set(host, value=int(breaker["state"] != "closed"))
+
+    return [operations, hit_ratio, coalesced, breaker_trips, breaker_open]
+
+
+metrics.COLLECTORS.append(cache_metrics)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Metrics of this process in the Prometheus text format, for monitoring.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route("/", methods=["GET"])
 def root():
     """
@@ -253,8 +639,32 @@ def root():
 docs.register(datasets)
 docs.register(dataset_url)
 docs.register(timeseries)
+docs.register(timeseries_batch)
 docs.register(locations)
 
+# Startup timing of this process, reported by /status and /metrics
+STARTUP = {
+    "imports": IMPORTS_DONE - IMPORT_STARTED,
+    "total": time.perf_counter() - IMPORT_STARTED,
+}
+logging.info(
+    "Application loaded in {:.3f}s ({:.3f}s imports)".format(
+        STARTUP["total"], STARTUP["imports"]
+    )
+)
+
+
+def startup_metrics():
+    startup = metrics.Gauge(
+        "dgds_startup_seconds", "Time to load the application, per phase.", ("phase",)
+    )
+    for phase, seconds in STARTUP.items():
+        startup.set(phase, value=seconds)
+    return [startup]
+
+
+metrics.COLLECTORS.append(startup_metrics)
+
 
 def main():
     app.run(threaded=True)
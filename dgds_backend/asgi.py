@@ -0,0 +1,367 @@
+"""
+Asynchronous (ASGI) entry point, serving /datasets, /locations and /timeseries
+with non-blocking upstream clients. A single process can hold many concurrent
+upstream-bound requests, run it with any ASGI server, e.g.
+
+    uvicorn dgds_backend.asgi:app
+
+Requires the async extra, `pip install dgds_backend[async]`.
+"""
+import asyncio
+import json
+import logging
+import time
+from copy import copy, deepcopy
+from functools import partial
+from urllib.parse import parse_qsl
+
+from flask import Config
+
+from dgds_backend import providers_async, providers_datasets, upstream
+from dgds_backend.providers_datasets import (
+    APP_DIR,
+    DATASETS,
+    clear_fews_capabilities,
+    get_service_url,
+)
+from dgds_backend.providers_timeseries import dd_shoreline
+from dgds_backend.shoreline import ShorelineCache
+
+# Configuration load, same settings as the Flask application
+config = Config(str(APP_DIR))
+config.from_object("dgds_backend.default_settings")
+try:
+    config.from_envvar("DGDS_BACKEND_SETTINGS")
+except (RuntimeError, FileNotFoundError) as e:
+    logging.warning("Could not load config from environment variables")
+
+upstream.configure(config)
+providers_datasets.configure(config)
+shoreline_cache = ShorelineCache(
+    config["SHORELINE_CACHE_DIR"], config["SHORELINE_CACHE_MAX_AGE"]
+)
+
+
+class HTTPError(Exception):
+    """Error response, rendered like the Flask error handler."""
+
+    def __init__(self, code, name, description):
+        super().__init__(description)
+        self.code = code
+        self.name = name
+        self.description = description
+
+
+def validate_args(args, required):
+    """
+    Validate request arguments like the webargs schemas of the Flask application
+    :param args: request arguments
+    :param required: required argument names
+    :return: args
+    """
+    errors = {
+        name: ["Missing data for required field."] for name in required if name not in args
+    }
+    if "datasetId" in args and args["datasetId"] not in DATASETS["access"]:
+        errors["datasetId"] = [
+            "Must be one of: {}.".format(", ".join(DATASETS["access"].keys()))
+        ]
+    if errors:
+        raise HTTPError(422, "Unprocessable Entity", errors)
+    return args
+
+
+async def dataset(datasetId, imageId, **kwargs):
+    """
+    Get the raster and flowmap layer information of a dataset, see app.dataset
+    """
+    service_url_data = get_service_url(datasetId, "rasterService")
+    access_url = service_url_data["url"]
+    feature_url = service_url_data["featureinfo_url"]
+    name = service_url_data["name"]
+    protocol = service_url_data["protocol"]
+    parameters = copy(service_url_data["parameters"])
+    parameters.update(kwargs)
+
+    if protocol == "fewsWms":
+        data = await providers_async.get_fews_url(
+            datasetId, name, access_url, feature_url, parameters
+        )
+    elif protocol == "hydroengine":
+        data = await providers_async.get_hydroengine_url(
+            datasetId, name, access_url, feature_url, parameters, image_id=imageId
+        )
+    else:
+        logging.error(
+            "{} protocol not recognized for dataset datasetId {}".format(
+                protocol, datasetId
+            )
+        )
+        data = {}
+
+    dataset_dict = {"rasterLayer": data}
+
+    # Populate flowmapLayer information
+    service_url_data = get_service_url(datasetId, "flowmapService")
+    if service_url_data:
+        if service_url_data["protocol"] == "googlestorage":
+            flowmap_data = await providers_async.get_google_storage_url(
+                datasetId,
+                service_url_data["name"],
+                service_url_data["url"],
+                service_url_data["parameters"],
+            )
+        else:
+            logging.error(
+                "{} protocol not recognized for flowmap datasetId {}".format(
+                    service_url_data["protocol"], datasetId
+                )
+            )
+            flowmap_data = {}
+        dataset_dict["flowmapLayer"] = flowmap_data
+
+    return dataset_dict
+
+
+async def build_catalog(previous=None):
+    """
+    Build a new dataset catalog, resolving all datasets concurrently with a global
+    deadline. Degraded datasets keep their information from the previous catalog.
+    :param previous: previous catalog or None
+    :return: catalog, whether all datasets were resolved
+    """
+    new_catalog = deepcopy(DATASETS["info"])
+    clear_fews_capabilities()
+    semaphore = asyncio.Semaphore(config["DATASETS_MAX_WORKERS"])
+
+    async def resolve(datasetinfo):
+        async with semaphore:
+            return await dataset(datasetinfo["id"], None)
+
+    tasks = {
+        asyncio.ensure_future(resolve(datasetinfo)): datasetinfo
+        for datasetinfo in new_catalog["datasets"]
+    }
+    done, pending = await asyncio.wait(list(tasks), timeout=config["DATASETS_TIMEOUT"])
+    for task in pending:
+        task.cancel()
+
+    previous_datasets = {d["id"]: d for d in previous["datasets"]} if previous else {}
+    complete = True
+    for task, datasetinfo in tasks.items():
+        if task in done and task.exception() is None:
+            datasetinfo.update(task.result())
+            continue
+
+        logging.error("Dataset id {} could not be resolved".format(datasetinfo["id"]))
+        datasetinfo.update(previous_datasets.get(datasetinfo["id"], {}))
+        datasetinfo["degraded"] = True
+        complete = False
+
+    return new_catalog, complete
+
+
+class AsyncCatalog:
+    """
+    Dataset catalog served stale while a single background task rebuilds it,
+    the asyncio counterpart of catalog.CatalogRefresher.
+    """
+
+    def __init__(self, timeout, refresh_ahead, retry_interval):
+        self.timeout = timeout
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self._state = None  # (catalog, refresh due at)
+        self._task = None
+
+    def _swap(self, catalog, complete):
+        delay = self.timeout - self.refresh_ahead if complete else self.retry_interval
+        self._state = (catalog, time.time() + delay)
+
+    async def get(self):
+        if self._state is None:
+            async with providers_async.get_lock("catalog", id(self)):
+                if self._state is None:
+                    self._swap(*await build_catalog())
+        elif time.time() >= self._state[1] and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self.refresh())
+        return self._state[0]
+
+    async def refresh(self):
+        try:
+            self._swap(*await build_catalog(self._state[0]))
+        except Exception:
+            logging.exception("Failed to refresh the dataset catalog, keeping the previous one")
+            self._state = (self._state[0], time.time() + self.retry_interval)
+
+
+catalog = AsyncCatalog(
+    timeout=config["DATASETS_REFRESH_TIMEOUT"],
+    refresh_ahead=config["DATASETS_REFRESH_AHEAD"],
+    retry_interval=config["DATASETS_REFRESH_RETRY"],
+)
+
+
+async def datasets(args, url_root):
+    """
+    Get datasets, populated with applicable urls for each dataset
+    """
+    return await catalog.get()
+
+
+async def locations(args, url_root):
+    """
+    Query locations
+    """
+    args = validate_args(args, ["datasetId"])
+    service_url_data = get_service_url(args["datasetId"], "dataService")
+
+    pi = providers_async.AsyncPiServiceDDL(
+        service_url_data["name"], service_url_data["url"], url_root
+    )
+    return await pi.get_locations({"datasetId": args["datasetId"]})
+
+
+async def timeseries(args, url_root):
+    """
+    Timeseries query
+    """
+    args = validate_args(args, ["datasetId", "locationId"])
+    input = {
+        key: args[key]
+        for key in ("datasetId", "locationId", "startTime", "endTime")
+        if key in args
+    }
+    service_url_data = get_service_url(input["datasetId"], "dataService")
+    data_url, observation_type_id, protocol = (
+        service_url_data["url"],
+        service_url_data["name"],
+        service_url_data["protocol"],
+    )
+
+    if protocol == "dd-api":
+        pi = providers_async.AsyncPiServiceDDL(observation_type_id, data_url, url_root)
+        content = await pi.get_timeseries(input)
+
+    # Shoreline lookups are local file reads after the first download
+    elif protocol == "dd-api-shoreline":
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(
+            None,
+            partial(
+                dd_shoreline,
+                data_url,
+                input["locationId"],
+                observation_type_id,
+                input["datasetId"],
+                cache=shoreline_cache,
+            ),
+        )
+
+    elif protocol == "staticimage":
+        content = data_url.format(**input)
+
+    else:
+        raise HTTPError(500, "Internal Server Error", "Unknown protocol in configuration.")
+
+    return content
+
+
+ROUTES = {
+    "/datasets": (datasets, ("GET",)),
+    "/locations": (locations, ("GET", "POST")),
+    "/timeseries": (timeseries, ("GET", "POST")),
+}
+
+
+async def request_args(scope, receive):
+    """
+    Get the request arguments from the query string and a json or form body
+    """
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    if scope["method"] != "POST":
+        return args
+
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+
+    content_type = dict(scope.get("headers", [])).get(b"content-type", b"")
+    if body and content_type.startswith(b"application/json"):
+        args.update(json.loads(body.decode("utf-8")))
+    elif body and content_type.startswith(b"application/x-www-form-urlencoded"):
+        args.update(parse_qsl(body.decode("latin-1")))
+    return args
+
+
+def url_root(scope):
+    headers = dict(scope.get("headers", []))
+    host = headers.get(b"host", b"localhost").decode("latin-1")
+    return "{}://{}{}/".format(scope.get("scheme", "http"), host, scope.get("root_path", ""))
+
+
+async def send_json(send, status, content):
+    body = json.dumps(content).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"access-control-allow-origin", b"*"),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await providers_async.close_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application."""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    try:
+        if path not in ROUTES:
+            raise HTTPError(404, "Not Found", "The requested URL was not found on the server.")
+        handler, methods = ROUTES[path]
+        if scope["method"] not in methods:
+            raise HTTPError(405, "Method Not Allowed", "The method is not allowed for the requested URL.")
+
+        args = await request_args(scope, receive)
+        status, content = 200, await handler(args, url_root(scope))
+
+    except HTTPError as e:
+        status, content = e.code, {"code": e.code, "name": e.name, "description": e.description}
+    except providers_async.UpstreamError as e:
+        status, content = 502, {"code": 502, "name": "Bad Gateway", "description": str(e)}
+    except Exception as e:
+        logging.exception("Unexpected error")
+        status = 500
+        content = {
+            "success": False,
+            "error": {"type": "UnexpectedException", "message": str(e)},
+        }
+
+    await send_json(send, status, content)
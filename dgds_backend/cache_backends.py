@@ -0,0 +1,157 @@
+"""
+Flask-Caching backends with hit/miss statistics.
+
+Use a full import path as CACHE_TYPE, e.g. `dgds_backend.cache_backends.filesystem`.
+The filesystem and redis backends are shared by all uwsgi workers on a node (put
+CACHE_DIR on a tmpfs such as /dev/shm to keep it in memory). Statistics are
+counted per worker process.
+"""
+import pickle
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, add is not atomic there
+    fcntl = None
+
+from flask_caching.backends.filesystem import FileSystemCache
+from flask_caching.backends.rediscache import RedisCache
+from flask_caching.backends.simple import SimpleCache
+
+
+class CacheStatsMixin:
+    """
+    Count cache hits and misses and reject values larger than `max_value_size` bytes.
+    Lookups done by Flask-Caching itself through `get_many` (memoize versions) are not counted.
+    """
+
+    def __init__(self, *args, max_value_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_value_size = max_value_size
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "rejected": 0}
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _count(self, name):
+        if getattr(self._local, "uncounted", False):
+            return
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """
+        Get cache statistics of this process
+        :return: dict with hits, misses, sets and rejected (too large) values
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def get(self, key):
+        value = super().get(key)
+        self._count("misses" if value is None else "hits")
+        return value
+
+    def get_many(self, *keys):
+        self._local.uncounted = True
+        try:
+            return super().get_many(*keys)
+        finally:
+            self._local.uncounted = False
+
+    def set(self, key, value, timeout=None, **kwargs):
+        if self.max_value_size is not None:
+            if len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) > self.max_value_size:
+                self._count("rejected")
+                return False
+        self._count("sets")
+        return super().set(key, value, timeout, **kwargs)
+
+
+class StatsSimpleCache(CacheStatsMixin, SimpleCache):
+    """Per process memory cache."""
+
+
+class SharedFileSystemCache(CacheStatsMixin, FileSystemCache):
+    """File backed cache shared by all processes using the same directory."""
+
+    def get(self, key):
+        # the file count management element is not a cache lookup
+        if key == self._fs_count_file:
+            return FileSystemCache.get(self, key)
+        return super().get(key)
+
+    def set(self, key, value, timeout=None, mgmt_element=False):
+        if mgmt_element:
+            return FileSystemCache.set(self, key, value, timeout, mgmt_element=True)
+        return super().set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        """
+        Add a value unless the key exists and has not expired. FileSystemCache.add
+        only checks whether the file exists, so an expired entry (e.g. the lease of
+        a recycled worker) is never replaced. The check and write are serialized
+        between processes with a lock file next to the entry.
+        """
+        if fcntl is None:
+            if FileSystemCache.has(self, key):
+                return False
+            return self.set(key, value, timeout)
+
+        # the transaction suffix keeps the lock file out of pruning and clear()
+        lock_filename = self._get_filename(key) + ".lock" + self._fs_transaction_suffix
+        with open(lock_filename, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if FileSystemCache.has(self, key):
+                return False
+            return self.set(key, value, timeout)
+
+
+class SharedRedisCache(CacheStatsMixin, RedisCache):
+    """
+    Redis cache shared by all processes (and nodes) using the same server.
+    Any client with the redis-py API can be given as host, which allows for a local stand-in.
+    """
+
+
+def _stats_kwargs(config, kwargs):
+    kwargs.update(
+        dict(
+            ignore_errors=config["CACHE_IGNORE_ERRORS"],
+            max_value_size=config.get("CACHE_MAX_VALUE_SIZE"),
+        )
+    )
+    return kwargs
+
+
+def simple(app, config, args, kwargs):
+    kwargs = _stats_kwargs(config, kwargs)
+    kwargs["threshold"] = config["CACHE_THRESHOLD"]
+    return StatsSimpleCache(*args, **kwargs)
+
+
+def filesystem(app, config, args, kwargs):
+    args.insert(0, config["CACHE_DIR"])
+    kwargs = _stats_kwargs(config, kwargs)
+    kwargs["threshold"] = config["CACHE_THRESHOLD"]
+    return SharedFileSystemCache(*args, **kwargs)
+
+
+def redis(app, config, args, kwargs):
+    kwargs.update(
+        dict(
+            host=config.get("CACHE_REDIS_HOST", "localhost"),
+            port=config.get("CACHE_REDIS_PORT", 6379),
+            password=config.get("CACHE_REDIS_PASSWORD"),
+            db=config.get("CACHE_REDIS_DB", 0),
+            key_prefix=config.get("CACHE_KEY_PREFIX"),
+            max_value_size=config.get("CACHE_MAX_VALUE_SIZE"),
+        )
+    )
+    redis_url = config.get("CACHE_REDIS_URL")
+    if redis_url:
+        try:
+            from redis import from_url as redis_from_url
+        except ImportError:
+            raise RuntimeError("no redis module found")
+        kwargs["host"] = redis_from_url(redis_url, db=kwargs.pop("db"))
+    return SharedRedisCache(*args, **kwargs)
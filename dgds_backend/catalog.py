@@ -0,0 +1,169 @@
+"""Dataset catalog that is rebuilt in the background (stale-while-revalidate)."""
+import functools
+import logging
+import os
+import threading
+import time
+import weakref
+
+
+def _after_fork(ref):
+    refresher = ref()
+    if refresher is not None:
+        refresher._reset()
+
+
+class CatalogRefresher:
+    """
+    Serve the last good catalog while a single background job rebuilds it.
+
+    The rebuild is scheduled `refresh_ahead` seconds before the catalog expires,
+    and the new catalog is swapped in atomically. A failed or incomplete rebuild
+    never evicts the catalog being served, it is retried after `retry_interval`.
+
+    With a shared `store` (a cache with get/set/add/delete) the catalog is shared
+    between processes and only the process holding the rebuild lease rebuilds it.
+    The lease of a process that dies during a rebuild expires after `lease`
+    seconds, so the store must replace expired keys in `add`.
+    """
+
+    def __init__(self, build, timeout, refresh_ahead, retry_interval, store=None, key="catalog", lease=60):
+        """
+        :param build: callable(previous_catalog) returning (catalog, complete)
+        :param timeout: seconds before a catalog expires
+        :param refresh_ahead: seconds before expiry to start the rebuild
+        :param retry_interval: seconds before retrying a failed rebuild
+        :param store: optional cache shared between processes
+        :param key: cache key of the catalog in the store
+        :param lease: seconds a process may hold the rebuild lease
+        """
+        self.build = build
+        self.timeout = timeout
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self.store = store
+        self.key = key
+        self.lease = lease
+
+        self._state = None  # (catalog, built_at, refresh due at), only replaced as a whole
+        self._reset()
+
+        # the app is preloaded in the uwsgi master, a refresh in flight at fork
+        # time would leave the workers with a held lock and a stuck running flag
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=functools.partial(_after_fork, weakref.ref(self)))
+
+    def _reset(self):
+        """Reset the refresh state, the threads using it do not survive a fork."""
+        self._build_lock = threading.Lock()  # one build at a time
+        self._lock = threading.Lock()  # guards the timer and running flag
+        self._timer = None
+        self._running = False
+
+    def _load(self):
+        if self.store is not None:
+            state = self.store.get(self.key)
+            # catalogs stored without their refresh due time are rebuilt
+            if state is not None and len(state) == 3:
+                self._state = state
+        return self._state
+
+    def _save(self, catalog, complete):
+        # a degraded catalog is served until its rebuild is retried
+        now = time.time()
+        delay = self.timeout - self.refresh_ahead if complete else self.retry_interval
+        self._state = (catalog, now, now + delay)
+        if self.store is not None:
+            # never expires, it's replaced by the next rebuild
+            self.store.set(self.key, self._state, timeout=0)
+            self.store.set(self.key + "_version", self._state[1], timeout=0)
+
+    @staticmethod
+    def _due(state):
+        return state[2]
+
+    def get(self):
+        """
+        Get the current catalog. Only the very first call builds it on the
+        request path, all others are served from the last good catalog.
+        :return: catalog
+        """
+        state = self._load()
+        if state is None:
+            with self._build_lock:
+                state = self._load()
+                if state is None:
+                    catalog, complete = self.build(None)
+                    self._save(catalog, complete)
+                    state = self._state
+
+        # (re)start the refresh timer, threads do not survive a worker fork
+        self.schedule(max(self._due(state) - time.time(), 0))
+
+        return state[0]
+
+    def version(self):
+        """
+        Version of the current catalog, without loading it from the store
+        :return: build time of the catalog, None before the first build
+        """
+        if self.store is not None:
+            return self.store.get(self.key + "_version")
+        state = self._state
+        return state[1] if state is not None else None
+
+    def schedule(self, delay):
+        """
+        Schedule a background rebuild in `delay` seconds, unless one is already
+        scheduled or running.
+        :param delay: seconds
+        """
+        with self._lock:
+            if self._running or (self._timer is not None and self._timer.is_alive()):
+                return
+            self._timer = threading.Timer(delay, self._scheduled_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _scheduled_refresh(self):
+        with self._lock:
+            self._running = True
+
+        delay = self.retry_interval
+        try:
+            state = self._load()
+            if state is not None and self._due(state) > time.time():
+                # another process already rebuilt the catalog
+                delay = self._due(state) - time.time()
+            elif self.store is None or self.store.add(self.key + "_lease", os.getpid(), timeout=self.lease):
+                try:
+                    if self.refresh():
+                        delay = max(self.timeout - self.refresh_ahead, 0)
+                finally:
+                    if self.store is not None:
+                        self.store.delete(self.key + "_lease")
+        finally:
+            with self._lock:
+                self._running = False
+                self._timer = None
+
+        self.schedule(delay)
+
+    def refresh(self):
+        """
+        Rebuild the catalog and swap it in.
+        :return: True when the catalog was rebuilt without degraded datasets
+        """
+        try:
+            with self._build_lock:
+                state = self._load()
+                previous = state[0] if state is not None else None
+                catalog, complete = self.build(previous)
+                self._save(catalog, complete)
+        except Exception:
+            logging.exception("Failed to refresh the dataset catalog, keeping the previous one")
+            return False
+
+        if not complete:
+            logging.warning("Dataset catalog refreshed with degraded datasets")
+        return complete
@@ -0,0 +1,145 @@
+"""Negotiated response compression, strong ETags and conditional GET (304) handling."""
+import functools
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response, g, request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+class CompressedResponses:
+    """
+    Compress JSON responses with gzip or brotli (as accepted by the client) and
+    tag them with a strong ETag. Requests with a matching If-None-Match header
+    get an empty 304 response.
+
+    Views decorated with `conditional` derive the ETag from the version of their
+    cached content and answer a matching If-None-Match before they render. The
+    ETag of other views is a hash of the rendered body.
+
+    Compressed bodies are kept in a small LRU cache by ETag, so repeated polls of
+    unchanged (cached) content are not compressed again.
+    """
+
+    def __init__(self, app=None):
+        self._compressed = OrderedDict()  # (etag, encoding): compressed body
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        self.level = app.config["COMPRESS_LEVEL"]
+        self.cache_size = app.config["COMPRESS_CACHE_SIZE"]
+        app.after_request(self.after_request)
+
+    def encodings(self):
+        return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def compress(self, data, encoding):
+        if encoding == "br":
+            return brotli.compress(data, quality=self.level)
+        return gzip.compress(data, compresslevel=self.level)
+
+    def get_compressed(self, data, etag, encoding):
+        key = (etag, encoding)
+        with self._lock:
+            if key in self._compressed:
+                self._compressed.move_to_end(key)
+                return self._compressed[key]
+
+        compressed = self.compress(data, encoding)
+
+        with self._lock:
+            self._compressed[key] = compressed
+            while len(self._compressed) > self.cache_size:
+                self._compressed.popitem(last=False)
+        return compressed
+
+    def conditional(self, version):
+        """
+        Decorate a view whose content has a cheap version, e.g. of a cache entry
+        :param version: callable with the view arguments, returning the version
+            of the content or None when unknown
+        :return: decorator
+        """
+
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if request.method in ("GET", "HEAD"):
+                    value = version(*args, **kwargs)
+                    if value is not None:
+                        g.etag = hashlib.sha1(
+                            "{}:{}".format(request.path, value).encode()
+                        ).hexdigest()
+                        response = self.not_modified(g.etag)
+                        if response is not None:
+                            return response
+                return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def not_modified(self, etag):
+        """
+        304 response when If-None-Match has the ETag of a representation of the content
+        :param etag: ETag of the content, without encoding
+        :return: response or None
+        """
+        # the size, and so the encoding, is unknown before rendering
+        candidates = [etag]
+        encoding = request.accept_encodings.best_match(self.encodings())
+        if encoding is not None:
+            candidates.append("{}-{}".format(etag, encoding))
+
+        for candidate in candidates:
+            if request.if_none_match.contains(candidate):
+                response = Response(status=304)
+                response.set_etag(candidate)
+                response.vary.add("Accept-Encoding")
+                return response
+        return None
+
+    def after_request(self, response):
+        if (
+            request.method not in ("GET", "HEAD")
+            or response.status_code != 200
+            or response.mimetype != "application/json"
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+
+        data = response.get_data()
+        etag = g.get("etag") or hashlib.sha1(data).hexdigest()
+        response.vary.add("Accept-Encoding")
+
+        encoding = None
+        if len(data) >= self.min_size:
+            encoding = request.accept_encodings.best_match(self.encodings())
+
+        # a strong ETag differs per encoding of the same content
+        if encoding is not None:
+            etag = "{}-{}".format(etag, encoding)
+        response.set_etag(etag)
+
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            response.set_data(b"")
+            del response.headers["Content-Length"]
+            return response
+
+        if encoding is not None:
+            response.set_data(self.get_compressed(data, etag, encoding))
+            response.headers["Content-Encoding"] = encoding
+
+        return response
@@ -1,3 +1,72 @@
 DEBUG = False  # make sure DEBUG is off unless enabled explicitly otherwise
 LOG_DIR = '.'  # create log files in current working directory
 APPLICATION_ROOT = '/api'
+
+# /datasets resolves the upstream urls of all datasets concurrently
+DATASETS_MAX_WORKERS = 8  # size of the worker pool used per catalog build
+DATASETS_TIMEOUT = 10  # seconds, datasets not resolved by then are marked degraded
+
+# /datasets refresh mode, either 'background' to keep serving the last good
+# catalog while it is rebuilt ahead of expiry, or 'request' to rebuild it on
+# the first request after expiry
+DATASETS_REFRESH = 'background'
+DATASETS_REFRESH_TIMEOUT = 6 * 60 * 60  # seconds, GLOSSIS produces new files every 6 hours
+DATASETS_REFRESH_AHEAD = 15 * 60  # seconds before expiry to start the rebuild
+DATASETS_REFRESH_RETRY = 5 * 60  # seconds before retrying a failed rebuild
+
+# FEWS capabilities are fetched again at the start of every catalog refresh,
+# lookups in between (e.g. /datasets/<id>/<image>) reuse them until this timeout
+FEWS_CAPABILITIES_TIMEOUT = None  # seconds, None for DATASETS_REFRESH_TIMEOUT
+
+# Cache backend, see dgds_backend.cache_backends. Use the filesystem (or redis)
+# backend to share the catalog and dataset lookups between uwsgi workers.
+CACHE_TYPE = 'dgds_backend.cache_backends.simple'
+CACHE_DIR = None  # directory of the filesystem backend, e.g. on /dev/shm
+CACHE_THRESHOLD = 500  # maximum number of cached items
+CACHE_MAX_VALUE_SIZE = 10 * 1024 * 1024  # bytes, larger values are not cached
+
+# Upstream connection pools (DD-API, FEWS, hydroengine, shoreline)
+UPSTREAM_POOL_SIZE = 10  # connections kept alive per host
+UPSTREAM_POOL_SIZES = {}  # pool size per host, overrides UPSTREAM_POOL_SIZE
+UPSTREAM_CONNECT_TIMEOUT = 5  # seconds
+UPSTREAM_READ_TIMEOUT = 30  # seconds
+UPSTREAM_REQUEST_DEADLINE = 60  # seconds for all upstream requests of an incoming request
+UPSTREAM_BREAKER_FAILURES = 5  # consecutive failures that open the circuit breaker of a host
+UPSTREAM_BREAKER_RESET = 30  # seconds the breaker stays open before a trial request
+UPSTREAM_NEGATIVE_TTL = 10  # seconds a failed GET is answered from the negative cache
+
+# Hedged DD-API requests, a duplicate is sent when no response arrived within
+# a percentile of the recent latency of the host
+UPSTREAM_HEDGE = False
+UPSTREAM_HEDGE_PERCENTILE = 95
+UPSTREAM_HEDGE_MIN_SAMPLES = 20  # latencies needed before hedging a host
+UPSTREAM_HEDGE_BUDGET = 0.05  # maximum fraction of requests that are duplicated
+
+# Local cache of shoreline box files, indexed by transect_id
+SHORELINE_CACHE_DIR = 'shoreline_cache'  # relative to the current working directory
+SHORELINE_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # seconds, box files are effectively static
+
+# /timeseries and /locations responses are cached per forecast cycle, unless
+# a dataset sets its own "refreshInterval" (seconds) in its dataService
+TIMESERIES_CACHE_CYCLE = 6 * 60 * 60  # seconds
+
+# /timeseries?autoPaging=true follows the DD-API pages, streaming a single response
+TIMESERIES_AUTOPAGING_MAX_PAGES = 1000
+
+# /timeseries/batch, every datasetId and locationId combination is fetched concurrently
+TIMESERIES_BATCH_MAX_ITEMS = 200  # maximum number of timeseries in one request
+TIMESERIES_BATCH_MAX_WORKERS = 8  # concurrent upstream requests per batch
+
+# Compression of JSON responses (gzip, or brotli when installed)
+COMPRESS_MIN_SIZE = 500  # bytes, smaller responses are sent uncompressed
+COMPRESS_LEVEL = 6  # gzip level (1-9) or brotli quality (0-11)
+COMPRESS_CACHE_SIZE = 64  # number of compressed responses kept by ETag
+
+# Sampling profiler, writes collapsed stacks (flamegraph.pl input) per profiled request.
+# Off unless a sample rate or token is set, the token (X-Profile-Token header)
+# profiles a single request and is needed to download profiles from /profiles.
+PROFILE_SAMPLE_RATE = 0.0  # fraction of requests to profile
+PROFILE_TOKEN = None  # admin token
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_DIR = 'profiles'  # relative to the current working directory
+PROFILE_KEEP = 100  # number of most recent profiles to keep
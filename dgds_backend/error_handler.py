@@ -5,6 +5,9 @@ import json
 from flask import Blueprint, jsonify, abort
 from webargs.flaskparser import parser
 from werkzeug.exceptions import HTTPException
+from requests.exceptions import RequestException
+
+from dgds_backend.upstream import UpstreamUnavailable
 
 error_handler = Blueprint("errors", __name__)
 
@@ -46,3 +49,15 @@ def handle_exception(e):
     })
     response.content_type = "application/json"
     return response
+
+
+@error_handler.app_errorhandler(RequestException)
+def handle_upstream_error(error):
+    """Upstream failures are reported as 502, or 503 while the upstream is unavailable."""
+    status_code = 503 if isinstance(error, UpstreamUnavailable) else 502
+    response = {
+        "code": status_code,
+        "name": "Service Unavailable" if status_code == 503 else "Bad Gateway",
+        "description": str(error),
+    }
+    return jsonify(response), status_code
@@ -0,0 +1,207 @@
+"""
+Request, upstream and cache metrics in the Prometheus text exposition format.
+
+Metrics are kept per process, in plain dicts guarded by a lock, so recording a
+value costs a dictionary update. With several uwsgi workers each worker reports
+its own values, scrape them per worker or aggregate them in Prometheus.
+"""
+import bisect
+import threading
+import time
+
+from flask import g, request
+
+# seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    labels = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: metric name
+        :param help: description
+        :param labels: label names
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values: value
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return ["{}{} {}".format(self.name, format_labels(self.labels, label_values), value)]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # bucket counts (the last one is +Inf), sum
+                counts = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render_value(self, label_values, value):
+        bucket_counts, total = value[0][:], value[1]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), bucket_counts):
+            cumulative += count
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.labels + ("le",), label_values + (bound,)),
+                    cumulative,
+                )
+            )
+        labels = format_labels(self.labels, label_values)
+        lines.append("{}_sum{} {}".format(self.name, labels, total))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+REQUESTS = Counter(
+    "dgds_requests_total", "Requests handled, per route, method and status.",
+    ("route", "method", "status"),
+)
+REQUEST_LATENCY = Histogram(
+    "dgds_request_duration_seconds", "Request handling time until the response headers, per route.",
+    ("route",),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "dgds_requests_in_flight", "Requests being handled.",
+)
+UPSTREAM_LATENCY = Histogram(
+    "dgds_upstream_duration_seconds", "Upstream request time, per protocol.",
+    ("protocol",),
+)
+UPSTREAM_ERRORS = Counter(
+    "dgds_upstream_errors_total",
+    "Failed upstream requests, per protocol and kind (timeout, connection, status, unavailable).",
+    ("protocol", "kind"),
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "dgds_upstream_requests_in_flight", "Upstream requests in flight, per protocol.",
+    ("protocol",),
+)
+
+METRICS = [
+    REQUESTS,
+    REQUEST_LATENCY,
+    REQUESTS_IN_FLIGHT,
+    UPSTREAM_LATENCY,
+    UPSTREAM_ERRORS,
+    UPSTREAM_IN_FLIGHT,
+]
+
+# callables returning metrics built at scrape time, from statistics kept elsewhere
+COLLECTORS = []
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text format
+    :return: str
+    """
+    metrics = list(METRICS)
+    for collector in COLLECTORS:
+        metrics.extend(collector())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """Record the count, latency and in-flight requests of the Flask routes."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        g.metrics_start = time.time()
+        REQUESTS_IN_FLIGHT.inc()
+
+    def route(self):
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    def after_request(self, response):
+        if "metrics_start" in g:
+            self.observe(response.status_code)
+        return response
+
+    def teardown_request(self, exception=None):
+        if "metrics_start" not in g:
+            return
+        # after_request is skipped for unhandled exceptions
+        if not g.get("metrics_observed", False):
+            self.observe(500)
+        REQUESTS_IN_FLIGHT.dec()
+
+    def observe(self, status):
+        route = self.route()
+        REQUESTS.inc(route, request.method, status)
+        REQUEST_LATENCY.observe(route, value=time.time() - g.metrics_start)
+        g.metrics_observed = True
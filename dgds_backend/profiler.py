@@ -0,0 +1,157 @@
+"""
+On-demand sampling profiler for live requests.
+
+A profiled request gets a sampler thread that records the stack of the request
+thread every PROFILE_INTERVAL seconds. The samples are written as collapsed
+stacks (one "frame;frame;frame count" line per stack), the input format of
+flamegraph.pl and speedscope.
+
+Requests are profiled at PROFILE_SAMPLE_RATE, or when they carry the
+PROFILE_TOKEN in the X-Profile-Token header. With neither set no hooks or
+routes are registered at all.
+"""
+import hmac
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from flask import abort, g, request, send_from_directory, jsonify
+
+TOKEN_HEADER = "X-Profile-Token"
+
+
+def frame_name(frame):
+    code = frame.f_code
+    filename = "/".join(Path(code.co_filename).parts[-2:])
+    return "{} ({})".format(code.co_name, filename)
+
+
+def collapse(frame):
+    """
+    Collapse a stack into a single line, outermost frame first
+    :param frame: innermost frame
+    :return: str
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of a thread at a fixed interval."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profiler-{}".format(thread_id), daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.stacks
+
+
+class RequestProfiler:
+    """
+    Profile sampled or requested (admin header) requests, and serve the profiles
+    at /profiles (listing) and /profiles/<name> (collapsed stacks download).
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.sample_rate = app.config["PROFILE_SAMPLE_RATE"]
+        self.token = app.config["PROFILE_TOKEN"]
+        self.interval = app.config["PROFILE_INTERVAL"]
+        self.keep = app.config["PROFILE_KEEP"]
+        self.profile_dir = Path(app.config["PROFILE_DIR"])
+
+        # zero overhead when off, nothing is registered
+        if not self.sample_rate and not self.token:
+            return
+
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule("/profiles", "profiles", self.list_profiles)
+        app.add_url_rule("/profiles/<string:name>", "profile", self.get_profile)
+
+    def has_token(self):
+        header = request.headers.get(TOKEN_HEADER)
+        return bool(self.token) and header is not None and hmac.compare_digest(header, self.token)
+
+    def before_request(self):
+        if request.endpoint in ("profiles", "profile"):
+            return
+        if not self.has_token() and random.random() >= self.sample_rate:
+            return
+
+        sampler = Sampler(threading.get_ident(), self.interval)
+        g.profile = (sampler, time.time(), time.thread_time())
+        sampler.start()
+
+    def teardown_request(self, exception=None):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+
+        sampler, wall_start, cpu_start = profile
+        stacks = sampler.stop()
+        wall = time.time() - wall_start
+        cpu = time.thread_time() - cpu_start
+        try:
+            self.save(stacks, wall, cpu)
+        except OSError as e:
+            logging.error("Could not save profile: {}".format(e))
+
+    def save(self, stacks, wall, cpu):
+        """
+        Write the collapsed stacks of a request, the file name holds the route,
+        wall-clock and cpu time in milliseconds of the request thread
+        """
+        route = request.path.strip("/").replace("/", "_") or "root"
+        name = "{}_{}_wall{}_cpu{}.collapsed".format(
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S%f"),
+            route,
+            int(wall * 1000),
+            int(cpu * 1000),
+        )
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        with open(str(self.profile_dir / name), "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+        # keep the most recent profiles
+        for old in sorted(self.profile_dir.glob("*.collapsed"))[: -self.keep]:
+            old.unlink()
+
+    def check_token(self):
+        if not self.has_token():
+            abort(403, "Profiles require the {} header.".format(TOKEN_HEADER))
+
+    def list_profiles(self):
+        self.check_token()
+        names = sorted(path.name for path in self.profile_dir.glob("*.collapsed"))
+        return jsonify({"profiles": names[::-1]})
+
+    def get_profile(self, name):
+        self.check_token()
+        return send_from_directory(
+            str(self.profile_dir.resolve()), name, mimetype="text/plain", as_attachment=True
+        )
@@ -0,0 +1,174 @@
+"""
+Non-blocking implementations of the upstream providers, used by the ASGI entry
+point (dgds_backend.asgi). Requests and responses are built and parsed by the
+same functions as the synchronous providers.
+
+Requires httpx, install with `pip install dgds_backend[async]`.
+"""
+import asyncio
+import logging
+import weakref
+
+try:
+    import httpx
+except ImportError:  # only needed for the ASGI entry point
+    httpx = None
+
+from dgds_backend import providers_datasets, upstream
+from dgds_backend.providers_timeseries import PiServiceDDL
+
+# asyncio objects are bound to the event loop they are created in
+_clients = weakref.WeakKeyDictionary()  # event loop: httpx.AsyncClient
+_locks = weakref.WeakKeyDictionary()  # event loop: {(name, key): asyncio lock}
+
+
+class UpstreamError(Exception):
+    """An upstream service could not be reached or returned an error."""
+
+
+def get_client():
+    """
+    Get the async http client of the running event loop, pooled and with the
+    upstream timeouts
+    :return: httpx.AsyncClient
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        if httpx is None:
+            raise RuntimeError("The async providers need httpx, install dgds_backend[async]")
+        client = _clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                upstream.CONFIG["UPSTREAM_READ_TIMEOUT"],
+                connect=upstream.CONFIG["UPSTREAM_CONNECT_TIMEOUT"],
+            ),
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=upstream.CONFIG["UPSTREAM_POOL_SIZE"],
+            ),
+        )
+    return client
+
+
+def get_lock(name, key):
+    """
+    Get the lock of a key in the running event loop
+    :param name: kind of lock, e.g. fews or flowmap
+    :param key: key within its kind
+    :return: asyncio.Lock
+    """
+    locks = _locks.setdefault(asyncio.get_running_loop(), {})
+    lock = locks.get((name, key))
+    if lock is None:
+        lock = locks[(name, key)] = asyncio.Lock()
+    return lock
+
+
+async def close_client():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class AsyncPiServiceDDL(PiServiceDDL):
+    async def make_request(self, data, ddl_url, url_path):
+        """
+        Make request to the PiServiceDDL
+        :param data:
+        :param ddl_url:
+        :param url_path:
+        :return:
+        """
+        dataset_id, data = self.request_params(data, url_path)
+
+        # Query / Response
+        try:
+            resp = await get_client().get(ddl_url, params=data)
+        except httpx.HTTPError as e:
+            raise UpstreamError("Failed to fetch from the DD-API/{}".format(url_path)) from e
+        if resp.status_code != 200:
+            raise UpstreamError("Failed to fetch from the DD-API/{}".format(url_path))
+
+        return self.process_response(resp.json(), ddl_url, url_path, dataset_id)
+
+    async def get_locations(self, data):
+        return await self.make_request(data, self.locations_url, "locations")
+
+    async def get_timeseries(self, data):
+        return await self.make_request(data, self.timeseries_url, "timeseries")
+
+
+async def get_hydroengine_url(id, layer_name, access_url, feature_url, parameters, image_id=None):
+    """
+    Get hydroengine url and other info
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :return: url
+    """
+    post_data = providers_datasets.hydroengine_post_data(layer_name, parameters, image_id)
+    resp = await get_client().post(access_url, json=post_data)
+
+    return providers_datasets.hydroengine_data(id, feature_url, resp)
+
+
+async def get_fews_layers(access_url):
+    """
+    Get the layers of a FEWS Pi WMS, fetched once per access_url per refresh cycle
+    :param access_url: url of the FEWS capabilities
+    :return: dict of layer name: layer, None when the capabilities could not be fetched
+    """
+    async with get_lock("fews", access_url):
+        layers = providers_datasets.cached_fews_layers(access_url)
+        if layers is None:
+            resp = await get_client().get(access_url)
+            layers = providers_datasets.parse_fews_layers(access_url, resp)
+
+    return layers
+
+
+async def get_fews_url(id, layer_name, access_url, feature_url, parameters):
+    """
+    Get FEWS Pi WMS url by filling in template with latest time
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :return: url
+    """
+    layers = await get_fews_layers(access_url)
+
+    return providers_datasets.fews_data(id, layer_name, feature_url, parameters, layers)
+
+
+async def list_google_storage_prefixes(bucket, folder, start_offset=None):
+    """
+    List the sub folders of a folder in a public bucket, with the storage JSON API
+    :return: list of prefixes, None when the bucket could not be listed
+    """
+    params = providers_datasets.google_storage_list_params(folder, start_offset)
+    list_url = providers_datasets.GOOGLE_STORAGE_LIST_URL.format(bucket=bucket)
+
+    prefixes = []
+    while True:
+        resp = await get_client().get(list_url, params=params)
+        if resp.status_code != 200:
+            logging.error("Bucket {} not listed. Error {}".format(bucket, resp.status_code))
+            return None
+
+        page = resp.json()
+        prefixes.extend(page.get("prefixes", []))
+        if not page.get("nextPageToken"):
+            return prefixes
+        params["pageToken"] = page["nextPageToken"]
+
+
+async def get_google_storage_url(id, layer_name, access_url, parameters, start_time=None, end_time=None, frames=None):
+    """
+    Get google storage flowmap urls and dates
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :return: url
+    """
+    bucket, folder = providers_datasets.split_bucket_folder(access_url)
+    key, index = providers_datasets.flowmap_index(bucket, folder, parameters)
+    async with get_lock("flowmap", key):
+        start_offset = max(index["prefixes"]) if index["prefixes"] else None
+        prefixes = await list_google_storage_prefixes(bucket, folder, start_offset) or []
+        url_date_list = providers_datasets.update_flowmap_index(index, bucket, prefixes, parameters)
+
+    return providers_datasets.flowmap_data(id, access_url, url_date_list, start_time, end_time, frames)
@@ -1,12 +1,12 @@
 import logging
 import json
-import requests
+import threading
+import time
 from os.path import dirname, realpath
 from pathlib import Path
 from datetime import datetime
-from google.cloud import storage
 
-from dgds_backend import error_handler
+from dgds_backend import error_handler, upstream
 
 
 # Load general settings
@@ -28,6 +28,83 @@ except FileNotFoundError as e:
     exit(-1)  # vital config needed
 
 
+# Supported protocols per service, "" for datasets without the service
+PROTOCOLS = {
+    "dataService": {"", "dd-api", "dd-api-shoreline", "staticimage"},
+    "rasterService": {"", "fewsWms", "hydroengine"},
+    "flowmapService": {"", "googlestorage"},
+}
+REQUIRED_PARAMETERS = {
+    "fewsWms": ["urlTemplate"],
+    "googlestorage": ["time_template", "tile_template"],
+}
+
+
+def validate_datasets(datasets):
+    """
+    Validate the dataset configuration
+    :param datasets: dict with info (datasets.json) and access (datasets_access.json)
+    :return: list of errors
+    """
+    errors = []
+    for datasetinfo in datasets["info"]["datasets"]:
+        if datasetinfo["id"] not in datasets["access"]:
+            errors.append("Dataset id {} has no access configuration".format(datasetinfo["id"]))
+
+    for id, access in datasets["access"].items():
+        for service_type, service in access.items():
+            if service_type not in PROTOCOLS:
+                continue
+            protocol = service.get("protocol")
+            if protocol not in PROTOCOLS[service_type]:
+                errors.append("Dataset id {} {} has unknown protocol {}".format(id, service_type, protocol))
+                continue
+            if protocol and not service.get("url"):
+                errors.append("Dataset id {} {} has no url".format(id, service_type))
+            for parameter in REQUIRED_PARAMETERS.get(protocol, []):
+                if parameter not in service.get("parameters", {}):
+                    errors.append("Dataset id {} {} misses parameter {}".format(id, service_type, parameter))
+
+    return errors
+
+
+# Validate once on import, before the (uwsgi) workers are forked
+_errors = validate_datasets(DATASETS)
+if _errors:
+    for error in _errors:
+        logging.error(error)
+    exit(-1)  # vital config needed
+
+
+# Flowmap tilesets in public google storage buckets, indexed per bucket folder
+GOOGLE_STORAGE_URL = "https://storage.googleapis.com/"
+GOOGLE_STORAGE_LIST_URL = "https://storage.googleapis.com/storage/v1/b/{bucket}/o"
+_flowmap_indexes = {}  # (bucket, folder, templates): {"prefixes": set, "frames": list}
+_flowmap_locks = {}  # (bucket, folder, templates): lock
+
+# Defaults, overridden with the application settings by configure()
+CONFIG = {
+    "FEWS_CAPABILITIES_TIMEOUT": 6 * 60 * 60,  # seconds, the catalog refresh cycle
+}
+
+# FEWS capabilities are shared by all FEWS datasets, they are fetched once
+# per access_url per refresh cycle (or when older than FEWS_CAPABILITIES_TIMEOUT)
+_fews_capabilities = {}  # access_url: (fetched at, {layer name: layer})
+_fews_locks = {}  # access_url: lock
+
+
+def configure(config):
+    """
+    Configure the dataset providers
+    :param config: application config
+    """
+    timeout = config.get("FEWS_CAPABILITIES_TIMEOUT")
+    if timeout is None:
+        # the capabilities are shared for a catalog refresh cycle
+        timeout = config.get("DATASETS_REFRESH_TIMEOUT", CONFIG["FEWS_CAPABILITIES_TIMEOUT"])
+    CONFIG["FEWS_CAPABILITIES_TIMEOUT"] = timeout
+
+
 # Get the associated service url to a dataset inside the params dict
 def get_service_url(datasetId, serviceType):
     """
@@ -40,23 +117,33 @@ def get_service_url(datasetId, serviceType):
     return service_url_data
 
 
-def get_hydroengine_url(id, layer_name, access_url, feature_url, parameters, image_id=None):
+def hydroengine_post_data(layer_name, parameters, image_id=None):
     """
-    Get hydroengine url and other info
-    :param id: dataset id, as defined in datasets.json and datasets_access.json
-    :return: url
+    Build the hydroengine request
+    :param layer_name: hydroengine dataset
+    :param parameters: additional parameters
+    :param image_id: optional image id
+    :return: dict to post as json
     """
-
-    data = {
-        "featureInfoUrl": feature_url
-    }
-
     post_data = {
         "dataset": layer_name,
         "imageId": image_id
     }
     post_data.update(parameters)
-    resp = requests.post(url=access_url, json=post_data)
+    return post_data
+
+
+def hydroengine_data(id, feature_url, resp):
+    """
+    Get the dataset info from a hydroengine response
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :param feature_url: feature info url
+    :param resp: hydroengine response (requests or httpx)
+    :return: dict
+    """
+    data = {
+        "featureInfoUrl": feature_url
+    }
 
     if resp.status_code == 200:
         data.update(json.loads(resp.text))
@@ -70,46 +157,157 @@ def get_hydroengine_url(id, layer_name, access_url, feature_url, parameters, ima
 
     return data
 
-def get_google_storage_url(id, layer_name, access_url, parameters):
+
+def get_hydroengine_url(id, layer_name, access_url, feature_url, parameters, image_id=None):
     """
-    Get google storage flowmap urls and dates
+    Get hydroengine url and other info
     :param id: dataset id, as defined in datasets.json and datasets_access.json
     :return: url
     """
-    data = {}
+    post_data = hydroengine_post_data(layer_name, parameters, image_id)
+    resp = upstream.post(access_url, json=post_data, protocol="hydroengine")
 
-    base_storage_url = 'https://storage.googleapis.com/'
-    bucket_folder = access_url.replace(base_storage_url, '')
-    # split  bucket and folder
+    return hydroengine_data(id, feature_url, resp)
+
+
+def split_bucket_folder(access_url):
+    """
+    Split a public google storage url into bucket and folder
+    :param access_url: url of a folder in a bucket
+    :return: bucket, folder (ending with /)
+    """
+    bucket_folder = access_url.replace(GOOGLE_STORAGE_URL, '')
     bucket, *folders = bucket_folder.split('/')
     folder = '/'.join(folders) + '/'
+    return bucket, folder
+
+
+def google_storage_list_params(folder, start_offset=None):
+    """
+    Parameters to list the sub folders of a folder with the storage JSON API
+    :param folder: folder, ending with /
+    :param start_offset: only list sub folders from this one (inclusive)
+    :return: dict
+    """
+    params = {"prefix": folder, "delimiter": "/", "fields": "prefixes,nextPageToken"}
+    if start_offset is not None:
+        params["startOffset"] = start_offset
+    return params
+
+
+def list_google_storage_prefixes(bucket, folder, start_offset=None):
+    """
+    List the sub folders of a folder in a public bucket, with the storage JSON API
+    :param bucket: bucket name
+    :param folder: folder, ending with /
+    :param start_offset: only list sub folders from this one (inclusive)
+    :return: list of prefixes, None when the bucket could not be listed
+    """
+    params = google_storage_list_params(folder, start_offset)
+
+    prefixes = []
+    while True:
+        resp = upstream.get(
+            GOOGLE_STORAGE_LIST_URL.format(bucket=bucket), params=params, protocol="googlestorage"
+        )
+        if resp.status_code != 200:
+            logging.error("Bucket {} not listed. Error {}".format(bucket, resp.status_code))
+            return None
+
+        page = resp.json()
+        prefixes.extend(page.get("prefixes", []))
+        if not page.get("nextPageToken"):
+            return prefixes
+        params["pageToken"] = page["nextPageToken"]
+
+
+def flowmap_index(bucket, folder, parameters):
+    """
+    Get the flowmap index of a bucket folder
+    :return: key of the index, index dict with prefixes and frames
+    """
+    key = (bucket, folder, parameters["time_template"], parameters["tile_template"])
+    return key, _flowmap_indexes.setdefault(key, {"prefixes": set(), "frames": []})
+
 
-    # use anonymous client (assuming public data)
-    client = storage.Client.create_anonymous_client()
-    # Note: Client.list_blobs requires at least package version 1.17.0.
-    # Version 1.27.0 broken list_blobs.
-    blobs = client.list_blobs(bucket, prefix=folder, delimiter='/')
-    # iterate over all blobs (result not used, but iteration needs to happen before prefixes is defined)
-    list(blobs)
-    #
-    prefixes = blobs.prefixes
-
-    if not len(prefixes):
+def update_flowmap_index(index, bucket, prefixes, parameters):
+    """
+    Add newly listed tileset folders to a flowmap index
+    :param index: index dict with prefixes and frames
+    :param bucket: bucket name
+    :param prefixes: listed folders, may include known ones
+    :param parameters: dict with time_template and tile_template
+    :return: list of dicts with url and date, sorted by date
+    """
+    new_frames = []
+    for prefix in prefixes:
+        if prefix in index["prefixes"]:
+            continue
+        # Get date of flowmap from folder name
+        foldername = prefix.rstrip("/").split("/")[-1]
+        try:
+            date_from_foldername = datetime.strptime(foldername, parameters["time_template"])
+        except ValueError:
+            logging.warning("Flowmap folder {} does not match the time template".format(prefix))
+            continue
+        new_frames.append({
+            "url": GOOGLE_STORAGE_URL + bucket + "/" + prefix + parameters["tile_template"],
+            "date": datetime.strftime(date_from_foldername, "%Y-%m-%dT%H:%M:%S")
+        })
+
+    # replace (not extend) the frames, so returned lists are never modified
+    if new_frames:
+        index["frames"] = sorted(index["frames"] + new_frames, key=lambda frame: frame["date"])
+    index["prefixes"] = index["prefixes"].union(prefixes)
+
+    return index["frames"]
+
+
+def get_flowmap_frames(bucket, folder, parameters):
+    """
+    Get the available flowmap tilesets in a bucket folder, sorted by date. The index
+    is updated incrementally, only folders from the last known one on are listed.
+    :param bucket: bucket name
+    :param folder: folder with a sub folder per tileset, ending with /
+    :param parameters: dict with time_template and tile_template
+    :return: list of dicts with url and date
+    """
+    key, index = flowmap_index(bucket, folder, parameters)
+    with _flowmap_locks.setdefault(key, threading.Lock()):
+        start_offset = max(index["prefixes"]) if index["prefixes"] else None
+        prefixes = list_google_storage_prefixes(bucket, folder, start_offset) or []
+        return update_flowmap_index(index, bucket, prefixes, parameters)
+
+
+def flowmap_data(id, access_url, url_date_list, start_time=None, end_time=None, frames=None):
+    """
+    Get the flowmap info of the tilesets within a time window
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :param access_url: url of the tilesets folder
+    :param url_date_list: available tilesets, sorted by date
+    :param start_time: optional datetime, only return tilesets from this time
+    :param end_time: optional datetime, only return tilesets up to this time
+    :param frames: optional number of (most recent) tilesets to return
+    :return: dict
+    """
+    data = {}
+
+    if not len(url_date_list):
         logging.error(f"Dataset id {id} has no flowmap layers in {access_url}/")
         return data
 
-    url_date_list = []
-    for folder in list(prefixes):
-        # Get date of flowmap from folder name
-        _, _, _, filename, _ = folder.split('/')
-        date_from_foldername = datetime.strptime(filename, parameters['time_template'])
-        datestring = datetime.strftime(date_from_foldername, '%Y-%m-%dT%H:%M:%S')
-        url = base_storage_url + bucket +'/' + folder + parameters['tile_template']
-        object = {
-            'url': url,
-            'date': datestring
-        }
-        url_date_list.append(object)
+    # Select time window, dates are iso formatted so compare as strings
+    if start_time is not None:
+        start = datetime.strftime(start_time, "%Y-%m-%dT%H:%M:%S")
+        url_date_list = [frame for frame in url_date_list if frame["date"] >= start]
+    if end_time is not None:
+        end = datetime.strftime(end_time, "%Y-%m-%dT%H:%M:%S")
+        url_date_list = [frame for frame in url_date_list if frame["date"] <= end]
+    if frames is not None:
+        url_date_list = url_date_list[-frames:]
+    if not len(url_date_list):
+        logging.warning(f"Dataset id {id} has no flowmap layers in the requested time window")
+        return data
 
     data['flowmapTimeseries'] = url_date_list
     data.update({
@@ -132,33 +330,101 @@ def get_google_storage_url(id, layer_name, access_url, parameters):
     return data
 
 
-def get_fews_url(id, layer_name, access_url, feature_url, parameters):
+def get_google_storage_url(id, layer_name, access_url, parameters, start_time=None, end_time=None, frames=None):
     """
-    Get FEWS Pi WMS url by filling in template with latest time
+    Get google storage flowmap urls and dates
     :param id: dataset id, as defined in datasets.json and datasets_access.json
-    :param url_template: template of url to adjust
+    :param start_time: optional datetime, only return tilesets from this time
+    :param end_time: optional datetime, only return tilesets up to this time
+    :param frames: optional number of (most recent) tilesets to return
     :return: url
     """
+    bucket, folder = split_bucket_folder(access_url)
+    url_date_list = get_flowmap_frames(bucket, folder, parameters)
+
+    return flowmap_data(id, access_url, url_date_list, start_time, end_time, frames)
+
+
+def clear_fews_capabilities():
+    """
+    Start a new refresh cycle, the FEWS capabilities are fetched again on next use.
+    """
+    _fews_capabilities.clear()
+
+
+def cached_fews_layers(access_url):
+    """
+    Get the FEWS layers of the current refresh cycle
+    :param access_url: url of the FEWS capabilities
+    :return: dict of layer name: layer, None when not fetched in this cycle
+    """
+    cached = _fews_capabilities.get(access_url)
+    if cached is not None and time.time() - cached[0] < CONFIG["FEWS_CAPABILITIES_TIMEOUT"]:
+        return cached[1]
+    return None
+
+
+def parse_fews_layers(access_url, resp):
+    """
+    Parse and store the layers of a FEWS capabilities response
+    :param access_url: url of the FEWS capabilities
+    :param resp: capabilities response (requests or httpx)
+    :return: dict of layer name: layer, None when the capabilities could not be fetched
+    """
+    if resp.status_code != 200:
+        logging.error("FEWS capabilities {} not reached. Error {}".format(access_url, resp.status_code))
+        return None
+
+    layers = {layer["name"]: layer for layer in json.loads(resp.text)["layers"]}
+    _fews_capabilities[access_url] = (time.time(), layers)
+    return layers
+
+
+def get_fews_layers(access_url):
+    """
+    Get the layers of a FEWS Pi WMS, fetched once per access_url per refresh cycle
+    :param access_url: url of the FEWS capabilities
+    :return: dict of layer name: layer, None when the capabilities could not be fetched
+    """
+    # datasets sharing the access_url wait for a single fetch
+    with _fews_locks.setdefault(access_url, threading.Lock()):
+        layers = cached_fews_layers(access_url)
+        if layers is None:
+            layers = parse_fews_layers(access_url, upstream.get(access_url, protocol="fewsWms"))
+
+    return layers
+
+
+def fews_data(id, layer_name, feature_url, parameters, layers):
+    """
+    Get the dataset info of a FEWS layer, by filling in the url template with the latest time
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :param layers: dict of layer name: layer, or None
+    :return: dict
+    """
     data = {
         "featureInfoUrl": feature_url
     }
 
-    resp = requests.get(url=access_url)
-
-    if resp.status_code == 200:
-        fews_data = json.loads(resp.text)
-
-        # ignore layers in hydroengine
-        for layer in fews_data["layers"]:
-            if layer["name"] == layer_name:
-                url_template = parameters["urlTemplate"]
-                times = layer["times"]
-                data["date"] = times[-1]
-                data["url"] = url_template.replace("##TIME##", times[-1])
-                data["dateFormat"] = "YYYY-MM-DDTHH:mm:ssZ"
-            else:
-                continue
-    else:
-        logging.error("Dataset id {} not reached. Error {}".format(id, resp.status_code))
+    if layers is None:
+        logging.error("Dataset id {} not reached.".format(id))
+    elif layer_name in layers:
+        url_template = parameters["urlTemplate"]
+        times = layers[layer_name]["times"]
+        data["date"] = times[-1]
+        data["url"] = url_template.replace("##TIME##", times[-1])
+        data["dateFormat"] = "YYYY-MM-DDTHH:mm:ssZ"
 
     return data
+
+
+def get_fews_url(id, layer_name, access_url, feature_url, parameters):
+    """
+    Get FEWS Pi WMS url by filling in template with latest time
+    :param id: dataset id, as defined in datasets.json and datasets_access.json
+    :param url_template: template of url to adjust
+    :return: url
+    """
+    layers = get_fews_layers(access_url)
+
+    return fews_data(id, layer_name, feature_url, parameters, layers)
@@ -1,14 +1,17 @@
-import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from pathlib import Path
+from functools import lru_cache
 
-import requests
 from requests.exceptions import RequestException
-import json
-from jinja2 import Template
 import logging
 
-from dgds_backend import error_handler
+from flask import abort
+
+from dgds_backend import upstream
+from dgds_backend.singleflight import SingleFlight
+
+_fetches = SingleFlight("dd-api")
+_shorelines = SingleFlight("shoreline")
 
 
 class PiServiceDDL:
@@ -26,22 +29,22 @@ class PiServiceDDL:
         :param url_local:
         :param resp_data:
         :param dataset_id:
-        :return:
+        :return: copy of resp_data with the updated paging
         """
-        rr = resp_data
+        # the response may be shared with concurrent callers, see SingleFlight
+        rr = dict(resp_data, paging=dict(resp_data["paging"]))
         if resp_data["paging"]["prev"] is not None:
             rr["paging"]["prev"] = resp_data["paging"]["prev"].replace(url, url_local) + "&datasetId=" + dataset_id
         if resp_data["paging"]["next"] is not None:
             rr["paging"]["next"] = resp_data["paging"]["next"].replace(url, url_local) + "&datasetId=" + dataset_id
         return rr
 
-    def make_request(self, data, ddl_url, url_path):
+    def request_params(self, data, url_path):
         """
-        Make request to the PiServiceDDL
-        :param data:
-        :param ddl_url:
-        :param url_path:
-        :return:
+        Translate request parameters into DD-API parameters
+        :param data: request parameters, updated inline
+        :param url_path: locations or timeseries
+        :return: dataset_id, DD-API parameters
         """
         # dataset_id not needed
         dataset_id = data.pop("datasetId", None)
@@ -52,22 +55,92 @@ class PiServiceDDL:
         location_id = data.pop("locationId", None)
         data["locationCode"] = location_id
 
+        return dataset_id, data
+
+    def process_response(self, resp_data, ddl_url, url_path, dataset_id):
+        """
+        Point the paging of a DD-API response to this service
+        :param resp_data: DD-API response json
+        :param ddl_url:
+        :param url_path:
+        :param dataset_id:
+        :return:
+        """
+        if "paging" in resp_data:
+            resp_data = self.update_paging(ddl_url, self.hostname_url + url_path, resp_data, dataset_id)
+
+        return resp_data
+
+    def fetch(self, url, params=None):
+        """
+        Fetch a DD-API response, concurrent identical requests share a single fetch
+        :param url: DD-API url
+        :param params: DD-API parameters
+        :return: response json
+        """
+        return _fetches.do(upstream.request_key("GET", url, params), self._fetch, url, params)
+
+    def _fetch(self, url, params):
         # Query / Response
         try:
-            resp = requests.get(url=ddl_url, params=data)
+            resp = upstream.hedged_get(url, params=params, protocol="dd-api")
             if resp.status_code != 200:
                 raise(RequestException("Failed request."))
 
+        except upstream.UpstreamUnavailable as e:
+            abort(503, "DD-API unavailable: {}".format(e))
         except RequestException as e:
-            msg = "Failed to fetch from the DD-API/locations"
-            raise error_handler.InvalidUsage(msg)
+            abort(502, "Failed to fetch from the DD-API")
 
-        logging.info(data, ddl_url, url_path, resp)
-        resp_data = resp.json()
-        if "paging" in resp_data:
-            resp_data = self.update_paging(ddl_url, self.hostname_url + url_path, resp_data, dataset_id)
+        logging.info("DD-API {} {}: {}".format(url, params, resp.status_code))
 
-        return resp_data
+        return resp.json()
+
+    def make_request(self, data, ddl_url, url_path):
+        """
+        Make request to the PiServiceDDL
+        :param data:
+        :param ddl_url:
+        :param url_path:
+        :return:
+        """
+        dataset_id, data = self.request_params(data, url_path)
+        resp_data = self.fetch(ddl_url, data)
+
+        return self.process_response(resp_data, ddl_url, url_path, dataset_id)
+
+    def iter_timeseries_pages(self, data, max_pages):
+        """
+        Get all pages of a timeseries, following the DD-API paging. The next page
+        is fetched while the current one is consumed, so at most two pages are
+        held in memory.
+        :param data: request parameters
+        :param max_pages: maximum number of pages to follow
+        :return: generator of DD-API response json, the upstream paging untouched
+        """
+        _, data = self.request_params(data, "timeseries")
+        page = self.fetch(self.timeseries_url, data)
+        # the next pages are fetched in the executor, while the response is streamed
+        fetch = upstream.with_deadline(self.fetch)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            for count in range(1, max_pages + 1):
+                next_url = (page.get("paging") or {}).get("next")
+                prefetch = None
+                if next_url and count < max_pages:
+                    prefetch = executor.submit(fetch, next_url)
+                elif next_url:
+                    logging.warning(
+                        "Timeseries paging stopped after {} pages".format(max_pages)
+                    )
+
+                yield page
+                if prefetch is None:
+                    return
+                page = prefetch.result()
+        finally:
+            executor.shutdown(wait=False)
 
     def get_locations(self, data):
         """
@@ -90,71 +163,101 @@ class PiServiceDDL:
 
 
 
+# Dates for Shoreline monitor are defined as years (of 365 days) since 01-01-1984.
+SHORELINE_START_TIME = datetime(1984, 1, 1, 00, 00, 00)
+DD_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+@lru_cache(maxsize=4096)
+def shoreline_timestamp(years):
+    """
+    Digital Delta timestamp of a shoreline date. Transects share the same
+    (satellite) dates, so these are formatted once and then looked up.
+    :param years: years since SHORELINE_START_TIME
+    :return: timestamp string
+    """
+    return (SHORELINE_START_TIME + timedelta(days=(years * 365))).strftime(DD_TIME_FORMAT)
+
+
 def transform_dd(feature, dataset_name, dataset_id):
     """
-    Transform a shoreline transect feature into Digital Delta format, from template
+    Transform a shoreline transect feature into Digital Delta 2.0 format
     :param feature: json of transect feature data
     :param dataset_name: name of dataset
     :param dataset_id: id of dataset
-    :return: rendered template, JSON of transect timeseries info in Digital Delta format
+    :return: JSON of transect timeseries info in Digital Delta format
     """
-    # Dates for Shoreline monitor are defined as days since 01-01-1984.
-    start_time = datetime(1984, 1, 1, 00, 00, 00)
-    dataset = {"name": dataset_name, "id": dataset_id}
-
-    # Load template
-    filepath = Path(os.path.dirname(os.path.realpath(__file__)))
-    template_file = Path(filepath / "templates" / "dd_timeseries_template.json.j2")
-    with open(str(template_file), "r") as f:
-        template_json = f.read()
-
-    template = Template(template_json)
+    properties = feature["properties"]
 
     # Transform timeseries data
-    dt = feature["properties"]["dt"]
-    dates = [start_time + timedelta(days=(x * 365)) for x in dt]
-    points = feature["properties"]["distances"]
+    timestamps = list(map(shoreline_timestamp, properties["dt"]))
+    points = properties["distances"]
 
     # Build events list from timeseries
-    events_list = []
-    for date, point in zip(dates, points):
-        event = {}
-        event["timeStamp"] = date.strftime("%Y-%m-%dT%H:%M:%SZ")
-        event["value"] = point
-        events_list.append(event)
-
-    # Build dictionary to send to template
-    transect = {}
-    transect["type"] = feature["type"]
-    transect["geometry"] = feature["geometry"]
-    transect["properties"] = {}
-    transect["properties"]["locationId"] = feature["properties"]["transect_id"]
-    transect["properties"]["countryName"] = feature["properties"]["country_name"]
-    transect["properties"]["continent"] = feature["properties"]["continent"]
-    transect["properties"]["flagSandy"] = feature["properties"]["flag_sandy"]
-    transect["properties"]["changeRate"] = feature["properties"]["change_rate"]
-    transect["properties"]["changeRateUnc"] = feature["properties"]["change_rate_unc"]
-    transect["startTime"] = dates[0].strftime("%Y-%m-%dT%H:%M:%SZ")
-    transect["endTime"] = dates[-1].strftime("%Y-%m-%dT%H:%M:%SZ")
-    transect["events"] = events_list
-
-    rendered = template.render(dataset=dataset, transect=transect).replace("'", '"')
-    dic = json.loads(rendered)
-    return dic
-
-
-def dd_shoreline(url, transect_id, dataset_name, dataset_id):
+    events = [
+        {"timeStamp": timestamp, "value": point}
+        for timestamp, point in zip(timestamps, points)
+    ]
+
+    return {
+        "results": [
+            {
+                "id": properties["transect_id"],
+                "source": {"institution": {"name": "Deltares"}},
+                "location": {
+                    "type": feature["type"],
+                    "geometry": feature["geometry"],
+                    "properties": {
+                        "locationId": properties["transect_id"],
+                        "countryName": properties["country_name"],
+                        "continent": properties["continent"],
+                        "flagSandy": properties["flag_sandy"],
+                        "changeRate": properties["change_rate"],
+                        "changeRateUnc": properties["change_rate_unc"],
+                    },
+                },
+                "observationType": {
+                    "id": dataset_id,
+                    "quantity": dataset_name,
+                    "unit": "m",
+                },
+                "startTime": timestamps[0],
+                "endTime": timestamps[-1],
+                "events": events,
+            }
+        ]
+    }
+
+
+@_shorelines.coalesce(
+    key=lambda url, transect_id, dataset_name, dataset_id, cache=None: (
+        url, transect_id, dataset_name, dataset_id, id(cache)
+    )
+)
+def dd_shoreline(url, transect_id, dataset_name, dataset_id, cache=None):
+    """
+    Get a shoreline transect in Digital Delta format
+    :param url: url template of the box file with the transect
+    :param transect_id: transect id, as BOX_<box>_<section>_<number>
+    :param dataset_name: name of dataset
+    :param dataset_id: id of dataset
+    :param cache: optional ShorelineCache of box files
+    :return: JSON of transect timeseries info in Digital Delta format
+    """
     _, box, section, number = transect_id.split("_")
     url = url.format(**{"box": box, "section": section})
 
-    response = requests.get(url)
-    featurecollection = response.json()
+    if cache is not None:
+        transect = cache.get_feature(url, transect_id)
+    else:
+        response = upstream.get(url, protocol="dd-api-shoreline")
+        featurecollection = response.json()
 
-    # Filter FeatureCollection
-    transect = None
-    for feature in featurecollection.get("features", []):
-        if feature.get("properties", {}).get("transect_id", transect_id) == transect_id:
-            transect = feature
+        # Filter FeatureCollection
+        transect = None
+        for feature in featurecollection.get("features", []):
+            if feature.get("properties", {}).get("transect_id", transect_id) == transect_id:
+                transect = feature
 
     if transect is None:
         return {}
@@ -11,9 +11,21 @@ class DatasetSchema(Schema):
     themes = fields.List(fields.Str())
     vectorLayer = fields.Dict()
     rasterLayer = fields.Dict()
+    degraded = fields.Bool()
 
 class TimeSerieSchema(Schema):
     """See DigitalDelta API 2.0."""
     paging = fields.Dict()
     provider = fields.Dict()
     results = fields.List(fields.Dict())
+
+class TimeSerieBatchItemSchema(Schema):
+    """Timeseries of one dataset and location, or the error fetching it."""
+    datasetId = fields.Str()
+    locationId = fields.Str()
+    status = fields.Int()
+    content = fields.Raw()
+    error = fields.Dict()
+
+class TimeSerieBatchSchema(Schema):
+    results = fields.List(fields.Nested(TimeSerieBatchItemSchema))
@@ -0,0 +1,135 @@
+"""Persistent local cache of shoreline (dd-api-shoreline) box files."""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from dgds_backend import upstream
+
+
+class ShorelineCache:
+    """
+    Local cache of shoreline box FeatureCollections.
+
+    Each box file is stored with one feature per line, next to an index of
+    transect_id: (offset, length). A transect lookup is a dictionary hit plus a
+    slice read instead of downloading and parsing the whole box file. The box
+    files are effectively static, they are downloaded again after `max_age` seconds.
+    """
+
+    def __init__(self, cache_dir, max_age):
+        """
+        :param cache_dir: directory to store the box files and indexes in
+        :param max_age: seconds before a box file is downloaded again
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_age = max_age
+        self._indexes = {}  # url: (loaded at, index)
+        self._locks = {}  # url: lock
+
+    def _index_file(self, url):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return self.cache_dir / (name + ".index.json")
+
+    def get_feature(self, url, transect_id):
+        """
+        Get a single transect feature from a box file
+        :param url: url of the box FeatureCollection
+        :param transect_id: transect id
+        :return: feature or None when not found
+        """
+        index = self.get_index(url)
+        try:
+            return self._read(index, transect_id)
+        except OSError:
+            # box file was replaced by another process, use its new index
+            self._indexes.pop(url, None)
+            return self._read(self.get_index(url), transect_id)
+
+    def _read(self, index, transect_id):
+        if index is None or transect_id not in index["transects"]:
+            return None
+
+        offset, length = index["transects"][transect_id]
+        with open(str(self.cache_dir / index["features"]), "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode("utf-8"))
+
+    def get_index(self, url):
+        """
+        Get the transect index of a box file, downloaded when missing or expired
+        :param url: url of the box FeatureCollection
+        :return: index dict or None when the box file could not be downloaded
+        """
+        cached = self._indexes.get(url)
+        if cached is not None and time.time() - cached[0] < self.max_age:
+            return cached[1]
+
+        with self._locks.setdefault(url, threading.Lock()):
+            cached = self._indexes.get(url)
+            if cached is not None and time.time() - cached[0] < self.max_age:
+                return cached[1]
+
+            # index written by an earlier run or another process
+            index_file = self._index_file(url)
+            try:
+                modified = os.path.getmtime(str(index_file))
+                if time.time() - modified < self.max_age:
+                    with open(str(index_file), "r") as f:
+                        index = json.load(f)
+                    self._indexes[url] = (modified, index)
+                    return index
+            except (OSError, ValueError):
+                pass
+
+            index = self._download(url)
+            if index is not None:
+                self._indexes[url] = (time.time(), index)
+            return index
+
+    def _download(self, url):
+        response = upstream.get(url, protocol="dd-api-shoreline")
+        if response.status_code != 200:
+            logging.error("Shoreline box {} not reached. Error {}".format(url, response.status_code))
+            return None
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        index_file = self._index_file(url)
+        transects = {}
+        features_fd, features_tmp = tempfile.mkstemp(dir=str(self.cache_dir), suffix=".tmp")
+        digest = hashlib.sha1()
+        with os.fdopen(features_fd, "wb") as f:
+            offset = 0
+            for feature in response.json().get("features", []):
+                line = json.dumps(feature).encode("utf-8")
+                transect_id = feature.get("properties", {}).get("transect_id")
+                if transect_id is not None:
+                    transects[transect_id] = (offset, len(line))
+                f.write(line + b"\n")
+                digest.update(line)
+                offset += len(line) + 1
+
+        # features are versioned by content, so readers of the old index keep working
+        features_file = index_file.name.replace(".index.json", ".{}.jsonl".format(digest.hexdigest()))
+        os.replace(features_tmp, str(self.cache_dir / features_file))
+
+        index = {"url": url, "features": features_file, "transects": transects}
+        index_fd, index_tmp = tempfile.mkstemp(dir=str(self.cache_dir), suffix=".tmp")
+        with os.fdopen(index_fd, "w") as f:
+            json.dump(index, f)
+        os.replace(index_tmp, str(index_file))
+
+        # remove previous versions of the box file
+        prefix = index_file.name.replace(".index.json", ".")
+        for path in self.cache_dir.glob(prefix + "*.jsonl"):
+            if path.name != features_file:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+        return index
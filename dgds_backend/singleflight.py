@@ -0,0 +1,101 @@
+"""Coalescing of identical concurrent calls (single-flight)."""
+import copy
+import functools
+import threading
+
+FLIGHTS = {}  # name: SingleFlight, for monitoring
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single execution. The first caller
+    runs the function, callers arriving while it is in flight wait for it and get
+    a copy of its result (or its exception). The first caller gets a copy too
+    when the result is shared.
+
+    Only calls that overlap in time are coalesced, results are not cached.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: name of this group of calls, as reported by flight_stats()
+        """
+        self.name = name
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = {}  # key: _Call
+        self._lock = threading.Lock()
+        FLIGHTS[name] = self
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call a function, or wait for the in-flight call with the same key
+        :param key: hashable key of the call
+        :param function: function to call
+        :return: result of the function
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+            else:
+                call.waiters += 1
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # callers may modify their result, don't share it
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+        # no callers join after the call is removed, the waiters copy the result
+        # while the leader may modify it
+        if call.waiters:
+            return copy.deepcopy(call.result)
+        return call.result
+
+    def coalesce(self, key):
+        """
+        Decorator coalescing concurrent calls of a function
+        :param key: callable(*args, **kwargs) returning the key of a call
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                return self.do(key(*args, **kwargs), function, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._in_flight)}
+
+
+def flight_stats():
+    """
+    Get the number of calls and calls that shared an in-flight call per group
+    :return: dict of name: calls, shared and in_flight
+    """
+    return {name: flight.stats() for name, flight in list(FLIGHTS.items())}
@@ -0,0 +1,202 @@
+"""Response cache for the DD-API /timeseries and /locations proxies."""
+import logging
+import time
+from calendar import timegm
+from datetime import datetime
+
+DD_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DD_TIME_FORMATS = (DD_TIME_FORMAT, "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_time(value):
+    """
+    Parse a DD-API time string
+    :param value: time string
+    :return: seconds since epoch (UTC), None when not parseable
+    """
+    for time_format in DD_TIME_FORMATS:
+        try:
+            return timegm(datetime.strptime(value, time_format).timetuple())
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def format_time(seconds):
+    return time.strftime(DD_TIME_FORMAT, time.gmtime(seconds))
+
+
+class TimeseriesCache:
+    """
+    Cache DD-API responses in a (shared) Flask-Caching cache.
+
+    Timeseries time windows are widened to the forecast cycle boundaries of the
+    dataset before querying the DD-API, so all requests within a cycle share the
+    same upstream response. Requests for a narrower window are sliced from any
+    cached window of the same location that contains it. Entries expire at the
+    next cycle boundary, when a new forecast may be available. Locations with
+    paged responses are remembered until then and queried without widening.
+    """
+
+    def __init__(self, cache):
+        """
+        :param cache: Flask-Caching cache
+        """
+        self.cache = cache
+
+    @staticmethod
+    def _timeout(cycle):
+        # expire at the next cycle boundary, with a minimum of a minute
+        return max(int(cycle - time.time() % cycle), 60)
+
+    @staticmethod
+    def _complete(resp_data):
+        # paged responses have local paging urls and can't be sliced
+        paging = resp_data.get("paging") or {}
+        return paging.get("next") is None and paging.get("prev") is None
+
+    def get_locations(self, pi, data, cycle):
+        """
+        Get locations, from cache if available
+        :param pi: PiServiceDDL
+        :param data: request parameters, with datasetId
+        :param cycle: refresh cadence of the dataset in seconds
+        :return: DD-API locations response
+        """
+        key = "locations:{}:{}:{}".format(
+            pi.hostname_url, pi.locations_url, sorted(data.items())
+        )
+        content = self.cache.get(key)
+        if content is None:
+            content = pi.get_locations(dict(data))
+            self.cache.set(key, content, timeout=self._timeout(cycle))
+        return content
+
+    def get_timeseries(self, pi, data, cycle):
+        """
+        Get timeseries, from cache if a cached window contains the requested window
+        :param pi: PiServiceDDL
+        :param data: request parameters, with datasetId, locationId, startTime and endTime
+        :param cycle: refresh cadence of the dataset in seconds
+        :return: DD-API timeseries response
+        """
+        start = parse_time(data.get("startTime"))
+        end = parse_time(data.get("endTime"))
+        if start is None or end is None or start > end:
+            # no window to normalize, cache the exact request
+            key = "timeseries:{}:{}".format(pi.timeseries_url, sorted(data.items()))
+            content = self.cache.get(key)
+            if content is None:
+                content = pi.get_timeseries(dict(data))
+                if self._complete(content):
+                    self.cache.set(key, content, timeout=self._timeout(cycle))
+            return content
+
+        location_key, other = self._location_key(pi, data)
+
+        # Any cached window containing the requested window
+        now = time.time()
+        windows = [w for w in self.cache.get(location_key) or [] if w[2] > now]
+        for window in self._containing(windows, start, end, other):
+            content = self.cache.get(self._window_key(location_key, window[0], window[1], other))
+            if content is not None:
+                return self._slice(content, start, end)
+
+        # Paged locations are not widened, the exact window is queried instead
+        paged_key = self._paged_key(location_key, other)
+        if self.cache.get(paged_key):
+            return pi.get_timeseries(dict(data))
+
+        # Query the window aligned on the forecast cycle
+        window_start = start - start % cycle
+        window_end = end if end % cycle == 0 else end - end % cycle + cycle
+        window_data = dict(data, startTime=format_time(window_start), endTime=format_time(window_end))
+        content = pi.get_timeseries(window_data)
+        timeout = self._timeout(cycle)
+        if not self._complete(content):
+            logging.info("Timeseries response for {} is paged, not cached".format(location_key))
+            self.cache.set(paged_key, True, timeout=timeout)
+            if window_start == start and window_end == end:
+                return content
+            return pi.get_timeseries(dict(data))
+
+        self.cache.set(self._window_key(location_key, window_start, window_end, other), content, timeout=timeout)
+        windows.append((window_start, window_end, now + timeout, other, now))
+        self.cache.set(location_key, windows, timeout=timeout)
+
+        return self._slice(content, start, end)
+
+    def version(self, pi, data):
+        """
+        Version of the timeseries response, without querying or slicing it
+        :param pi: PiServiceDDL
+        :param data: request parameters, with datasetId, locationId, startTime and endTime
+        :return: cached window key with its store time, None when not cached
+        """
+        start = parse_time(data.get("startTime"))
+        end = parse_time(data.get("endTime"))
+        if start is None or end is None or start > end:
+            return None
+
+        location_key, other = self._location_key(pi, data)
+        now = time.time()
+        windows = [w for w in self.cache.get(location_key) or [] if w[2] > now]
+        for window in self._containing(windows, start, end, other):
+            window_key = self._window_key(location_key, window[0], window[1], other)
+            if self.cache.get(window_key) is not None:
+                # the paging links of a response point to this service
+                return "{}:{}:{}:{}:{}".format(window_key, window[4], start, end, pi.hostname_url)
+        return None
+
+    @staticmethod
+    def _location_key(pi, data):
+        location_key = "timeseries:{}:{}:{}".format(
+            pi.timeseries_url, pi.observation_type_id, data["locationId"]
+        )
+        other = sorted(
+            (k, v) for k, v in data.items() if k not in ("startTime", "endTime")
+        )
+        return location_key, other
+
+    @staticmethod
+    def _containing(windows, start, end, other):
+        # windows are (start, end, expires, other, stored)
+        return [
+            w for w in windows if w[0] <= start and end <= w[1] and w[3] == other
+        ]
+
+    @staticmethod
+    def _window_key(location_key, window_start, window_end, other):
+        return "{}:{}:{}:{}".format(location_key, window_start, window_end, other)
+
+    @staticmethod
+    def _paged_key(location_key, other):
+        return "{}:paged:{}".format(location_key, other)
+
+    @staticmethod
+    def _in_window(timestamp, start_time, end_time):
+        # DD-API timestamps sort as strings, only parse other formats
+        if not isinstance(timestamp, str) or len(timestamp) != len(start_time):
+            seconds = parse_time(timestamp)
+            return seconds is None or parse_time(start_time) <= seconds <= parse_time(end_time)
+        return start_time <= timestamp <= end_time
+
+    @staticmethod
+    def _slice(content, start, end):
+        """Copy of a timeseries response with only the events within start and end."""
+        start_time, end_time = format_time(start), format_time(end)
+        results = []
+        for result in content.get("results", []):
+            result = dict(result)
+            if "events" in result:
+                result["events"] = [
+                    event
+                    for event in result["events"]
+                    if TimeseriesCache._in_window(event.get("timeStamp"), start_time, end_time)
+                ]
+            if "startTime" in result:
+                result["startTime"] = start_time
+            if "endTime" in result:
+                result["endTime"] = end_time
+            results.append(result)
+        return dict(content, results=results)
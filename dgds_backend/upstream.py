@@ -0,0 +1,449 @@
+"""
+Pooled keep-alive HTTP sessions shared by all upstream providers.
+
+Each upstream host gets its own session with a connection pool, so requests to
+the DD-API, FEWS, hydroengine and shoreline hosts reuse their TCP+TLS connections.
+
+Requests are guarded per host by a circuit breaker, which opens after consecutive
+failures and then fails fast until a trial request succeeds. Failed GETs are
+remembered shortly (negative cache), and all requests made while handling an
+incoming request share its deadline.
+
+Optionally, GETs can be hedged: when no response arrived within a percentile of
+the recent latency of the host, a duplicate request is sent and the first
+response is used.
+"""
+import functools
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dgds_backend import metrics
+
+# Defaults, overridden with the application settings by configure()
+CONFIG = {
+    "UPSTREAM_POOL_SIZE": 10,  # connections kept alive per host
+    "UPSTREAM_POOL_SIZES": {},  # pool size per host, e.g. {"hydro-engine.appspot.com": 20}
+    "UPSTREAM_CONNECT_TIMEOUT": 5,  # seconds
+    "UPSTREAM_READ_TIMEOUT": 30,  # seconds
+    "UPSTREAM_BREAKER_FAILURES": 5,  # consecutive failures that open the breaker of a host
+    "UPSTREAM_BREAKER_RESET": 30,  # seconds open before a trial request is let through
+    "UPSTREAM_NEGATIVE_TTL": 10,  # seconds a failed GET is answered from the negative cache
+    "UPSTREAM_HEDGE": False,  # send a duplicate of slow hedged GETs
+    "UPSTREAM_HEDGE_PERCENTILE": 95,  # percentile of recent latency after which to hedge
+    "UPSTREAM_HEDGE_MIN_SAMPLES": 20,  # latencies needed before hedging a host
+    "UPSTREAM_HEDGE_BUDGET": 0.05,  # maximum fraction of hedged requests that are duplicated
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_breakers = {}
+_negative = {}  # url: (expires, exception or response)
+_local = threading.local()
+_hedges = {}
+_hedge_executor = None
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """An upstream request was not made, its host is failing or the deadline passed."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an upstream host. Closed, requests pass; open after
+    `failures` consecutive failures, requests fail fast; half open after
+    `reset_timeout` seconds, a single trial request decides whether it closes again.
+    """
+
+    def __init__(self, failures, reset_timeout):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return self.state == "closed"
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (
+                self.state == "closed" and self.failures >= self.max_failures
+            ):
+                self.state = "open"
+                self.opened_at = time.time()
+                self.trips += 1
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "trips": self.trips}
+
+
+def configure(config):
+    """
+    Configure the upstream sessions, existing sessions are closed.
+    :param config: application config
+    """
+    with _sessions_lock:
+        CONFIG.update({key: config[key] for key in CONFIG if key in config})
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _breakers.clear()
+        _negative.clear()
+        _hedges.clear()
+
+
+def get_session(url):
+    """
+    Get the pooled session of the host of an url
+    :param url: upstream url
+    :return: requests.Session
+    """
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                pool_size = CONFIG["UPSTREAM_POOL_SIZES"].get(host, CONFIG["UPSTREAM_POOL_SIZE"])
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _sessions[host] = session
+    return session
+
+
+def get_breaker(url):
+    """
+    Get the circuit breaker of the host of an url
+    :param url: upstream url
+    :return: CircuitBreaker
+    """
+    host = urlsplit(url).netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers.setdefault(
+            host,
+            CircuitBreaker(CONFIG["UPSTREAM_BREAKER_FAILURES"], CONFIG["UPSTREAM_BREAKER_RESET"]),
+        )
+    return breaker
+
+
+def set_deadline(seconds):
+    """
+    Set the deadline of the upstream requests made by the current thread
+    :param seconds: seconds from now, None for no deadline
+    """
+    _local.deadline = time.time() + seconds if seconds is not None else None
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Upstream requests made within this context share a deadline
+    :param seconds: seconds from now
+    """
+    previous = getattr(_local, "deadline", None)
+    set_deadline(seconds)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def with_deadline(function):
+    """
+    Bind the deadline of the current thread to a function, which may run in
+    another thread (an executor) or after the incoming request was handled
+    (a streamed response)
+    :param function: function making upstream requests
+    :return: wrapped function
+    """
+    deadline_at = getattr(_local, "deadline", None)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "deadline", None)
+        _local.deadline = deadline_at
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+
+    return wrapper
+
+
+def remaining():
+    """
+    Get the time left before the deadline of the current thread
+    :return: seconds, None without a deadline
+    """
+    deadline_at = getattr(_local, "deadline", None)
+    return deadline_at - time.time() if deadline_at is not None else None
+
+
+def request_timeout():
+    """
+    Get the (connect, read) timeout of a request, bounded by the deadline
+    :return: tuple of seconds
+    """
+    connect, read = CONFIG["UPSTREAM_CONNECT_TIMEOUT"], CONFIG["UPSTREAM_READ_TIMEOUT"]
+    seconds = remaining()
+    if seconds is None:
+        return connect, read
+    if seconds <= 0:
+        raise UpstreamUnavailable("Upstream request deadline exceeded")
+    return min(connect, seconds), min(read, seconds)
+
+
+def request_key(method, url, params=None):
+    """
+    Get the normalized url of a GET request, with its query parameters
+    :return: url, None for other methods
+    """
+    if method != "GET":
+        return None
+    return requests.Request(method, url, params=params).prepare().url
+
+
+def remember_failure(key, failure):
+    """
+    Store a failed GET in the negative cache, expired entries are dropped
+    :param key: request url with parameters, None for requests that are not cached
+    :param failure: exception or error response
+    """
+    if key is None:
+        return
+    now = time.time()
+    for expired in [k for k, (expires, _) in list(_negative.items()) if expires <= now]:
+        _negative.pop(expired, None)
+    _negative[key] = (now + CONFIG["UPSTREAM_NEGATIVE_TTL"], failure)
+
+
+def request(method, url, protocol=None, **kwargs):
+    """
+    Request an upstream url with the pooled session of its host
+    :param method: http method
+    :param url: upstream url
+    :param protocol: protocol of the upstream (e.g. dd-api), used as metrics label
+    :param kwargs: passed on to requests
+    :return: requests.Response
+    """
+    protocol = protocol or "other"
+    key = request_key(method, url, kwargs.get("params"))
+    if key is not None:
+        cached = _negative.get(key)
+        if cached is not None and cached[0] > time.time():
+            metrics.UPSTREAM_ERRORS.inc(protocol, "unavailable")
+            if isinstance(cached[1], Exception):
+                raise UpstreamUnavailable("{} failed recently: {}".format(url, cached[1]))
+            return cached[1]
+
+    try:
+        kwargs.setdefault("timeout", request_timeout())
+        breaker = get_breaker(url)
+        if not breaker.allow():
+            raise UpstreamUnavailable("Circuit breaker of {} is open".format(urlsplit(url).netloc))
+    except UpstreamUnavailable:
+        metrics.UPSTREAM_ERRORS.inc(protocol, "unavailable")
+        raise
+
+    session = get_session(url)
+    start = time.time()
+    metrics.UPSTREAM_IN_FLIGHT.inc(protocol)
+    try:
+        resp = session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        breaker.failure()
+        remember_failure(key, e)
+        kind = "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection"
+        metrics.UPSTREAM_ERRORS.inc(protocol, kind)
+        raise
+    finally:
+        metrics.UPSTREAM_IN_FLIGHT.dec(protocol)
+        metrics.UPSTREAM_LATENCY.observe(protocol, value=time.time() - start)
+
+    if resp.status_code >= 500:
+        breaker.failure()
+        remember_failure(key, resp)
+        metrics.UPSTREAM_ERRORS.inc(protocol, "status")
+    else:
+        breaker.success()
+    return resp
+
+
+class HedgeState:
+    """Recent latencies and hedging budget of an upstream host."""
+
+    def __init__(self, size=100):
+        self.latencies = deque(maxlen=size)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self._lock = threading.Lock()
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def hedge_delay(self, percentile, min_samples):
+        """
+        Get the delay after which a request is hedged
+        :return: seconds, None when there are too few samples
+        """
+        with self._lock:
+            if len(self.latencies) < min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = max(int(math.ceil(percentile / 100 * len(latencies))) - 1, 0)
+        return latencies[index]
+
+    def start(self):
+        with self._lock:
+            self.requests += 1
+
+    def take_hedge(self, budget):
+        """
+        Take a hedge from the budget, a fraction of all hedged requests
+        :return: whether a duplicate request may be sent
+        """
+        with self._lock:
+            if self.hedges + 1 > budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def win(self):
+        with self._lock:
+            self.wins += 1
+
+    def stats(self):
+        return {"requests": self.requests, "hedges": self.hedges, "wins": self.wins}
+
+
+def get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _sessions_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=32, thread_name_prefix="upstream-hedge"
+                )
+    return _hedge_executor
+
+
+def timed_get(state, url, kwargs):
+    start = time.time()
+    resp = request("GET", url, **kwargs)
+    if resp.status_code < 500:
+        state.add_latency(time.time() - start)
+    return resp
+
+
+def close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def hedged_get(url, **kwargs):
+    """
+    GET an upstream url, sending a duplicate request when no response arrived
+    within a percentile of the recent latency of the host (if UPSTREAM_HEDGE is set).
+    The first response is returned, the other one is cancelled or discarded.
+    :param url: upstream url
+    :param kwargs: passed on to requests
+    :return: requests.Response
+    """
+    if not CONFIG["UPSTREAM_HEDGE"]:
+        return get(url, **kwargs)
+
+    host = urlsplit(url).netloc
+    state = _hedges.get(host) or _hedges.setdefault(host, HedgeState())
+    state.start()
+    delay = state.hedge_delay(CONFIG["UPSTREAM_HEDGE_PERCENTILE"], CONFIG["UPSTREAM_HEDGE_MIN_SAMPLES"])
+    if delay is None:
+        return timed_get(state, url, kwargs)
+
+    # the deadline of this thread does not carry over to the executor
+    kwargs.setdefault("timeout", request_timeout())
+    executor = get_hedge_executor()
+    primary = executor.submit(timed_get, state, url, kwargs)
+    done, _ = wait([primary], timeout=delay)
+    if done or not state.take_hedge(CONFIG["UPSTREAM_HEDGE_BUDGET"]):
+        return primary.result()
+
+    hedge = executor.submit(timed_get, state, url, kwargs)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # use the first successful response, or the last failure
+        for future in sorted(done, key=lambda future: future.exception() is not None):
+            if future.exception() is None or not pending:
+                for loser in pending:
+                    if not loser.cancel():
+                        loser.add_done_callback(close_response)
+                if future is hedge:
+                    state.win()
+                return future.result()
+
+
+def hedge_stats():
+    """
+    Get the number of hedged requests, duplicates sent and duplicates that won per host
+    :return: dict of host: requests, hedges and wins
+    """
+    return {host: state.stats() for host, state in list(_hedges.items())}
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def pool_stats():
+    """
+    Get connection reuse statistics per upstream host
+    :return: dict of host: requests, connections (opened) and reused connections
+    """
+    stats = {}
+    for host, session in list(_sessions.items()):
+        host_stats = {"requests": 0, "connections": 0}
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool in filter(None, map(pools.get, pools.keys())):
+                host_stats["requests"] += pool.num_requests
+                host_stats["connections"] += pool.num_connections
+        host_stats["reused"] = host_stats["requests"] - host_stats["connections"]
+        stats[host] = host_stats
+    return stats
+
+
+def breaker_stats():
+    """
+    Get the circuit breaker state and number of trips per upstream host
+    :return: dict of host: state, consecutive failures and trips
+    """
+    return {host: breaker.stats() for host, breaker in list(_breakers.items())}
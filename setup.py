@@ -18,6 +18,9 @@ setup(
         'flask',
         'coverage',
         'codecov',
-        'google-cloud-storage'
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'async': ['httpx', 'uvicorn'],
+    },
 )
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from dgds_backend import providers_async
+
+
+def response(status_code, content):
+    return Mock(status_code=status_code, json=Mock(return_value=content))
+
+
+class AsyncClient:
+    """Stand-in for httpx.AsyncClient, returning the given responses in order."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    async def get(self, url, **kwargs):
+        self.calls.append(("GET", url, kwargs))
+        return self.responses.pop(0)
+
+    async def post(self, url, **kwargs):
+        self.calls.append(("POST", url, kwargs))
+        return self.responses.pop(0)
+
+
+def call(path, method="GET", query_string=b"", body=b"", headers=()):
+    from dgds_backend.asgi import app
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "root_path": "",
+        "query_string": query_string,
+        "headers": [(b"host", b"testserver")] + list(headers),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, body = messages
+    return start["status"], dict(start["headers"]), json.loads(body["body"].decode("utf-8"))
+
+
+class LockTestCase(unittest.TestCase):
+    def test_lock_per_event_loop(self):
+        async def locks():
+            lock = providers_async.get_lock("fews", "http://fews/wms")
+            async with lock:
+                pass
+            return lock, providers_async.get_lock("fews", "http://fews/wms")
+
+        first, same = asyncio.run(locks())
+        self.assertIs(first, same)
+
+        # a new event loop gets its own lock
+        second, _ = asyncio.run(locks())
+        self.assertIsNot(first, second)
+
+    @unittest.skipIf(httpx is None, "httpx not installed")
+    def test_client_per_event_loop(self):
+        async def clients():
+            client = providers_async.get_client()
+            same = providers_async.get_client()
+            await providers_async.close_client()
+            return client, same
+
+        first, same = asyncio.run(clients())
+        self.assertIs(first, same)
+        self.assertTrue(first.is_closed)
+
+        # a new event loop gets a new client
+        second, _ = asyncio.run(clients())
+        self.assertIsNot(first, second)
+
+
+@unittest.skipIf(httpx is None, "httpx not installed")
+class AsgiTestCase(unittest.TestCase):
+    def test_locations(self):
+        client = AsyncClient(response(200, {"results": [{"locationId": "diva_id__270"}]}))
+        with patch.object(providers_async, "get_client", return_value=client):
+            status, headers, content = call("/locations", query_string=b"datasetId=wl")
+
+        self.assertEqual(200, status)
+        self.assertEqual(b"*", headers[b"access-control-allow-origin"])
+        self.assertEqual([{"locationId": "diva_id__270"}], content["results"])
+        method, url, kwargs = client.calls[0]
+        self.assertTrue(url.endswith("/locations"))
+        self.assertNotIn("datasetId", kwargs["params"])
+
+    def test_timeseries_post(self):
+        client = AsyncClient(
+            response(200, {"paging": {"next": None, "prev": None}, "results": []})
+        )
+        body = json.dumps({"datasetId": "wl", "locationId": "diva_id__270"}).encode("utf-8")
+        with patch.object(providers_async, "get_client", return_value=client):
+            status, headers, content = call(
+                "/timeseries",
+                method="POST",
+                body=body,
+                headers=[(b"content-type", b"application/json")],
+            )
+
+        self.assertEqual(200, status)
+        self.assertEqual([], content["results"])
+        method, url, kwargs = client.calls[0]
+        self.assertEqual("diva_id__270", kwargs["params"]["locationCode"])
+
+    def test_unknown_dataset(self):
+        status, headers, content = call("/locations", query_string=b"datasetId=unknown")
+
+        self.assertEqual(422, status)
+        self.assertIn("datasetId", content["description"])
+
+    def test_upstream_error(self):
+        client = AsyncClient(response(500, {}))
+        with patch.object(providers_async, "get_client", return_value=client):
+            status, headers, content = call("/locations", query_string=b"datasetId=wl")
+
+        self.assertEqual(502, status)
+        self.assertEqual("Bad Gateway", content["name"])
+
+    def test_not_found(self):
+        status, headers, content = call("/unknown")
+
+        self.assertEqual(404, status)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import tempfile
+import time
+import unittest
+
+from dgds_backend.cache_backends import SharedFileSystemCache, SharedRedisCache
+
+
+class FakeRedis:
+    """In memory stand-in for the redis-py client."""
+
+    def __init__(self):
+        self.data = {}
+        self.clock = time.time
+
+    def _expired(self, name):
+        value, expires = self.data.get(name, (None, None))
+        if expires is not None and expires <= self.clock():
+            del self.data[name]
+
+    def get(self, name):
+        self._expired(name)
+        return self.data.get(name, (None, None))[0]
+
+    def mget(self, names):
+        return [self.get(name) for name in names]
+
+    def set(self, name, value):
+        self.data[name] = (value, None)
+        return True
+
+    def setex(self, name, value, time):
+        self.data[name] = (value, self.clock() + time)
+        return True
+
+    def delete(self, *names):
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+    def exists(self, name):
+        self._expired(name)
+        return name in self.data
+
+
+class CacheBackendsTestCase(unittest.TestCase):
+    def check_backend(self, cache):
+        self.assertIsNone(cache.get("datasets"))
+        cache.set("datasets", {"id": "wl"}, timeout=60)
+        self.assertEqual(cache.get("datasets"), {"id": "wl"})
+        cache.set("short", 1, timeout=1)
+        time.sleep(1.1)
+        self.assertIsNone(cache.get("short"))
+        self.assertFalse(cache.set("large", "x" * 2000))
+        self.assertIsNone(cache.get("large"))
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 3, "sets": 2, "rejected": 1}
+        )
+
+    def test_filesystem(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SharedFileSystemCache(cache_dir, max_value_size=1000)
+            self.check_backend(cache)
+            # another process sees the same entries
+            self.assertEqual(SharedFileSystemCache(cache_dir).get("datasets"), {"id": "wl"})
+
+    def test_filesystem_add_expired(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SharedFileSystemCache(cache_dir)
+            self.assertTrue(cache.add("catalog_lease", 1, timeout=60))
+            self.assertFalse(cache.add("catalog_lease", 2, timeout=60))
+            self.assertEqual(cache.get("catalog_lease"), 1)
+
+            # the lease of a worker that died during a rebuild
+            cache.set("catalog_lease", 3, timeout=-1)
+            self.assertTrue(cache.add("catalog_lease", 4, timeout=60))
+            self.assertEqual(cache.get("catalog_lease"), 4)
+
+    def test_filesystem_threshold(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SharedFileSystemCache(cache_dir, threshold=3)
+            for i in range(10):
+                cache.set(str(i), i)
+            self.assertLessEqual(len(cache._list_dir()), 4)
+
+    def test_redis(self):
+        client = FakeRedis()
+        cache = SharedRedisCache(host=client, key_prefix="dgds_", max_value_size=1000)
+        self.check_backend(cache)
+        self.assertIn("dgds_datasets", client.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from flask_caching.backends.simple import SimpleCache
+
+from dgds_backend.cache_backends import SharedFileSystemCache
+from dgds_backend.catalog import CatalogRefresher
+
+
+class CatalogRefresherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.builds = []
+        self.fail = False
+        self.complete = True
+        self.saved = threading.Event()
+
+    def refresher(self, *args):
+        refresher = CatalogRefresher(self.build, *args)
+        save = refresher._save
+
+        def saved(catalog, complete):
+            save(catalog, complete)
+            self.saved.set()
+
+        refresher._save = saved
+        return refresher
+
+    def build(self, previous):
+        self.builds.append(previous)
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return {"version": len(self.builds)}, self.complete
+
+    def test_first_get_builds(self):
+        refresher = CatalogRefresher(self.build, 60, 10, 10)
+        self.assertEqual(refresher.get(), {"version": 1})
+        self.assertEqual(refresher.get(), {"version": 1})
+        self.assertEqual(self.builds, [None])
+
+    def test_background_refresh_ahead_of_expiry(self):
+        refresher = self.refresher(0.2, 0.1, 10)
+        self.assertEqual(refresher.get(), {"version": 1})
+        self.saved.clear()
+        self.assertTrue(self.saved.wait(2))
+        self.assertEqual(refresher.get(), {"version": 2})
+        self.assertEqual(self.builds[1], {"version": 1})
+
+    def test_degraded_catalog_retried(self):
+        # degraded builds are retried after retry_interval, not the full cycle
+        self.complete = False
+        refresher = self.refresher(60, 10, 0.2)
+        self.assertEqual(refresher.get(), {"version": 1})
+        for version in (2, 3):
+            self.saved.clear()
+            self.assertTrue(self.saved.wait(2))
+            self.assertEqual(refresher.get(), {"version": version})
+
+        # a complete build is kept until the refresh ahead of expiry
+        self.complete = True
+        self.saved.clear()
+        self.assertTrue(self.saved.wait(2))
+        self.saved.clear()
+        self.assertFalse(self.saved.wait(0.5))
+        self.assertEqual(len(self.builds), 4)
+
+    def test_failed_refresh_keeps_catalog(self):
+        refresher = CatalogRefresher(self.build, 60, 10, 10)
+        refresher.get()
+        self.fail = True
+        refresher.refresh()
+        self.assertEqual(refresher.get(), {"version": 1})
+
+    def test_version(self):
+        store = SimpleCache()
+        refresher = CatalogRefresher(self.build, 60, 10, 10, store=store)
+        self.assertIsNone(refresher.version())
+        refresher.get()
+        version = refresher.version()
+        self.assertIsNotNone(version)
+
+        refresher.refresh()
+        self.assertNotEqual(refresher.version(), version)
+        self.assertEqual(refresher.version(), store.get("catalog")[1])
+
+    def test_expired_lease(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = SharedFileSystemCache(cache_dir)
+            refresher = CatalogRefresher(self.build, 60, 10, 10, store=store)
+            # a worker recycled during its rebuild left an expired lease behind
+            store.set("catalog_lease", 1234, timeout=-1)
+
+            refresher._scheduled_refresh()
+            refresher._timer.cancel()
+
+            self.assertEqual(self.builds, [None])
+            self.assertIsNone(store.get("catalog_lease"))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_refresh_state_reset_after_fork(self):
+        refresher = CatalogRefresher(self.build, 60, 10, 10)
+        refresher.get()
+        # a refresh in flight in the parent at fork time
+        refresher._running = True
+        refresher._build_lock.acquire()
+
+        pid = os.fork()
+        if pid == 0:
+            ok = not refresher._running and refresher._build_lock.acquire(blocking=False)
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        refresher._build_lock.release()
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
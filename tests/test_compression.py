@@ -0,0 +1,88 @@
+import gzip
+import json
+import unittest
+
+from flask import Flask, jsonify
+
+from dgds_backend import default_settings
+from dgds_backend.compression import CompressedResponses
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.from_object(default_settings)
+        compressed = CompressedResponses(app)
+        self.version = "1"
+        self.rendered = 0
+
+        @app.route("/datasets")
+        def datasets():
+            return jsonify({"toolTip": "Water level " * 100})
+
+        @app.route("/catalog")
+        @compressed.conditional(lambda: self.version)
+        def catalog():
+            self.rendered += 1
+            return jsonify({"toolTip": "Water level " * 100})
+
+        @app.route("/small")
+        def small():
+            return jsonify({"id": "wl"})
+
+        self.client = app.test_client()
+
+    def test_gzip(self):
+        rv = self.client.get("/datasets", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(rv.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", rv.headers["Vary"])
+        self.assertEqual(
+            json.loads(gzip.decompress(rv.data))["toolTip"], "Water level " * 100
+        )
+
+    def test_uncompressed(self):
+        rv = self.client.get("/datasets")
+        self.assertNotIn("Content-Encoding", rv.headers)
+        self.assertEqual(rv.json["toolTip"], "Water level " * 100)
+
+        rv = self.client.get("/small", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", rv.headers)
+
+    def test_conditional_get(self):
+        rv = self.client.get("/datasets", headers={"Accept-Encoding": "gzip"})
+        etag = rv.headers["ETag"]
+
+        rv = self.client.get(
+            "/datasets", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+        )
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b"")
+
+        # the uncompressed representation has another ETag
+        rv = self.client.get("/datasets", headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_conditional_get_before_render(self):
+        rv = self.client.get("/catalog", headers={"Accept-Encoding": "gzip"})
+        etag = rv.headers["ETag"]
+        self.assertEqual(self.rendered, 1)
+
+        rv = self.client.get(
+            "/catalog", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+        )
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers["ETag"], etag)
+        self.assertEqual(self.rendered, 1)
+
+        # a new version is rendered again
+        self.version = "2"
+        rv = self.client.get(
+            "/catalog", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+        )
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers["ETag"], etag)
+        self.assertEqual(self.rendered, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,22 +1,26 @@
 import json
 import unittest
 import os
+import threading
+from datetime import datetime
 from unittest.mock import Mock, patch
 import unittest
 
-from dgds_backend import app, providers_datasets
+from dgds_backend import app, providers_datasets, upstream
 
 
 class Dgds_backendTestCase(unittest.TestCase):
     def setUp(self):
         self.client = app.app.test_client()
+        providers_datasets.clear_fews_capabilities()
+        upstream.configure({})
 
     def test_index(self):
         rv = self.client.get("/")
         self.assertIn("/swagger-ui", rv.data.decode())
 
-    @patch("dgds_backend.app.requests.get")
-    def test_get_fews_url(self, mock_get):
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_fews_url(self, mock_request):
         mocked_fews_resp = """{
                     "title": "Spatial Display",
                     "layers": [{
@@ -37,8 +41,8 @@ class Dgds_backendTestCase(unittest.TestCase):
                     }]
                 }"""
 
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.text = mocked_fews_resp
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.text = mocked_fews_resp
 
         id = "wd"
         url_access = "http://test-url.deltares.nl/"
@@ -56,8 +60,35 @@ class Dgds_backendTestCase(unittest.TestCase):
         )
         self.assertEqual(data["url"], expected_url)
 
-    @patch("dgds_backend.app.requests.post")
-    def test_get_hydroengine_url(self, mock_post):
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_fews_capabilities_once(self, mock_request):
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.text = json.dumps(
+            {
+                "layers": [
+                    {"name": "Water Level", "times": ["2019-08-01T12:00:00Z"]},
+                    {"name": "Current 2DH", "times": ["2019-08-01T13:00:00Z"]},
+                ]
+            }
+        )
+        url_access = "http://test-url.deltares.nl/"
+        parameters = {"urlTemplate": "http://test-url.deltares.nl/time=##TIME##"}
+
+        wl = app.get_fews_url("wl", "Water Level", url_access, "", parameters)
+        cc = app.get_fews_url("cc", "Current 2DH", url_access, "", parameters)
+
+        self.assertEqual(wl["date"], "2019-08-01T12:00:00Z")
+        self.assertEqual(cc["date"], "2019-08-01T13:00:00Z")
+        self.assertEqual(mock_request.call_count, 1)
+
+        # outdated capabilities are fetched again
+        with patch.dict(providers_datasets.CONFIG):
+            providers_datasets.configure({"FEWS_CAPABILITIES_TIMEOUT": 0})
+            app.get_fews_url("wl", "Water Level", url_access, "", parameters)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_hydroengine_url(self, mock_request):
         mocked_hydroengine_resp = """{
             "url": "https://earthengine.googleapis.com/map/",
             "dataset": "currents",
@@ -67,8 +98,8 @@ class Dgds_backendTestCase(unittest.TestCase):
             "palette": ["1d1b1a",  "621d62",  "7642a5", "7871d5", "76a4e5", "e6f1f1"]
         }"""
 
-        mock_post.return_value.status_code = 200
-        mock_post.return_value.text = mocked_hydroengine_resp
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.text = mocked_hydroengine_resp
 
         id = "cc"
         layer_name = "currents"
@@ -83,41 +114,57 @@ class Dgds_backendTestCase(unittest.TestCase):
         self.assertEqual(data["date"], "2018-06-01T12:00:00")
         self.assertEqual(data["min"], 0.0)
 
-    @unittest.skip("waiting for proper mockup solution")
-    @patch("google.cloud.storage.Client")
-    @patch("google.cloud.storage.Bucket")
-    @patch("google.api_core.page_iterator.HTTPIterator")
-    def test_get_flowmap_url(self, client, bucket, blobs):
-        # folders within a bucket are returned as a set
-        blobs.prefixes = set(
-            [
-                "flowmap/glossis/tiles/glossis-current-202003290000/",
-                "flowmap/glossis/tiles/glossis-current-202003300000/",
-                "flowmap/glossis/tiles/glossis-current-202003310000/",
-            ]
-        )
-        client.get_bucket.return_value = bucket
-        client.list_blobs.return_value = blobs
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_flowmap_url(self, mock_request):
+        # folders within a bucket are listed as prefixes, the second listing
+        # starts at the last known folder
+        prefix = "flowmap_glossis/tiles/glossis-current-{}/"
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.json.side_effect = [
+            {"prefixes": [prefix.format("202003290000"), prefix.format("202003300000")]},
+            {"prefixes": [prefix.format("202003300000"), prefix.format("202003310000")]},
+            {"prefixes": [prefix.format("202003310000")]},
+        ]
 
         id = "cc"
         access_url = "https://storage.googleapis.com/test-bucket/flowmap_glossis/tiles"
         dataset = "currents"
         parameters = {
-            "time_template": "glossis-current-%Y%m%d%H%M%S",
+            "time_template": "glossis-current-%Y%m%d%H%M",
             "tile_template": "{z}/{x}/{y}.png",
         }
         data = providers_datasets.get_google_storage_url(
             id, dataset, access_url, parameters
         )
+        self.assertEqual(len(data["flowmapTimeseries"]), 2)
+
+        data = providers_datasets.get_google_storage_url(
+            id, dataset, access_url, parameters, frames=2
+        )
+        self.assertEqual(
+            mock_request.call_args[1]["params"]["startOffset"], prefix.format("202003300000")
+        )
         # Expect latest time to get url returned
-        expected_url = "https://storage.googleapis.com/test-bucket/flowmap/glossis/tiles/glossis-current-202003310000/{z}/{x}/{y}.png"
+        expected_url = "https://storage.googleapis.com/test-bucket/flowmap_glossis/tiles/glossis-current-202003310000/{z}/{x}/{y}.png"
         self.assertEqual(data["url"], expected_url)
+        self.assertEqual(data["date"], "2020-03-31T00:00:00")
+        self.assertEqual(
+            [frame["date"] for frame in data["flowmapTimeseries"]],
+            ["2020-03-30T00:00:00", "2020-03-31T00:00:00"],
+        )
 
-    @patch("dgds_backend.app.requests.get")
-    @patch("dgds_backend.app.requests.post")
-    def test_get_datasets_url(self, mock_post, mock_get):
-        mock_get.return_value = Mock()
-        mock_post.return_value = Mock()
+        data = providers_datasets.get_google_storage_url(
+            id, dataset, access_url, parameters, end_time=datetime(2020, 3, 29, 12)
+        )
+        self.assertEqual(data["date"], "2020-03-29T00:00:00")
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_datasets_url(self, mock_request):
+        mock_get = Mock()
+        mock_post = Mock()
+        mock_request.side_effect = lambda method, url, **kwargs: (
+            mock_post if method == "POST" else mock_get
+        )(url, **kwargs)
 
         mocked_hydroengine_resp = """{
             "dataset": "waterlevel",
@@ -191,9 +238,9 @@ class Dgds_backendTestCase(unittest.TestCase):
         result = json.loads(response.data)
         self.assertIn(expected_data, result["datasets"])
 
-    @patch("dgds_backend.app.requests.post")
-    def test_get_datasets_with_min_max(self, mock_post):
-        mock_post.return_value = Mock()
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_datasets_with_min_max(self, mock_request):
+        hydroengine = Mock()
         mocked_hydroengine_resp = """{
             "url": "https://earthengine.googleapis.com/map/",
             "dataset": "currents",
@@ -204,30 +251,170 @@ class Dgds_backendTestCase(unittest.TestCase):
             "palette": ["1d1b1a",  "621d62",  "7642a5", "7871d5", "76a4e5", "e6f1f1"]
         }"""
 
-        mock_post.return_value.status_code = 200
-        mock_post.return_value.text = mocked_hydroengine_resp
+        hydroengine.status_code = 200
+        hydroengine.text = mocked_hydroengine_resp
+
+        # the flowmap tilesets of cc are listed in its google storage bucket
+        google_storage = Mock()
+        google_storage.status_code = 200
+        google_storage.json.return_value = {
+            "prefixes": ["flowmap/glossis/tiles/glossis-current-20180601120000/"]
+        }
+        mock_request.side_effect = lambda method, url, **kwargs: (
+            google_storage if url.startswith("https://storage.googleapis.com/") else hydroengine
+        )
 
         response = self.client.get("/datasets/cc/image_id_sample?min=10&max=20")
         result = json.loads(response.data)
         self.assertEqual(result["rasterLayer"]["min"], 10)
+        self.assertEqual(result["flowmapLayer"]["date"], "2018-06-01T12:00:00")
+
+    @patch("dgds_backend.app.dataset")
+    def test_resolve_datasets_deadline(self, mock_dataset):
+        # The slow dataset misses the deadline and is marked degraded
+        release = threading.Event()
+
+        deadlines = []
+
+        def slow_dataset(datasetId, imageId):
+            deadlines.append(upstream.remaining())
+            if datasetId == "slow":
+                release.wait(5)
+            return {"rasterLayer": {"url": datasetId}}
+
+        mock_dataset.side_effect = slow_dataset
+        datasets_info = [{"id": "fast"}, {"id": "slow"}]
 
-    @patch("dgds_backend.app.requests.get")
-    def test_get_fews_timeseries(self, mock_get):
+        with patch.dict(app.app.config, {"DATASETS_TIMEOUT": 0.2}), upstream.deadline(60):
+            degraded = app.resolve_datasets(datasets_info)
+        release.set()
+
+        # the workers share the deadline of the request
+        self.assertEqual(len(deadlines), 2)
+        self.assertTrue(all(0 < seconds <= 60 for seconds in deadlines))
+
+        self.assertEqual(degraded, ["slow"])
+        self.assertEqual(datasets_info[0]["rasterLayer"]["url"], "fast")
+        self.assertNotIn("degraded", datasets_info[0])
+        self.assertTrue(datasets_info[1]["degraded"])
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_fews_timeseries(self, mock_request):
         # Test FEWS PI service
         filename = os.path.join(
             os.path.dirname(__file__), "../dgds_backend/dummy_data/dummyTseries.json"
         )
         with open(filename, "r") as f:
             mocked_fews_resp = json.load(f)
-        mock_get.return_value = Mock()
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = mocked_fews_resp
+        mock_request.return_value = Mock()
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.json.return_value = mocked_fews_resp
         response = self.client.get(
             "/timeseries?locationId=diva_id__270&startTime=2019-03-22T00:00:00Z&endTime=2019-03-26T00:50:00Z&observationTypeId=H.simulated&datasetId=wl"
         )
         result = json.loads(response.data.decode("utf-8"))
         self.assertIn("events", result["results"][1])
 
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_cached_timeseries(self, mock_request):
+        # A repeated request is served from the cache, a conditional one is not rendered
+        filename = os.path.join(
+            os.path.dirname(__file__), "../dgds_backend/dummy_data/dummyTseries.json"
+        )
+        with open(filename, "r") as f:
+            mocked_fews_resp = json.load(f)
+        mock_request.return_value = Mock()
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.json.return_value = mocked_fews_resp
+        url = "/timeseries?locationId=diva_id__274&startTime=2019-03-22T00:00:00Z&endTime=2019-03-23T00:00:00Z&datasetId=wl"
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 1)
+
+        response = self.client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_timeseries_batch(self, mock_request):
+        # One bad location does not fail the batch
+        def dd_api(method, url, params=None, **kwargs):
+            response = Mock()
+            response.status_code = 500 if params["locationCode"] == "bad" else 200
+            response.json.return_value = {
+                "results": [{"location": {"properties": {"locationId": params["locationCode"]}}}]
+            }
+            return response
+
+        mock_request.side_effect = dd_api
+        response = self.client.post(
+            "/timeseries/batch",
+            json={
+                "datasetIds": ["wl"],
+                "locationIds": ["diva_id__271", "bad", "diva_id__272"],
+                "startTime": "2019-03-22T00:00:00Z",
+                "endTime": "2019-03-26T00:50:00Z",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)["results"]
+        self.assertEqual(
+            [r["locationId"] for r in results], ["diva_id__271", "bad", "diva_id__272"]
+        )
+        self.assertEqual([r["status"] for r in results], [200, 502, 200])
+        self.assertIn("error", results[1])
+        self.assertEqual(
+            results[2]["content"]["results"][0]["location"]["properties"]["locationId"],
+            "diva_id__272",
+        )
+
+    def test_get_timeseries_batch_too_large(self):
+        with patch.dict(app.app.config, {"TIMESERIES_BATCH_MAX_ITEMS": 2}):
+            response = self.client.get(
+                "/timeseries/batch?datasetIds=wl&locationIds=a&locationIds=b&locationIds=c"
+            )
+        self.assertEqual(response.status_code, 422)
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_get_timeseries_auto_paging(self, mock_request):
+        # All pages are followed and streamed as a single response
+        def page(number, next_url):
+            response = Mock()
+            response.status_code = 200
+            response.json.return_value = {
+                "provider": {"name": "Deltares"},
+                "paging": {"next": next_url, "prev": None},
+                "results": [{"id": number}],
+            }
+            return response
+
+        pages = [
+            page(1, "http://dd-api/timeseries?page=2"),
+            page(2, "http://dd-api/timeseries?page=3"),
+            page(3, None),
+        ]
+        deadlines = []
+
+        def dd_api(method, url, **kwargs):
+            # the pages fetched while streaming have the deadline of the request
+            deadlines.append(upstream.remaining())
+            return pages.pop(0)
+
+        mock_request.side_effect = dd_api
+        response = self.client.get(
+            "/timeseries?locationId=diva_id__273&datasetId=wl&autoPaging=true"
+        )
+        self.assertTrue(response.is_streamed)
+        result = json.loads(response.data)
+        self.assertEqual([r["id"] for r in result["results"]], [1, 2, 3])
+        self.assertIsNone(result["paging"]["next"])
+        self.assertEqual(mock_request.call_args[0][1], "http://dd-api/timeseries?page=3")
+        self.assertEqual(len(deadlines), 3)
+        self.assertTrue(all(seconds is not None for seconds in deadlines))
+
     def test_get_shoreline_timeseries(self):
         # Test get timeseries from shoreline service
         response = self.client.get("/timeseries?locationId=BOX_120_000_32&datasetId=sm")
@@ -0,0 +1,57 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from dgds_backend import app, metrics, upstream
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_render(self):
+        histogram = metrics.Histogram("latency", "Latency.", ("route",), buckets=(0.1, 1))
+        histogram.observe("/a", value=0.05)
+        histogram.observe("/a", value=0.5)
+        histogram.observe("/a", value=5)
+
+        self.assertEqual(
+            histogram.render(),
+            [
+                "# HELP latency Latency.",
+                "# TYPE latency histogram",
+                'latency_bucket{route="/a",le="0.1"} 1',
+                'latency_bucket{route="/a",le="1"} 2',
+                'latency_bucket{route="/a",le="+Inf"} 3',
+                'latency_sum{route="/a"} 5.55',
+                'latency_count{route="/a"} 3',
+            ],
+        )
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+        upstream.configure({})
+
+    def test_request_metrics(self):
+        self.client.get("/status")
+        self.client.get("/status")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.content_type, metrics.CONTENT_TYPE)
+        text = response.data.decode()
+        self.assertIn('dgds_requests_total{route="/status",method="GET",status="200"}', text)
+        self.assertIn('dgds_request_duration_seconds_count{route="/status"}', text)
+        # the scrape itself is in flight
+        self.assertIn("dgds_requests_in_flight 1", text)
+        self.assertIn("dgds_cache_operations_total", text)
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_upstream_metrics(self, mock_request):
+        mock_request.return_value = Mock(status_code=503)
+        upstream.get("http://fews/capabilities", protocol="fewsWms")
+
+        text = self.client.get("/metrics").data.decode()
+        self.assertIn('dgds_upstream_duration_seconds_count{protocol="fewsWms"}', text)
+        self.assertIn('dgds_upstream_errors_total{protocol="fewsWms",kind="status"}', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
+import threading
+import time
 import unittest
+from unittest.mock import Mock, patch
 
-from dgds_backend import app
+from dgds_backend import app, providers_timeseries
 from dgds_backend.providers_timeseries import PiServiceDDL
 
 
@@ -23,3 +26,41 @@ class Dgds_backendTestCase(unittest.TestCase):
     def test_update_paging(self):
         # self.pi.update_paging(self.url, self.client, )
         pass
+
+    def test_concurrent_paging(self):
+        pi = PiServiceDDL("H.simulated", self.url, "http://localhost/")
+        release = threading.Event()
+
+        def hedged_get(url, params=None, **kwargs):
+            release.wait(5)
+            return Mock(
+                status_code=200,
+                json=Mock(return_value={
+                    "paging": {"next": self.url + "/timeseries?page=2", "prev": None},
+                    "results": [],
+                }),
+            )
+
+        results = []
+
+        def get_timeseries():
+            results.append(pi.get_timeseries({"datasetId": "wl", "locationId": "diva_id__270"}))
+
+        count = 5
+        shared = providers_timeseries._fetches.stats()["shared"]
+        threads = [threading.Thread(target=get_timeseries) for i in range(count)]
+        with patch("dgds_backend.upstream.hedged_get", side_effect=hedged_get) as mock_get:
+            for thread in threads:
+                thread.start()
+            # wait until all callers joined the fetch in flight
+            while providers_timeseries._fetches.stats()["shared"] < shared + count - 1:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(
+            [result["paging"]["next"] for result in results],
+            ["http://localhost/timeseries?page=2&datasetId=wl"] * count,
+        )
@@ -0,0 +1,70 @@
+import tempfile
+import time
+import unittest
+
+from flask import Flask
+
+from dgds_backend.profiler import RequestProfiler
+
+
+def create_app(**config):
+    app = Flask(__name__)
+    app.config.update(
+        PROFILE_SAMPLE_RATE=0.0,
+        PROFILE_TOKEN=None,
+        PROFILE_INTERVAL=0.001,
+        PROFILE_KEEP=2,
+    )
+    app.config.update(config)
+
+    @app.route("/slow")
+    def slow():
+        time.sleep(0.05)
+        return "done"
+
+    RequestProfiler(app)
+    return app
+
+
+class RequestProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_off(self):
+        app = create_app(PROFILE_DIR=self.tmpdir.name)
+        self.assertEqual(app.before_request_funcs, {})
+        self.assertNotIn("profiles", app.view_functions)
+
+    def test_token(self):
+        app = create_app(PROFILE_DIR=self.tmpdir.name, PROFILE_TOKEN="secret")
+        client = app.test_client()
+        headers = {"X-Profile-Token": "secret"}
+
+        client.get("/slow")
+        self.assertEqual(client.get("/profiles", headers=headers).get_json(), {"profiles": []})
+        client.get("/slow", headers=headers)
+
+        self.assertEqual(client.get("/profiles").status_code, 403)
+        profiles = client.get("/profiles", headers=headers).get_json()["profiles"]
+        self.assertEqual(len(profiles), 1)
+        self.assertIn("_slow_wall", profiles[0])
+
+        stacks = client.get("/profiles/" + profiles[0], headers=headers).data.decode()
+        self.assertIn("slow (tests/test_profiler.py)", stacks)
+
+    def test_sample_rate(self):
+        app = create_app(PROFILE_DIR=self.tmpdir.name, PROFILE_SAMPLE_RATE=1.0, PROFILE_TOKEN="secret")
+        client = app.test_client()
+        for i in range(3):
+            client.get("/slow")
+
+        # only the most recent profiles are kept
+        profiles = client.get("/profiles", headers={"X-Profile-Token": "secret"}).get_json()
+        self.assertEqual(len(profiles["profiles"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from dgds_backend import upstream
+from dgds_backend.providers_timeseries import dd_shoreline, transform_dd
+from dgds_backend.shoreline import ShorelineCache
+
+
+def transect(transect_id, distances):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": [[4.0, 52.0], [4.1, 52.1]]},
+        "properties": {
+            "transect_id": transect_id,
+            "country_name": "Netherlands",
+            "continent": "Europe",
+            "flag_sandy": "True",
+            "change_rate": 0.5,
+            "change_rate_unc": 0.1,
+            "dt": [0, 1, 2],
+            "distances": distances,
+        },
+    }
+
+
+class ShorelineCacheTestCase(unittest.TestCase):
+    url = "https://storage.googleapis.com/shoreline-monitor/features/{box}/{section}/BOX_{box}_{section}.json"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ShorelineCache(self.tmpdir.name, 60)
+        # no circuit breaker or negative cache state of other tests
+        upstream.configure({})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @patch("dgds_backend.upstream.requests.Session.request")
+    def test_indexed_lookup(self, mock_request):
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.json.return_value = {
+            "type": "FeatureCollection",
+            "features": [
+                transect("BOX_120_000_31", [1.0, 2.0, 3.0]),
+                transect("BOX_120_000_32", [4.0, 5.0, 6.0]),
+            ],
+        }
+
+        first = dd_shoreline(self.url, "BOX_120_000_32", "Shoreline", "sm", cache=self.cache)
+        second = dd_shoreline(self.url, "BOX_120_000_31", "Shoreline", "sm", cache=self.cache)
+        missing = dd_shoreline(self.url, "BOX_120_000_99", "Shoreline", "sm", cache=self.cache)
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual([e["value"] for e in first["results"][0]["events"]], [4.0, 5.0, 6.0])
+        self.assertEqual(second["results"][0]["id"], "BOX_120_000_31")
+        self.assertEqual(missing, {})
+
+        # the index is persistent, a new cache (or process) does not download again
+        other = ShorelineCache(self.tmpdir.name, 60)
+        feature = other.get_feature(
+            self.url.format(box="120", section="000"), "BOX_120_000_32"
+        )
+        self.assertEqual(feature["properties"]["distances"], [4.0, 5.0, 6.0])
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(len([f for f in os.listdir(self.tmpdir.name) if f.endswith(".jsonl")]), 1)
+
+
+class TransformDDTestCase(unittest.TestCase):
+    def test_transform_dd(self):
+        feature = transect("BOX_120_000_32", [4.0, 5.0])
+        feature["properties"]["country_name"] = "Côte d'Ivoire"
+        feature["properties"]["dt"] = [0, 1]
+
+        result = transform_dd(feature, "Shoreline", "sm")["results"][0]
+
+        self.assertEqual(result["location"]["properties"]["countryName"], "Côte d'Ivoire")
+        self.assertEqual(result["startTime"], "1984-01-01T00:00:00Z")
+        self.assertEqual(result["endTime"], "1984-12-31T00:00:00Z")
+        self.assertEqual(result["events"][1], {"timeStamp": "1984-12-31T00:00:00Z", "value": 5.0})
+        self.assertEqual(result["observationType"], {"id": "sm", "quantity": "Shoreline", "unit": "m"})
+
+
+if __name__ == "__main__":
+    unittest.main()
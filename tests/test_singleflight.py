@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from dgds_backend.singleflight import SingleFlight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight("test")
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if value == "error":
+            raise ValueError(value)
+        return {"value": value}
+
+    def run_concurrently(self, key, value, count=5):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do(key, self.slow, value))
+            except ValueError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        # wait until all callers joined the call in flight
+        while self.flight.stats()["shared"] < count - 1:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        results = self.run_concurrently("a", "a")
+
+        self.assertEqual(self.calls, ["a"])
+        self.assertEqual(results, [{"value": "a"}] * 5)
+        # every caller gets its own result
+        self.assertEqual(len(set(map(id, results))), 5)
+        self.assertEqual(self.flight.stats(), {"calls": 5, "shared": 4, "in_flight": 0})
+
+    def test_shared_error(self):
+        results = self.run_concurrently("error", "error", count=3)
+
+        self.assertEqual(self.calls, ["error"])
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_sequential_calls_not_coalesced(self):
+        self.release.set()
+        self.flight.do("a", self.slow, "a")
+        self.flight.do("a", self.slow, "a")
+
+        self.assertEqual(self.calls, ["a", "a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
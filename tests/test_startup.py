@@ -0,0 +1,41 @@
+import copy
+import unittest
+
+from dgds_backend import app, providers_datasets
+
+
+class StartupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def test_datasets_config_valid(self):
+        self.assertEqual(providers_datasets.validate_datasets(providers_datasets.DATASETS), [])
+
+    def test_datasets_config_errors(self):
+        datasets = copy.deepcopy(providers_datasets.DATASETS)
+        datasets["info"]["datasets"].append({"id": "missing"})
+        datasets["access"]["cc"]["rasterService"]["protocol"] = "wms"
+        del datasets["access"]["cc"]["flowmapService"]["parameters"]["tile_template"]
+
+        errors = providers_datasets.validate_datasets(datasets)
+        self.assertEqual(
+            errors,
+            [
+                "Dataset id missing has no access configuration",
+                "Dataset id cc rasterService has unknown protocol wms",
+                "Dataset id cc flowmapService misses parameter tile_template",
+            ],
+        )
+
+    def test_startup_timing(self):
+        startup = self.client.get("/status").get_json()["startup"]
+        self.assertLess(startup["imports"], startup["total"])
+
+    def test_docs_on_first_use(self):
+        spec = self.client.get("/swagger/").get_json()
+        self.assertIn("/timeseries", spec["paths"])
+        self.assertIn("/datasets", spec["paths"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+from unittest.mock import Mock
+
+from flask_caching.backends.simple import SimpleCache
+
+from dgds_backend.timeseries_cache import TimeseriesCache, parse_time
+
+
+def timeseries_response(data):
+    # one event every hour within the requested window
+    start, end = parse_time(data["startTime"]), parse_time(data["endTime"])
+    events = [
+        {"timeStamp": "2019-03-22T{:02d}:00:00Z".format(hour), "value": hour}
+        for hour in range(24)
+        if start <= parse_time("2019-03-22T{:02d}:00:00Z".format(hour)) <= end
+    ]
+    return {
+        "paging": {"next": None, "prev": None},
+        "results": [
+            {"startTime": data["startTime"], "endTime": data["endTime"], "events": events}
+        ],
+    }
+
+
+def paged_response(data):
+    content = timeseries_response(data)
+    content["paging"]["next"] = "http://localhost/timeseries?page=2"
+    return content
+
+
+class TimeseriesCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = TimeseriesCache(SimpleCache())
+        self.pi = Mock(
+            timeseries_url="http://dd-api/timeseries",
+            observation_type_id="H.simulated",
+            hostname_url="http://localhost/",
+        )
+        self.pi.get_timeseries.side_effect = timeseries_response
+
+    def request(self, start, end):
+        data = {
+            "datasetId": "wl",
+            "locationId": "diva_id__270",
+            "startTime": start,
+            "endTime": end,
+        }
+        return self.cache.get_timeseries(self.pi, data, 6 * 60 * 60)
+
+    def version(self, start, end):
+        data = {
+            "datasetId": "wl",
+            "locationId": "diva_id__270",
+            "startTime": start,
+            "endTime": end,
+        }
+        return self.cache.version(self.pi, data)
+
+    def test_window_aligned_on_cycle(self):
+        content = self.request("2019-03-22T01:30:00Z", "2019-03-22T04:00:00Z")
+        upstream_data = self.pi.get_timeseries.call_args[0][0]
+        self.assertEqual(upstream_data["startTime"], "2019-03-22T00:00:00Z")
+        self.assertEqual(upstream_data["endTime"], "2019-03-22T06:00:00Z")
+
+        result = content["results"][0]
+        self.assertEqual([e["value"] for e in result["events"]], [2, 3, 4])
+        self.assertEqual(result["startTime"], "2019-03-22T01:30:00Z")
+
+    def test_narrower_window_sliced_from_cache(self):
+        self.request("2019-03-22T00:00:00Z", "2019-03-22T11:00:00Z")
+        content = self.request("2019-03-22T07:00:00Z", "2019-03-22T08:00:00Z")
+        self.assertEqual(self.pi.get_timeseries.call_count, 1)
+        self.assertEqual([e["value"] for e in content["results"][0]["events"]], [7, 8])
+
+        # a wider window needs a new upstream request
+        self.request("2019-03-22T00:00:00Z", "2019-03-22T13:00:00Z")
+        self.assertEqual(self.pi.get_timeseries.call_count, 2)
+
+    def test_version(self):
+        self.assertIsNone(self.version("2019-03-22T01:00:00Z", "2019-03-22T02:00:00Z"))
+
+        self.request("2019-03-22T00:00:00Z", "2019-03-22T06:00:00Z")
+        version = self.version("2019-03-22T01:00:00Z", "2019-03-22T02:00:00Z")
+        self.assertIsNotNone(version)
+        self.assertEqual(self.version("2019-03-22T01:00:00Z", "2019-03-22T02:00:00Z"), version)
+        self.assertNotEqual(self.version("2019-03-22T01:00:00Z", "2019-03-22T03:00:00Z"), version)
+        self.assertIsNone(self.version("2019-03-22T01:00:00Z", "2019-03-22T07:00:00Z"))
+        self.assertEqual(self.pi.get_timeseries.call_count, 1)
+
+    def test_paged_aligned_window_fetched_once(self):
+        self.pi.get_timeseries.side_effect = paged_response
+        content = self.request("2019-03-22T00:00:00Z", "2019-03-22T06:00:00Z")
+        self.assertEqual(self.pi.get_timeseries.call_count, 1)
+        self.assertIsNotNone(content["paging"]["next"])
+
+    def test_paged_location_not_widened(self):
+        self.pi.get_timeseries.side_effect = paged_response
+        self.request("2019-03-22T01:30:00Z", "2019-03-22T04:00:00Z")
+        self.assertEqual(self.pi.get_timeseries.call_count, 2)
+        upstream_data = self.pi.get_timeseries.call_args[0][0]
+        self.assertEqual(upstream_data["startTime"], "2019-03-22T01:30:00Z")
+
+        # the next request of the location queries the exact window only
+        content = self.request("2019-03-22T02:00:00Z", "2019-03-22T03:00:00Z")
+        self.assertEqual(self.pi.get_timeseries.call_count, 3)
+        upstream_data = self.pi.get_timeseries.call_args[0][0]
+        self.assertEqual(upstream_data["startTime"], "2019-03-22T02:00:00Z")
+        self.assertEqual(upstream_data["endTime"], "2019-03-22T03:00:00Z")
+        self.assertEqual([e["value"] for e in content["results"][0]["events"]], [2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from dgds_backend import upstream
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    slow = set()  # paths that are slow on their first request
+
+    def do_GET(self):
+        if self.path in self.slow:
+            self.slow.discard(self.path)
+            time.sleep(1)
+        body = json.dumps({"path": self.path}).encode()
+        self.send_response(500 if self.path.startswith("/error") else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UpstreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), JsonHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        upstream.configure({})
+
+    def tearDown(self):
+        upstream.configure(
+            {
+                "UPSTREAM_BREAKER_FAILURES": 5,
+                "UPSTREAM_BREAKER_RESET": 30,
+                "UPSTREAM_NEGATIVE_TTL": 10,
+                "UPSTREAM_HEDGE": False,
+                "UPSTREAM_HEDGE_MIN_SAMPLES": 20,
+                "UPSTREAM_HEDGE_BUDGET": 0.05,
+            }
+        )
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        for i in range(3):
+            resp = upstream.get(self.url + "/timeseries", params={"page": i})
+            self.assertEqual(resp.json()["path"], "/timeseries?page={}".format(i))
+
+        stats = upstream.pool_stats()[self.url.replace("http://", "")]
+        self.assertEqual(stats, {"requests": 3, "connections": 1, "reused": 2})
+
+    def test_same_session_per_host(self):
+        self.assertIs(
+            upstream.get_session(self.url + "/locations"),
+            upstream.get_session(self.url + "/timeseries"),
+        )
+
+    def test_negative_cache(self):
+        # a failed GET is answered from the negative cache, other urls still pass
+        self.assertEqual(upstream.get(self.url + "/error").status_code, 500)
+        self.assertEqual(upstream.get(self.url + "/error").status_code, 500)
+        self.assertEqual(upstream.get(self.url + "/timeseries").status_code, 200)
+
+        stats = upstream.pool_stats()[self.url.replace("http://", "")]
+        self.assertEqual(stats["requests"], 2)
+
+    def test_circuit_breaker(self):
+        upstream.configure(
+            {"UPSTREAM_BREAKER_FAILURES": 2, "UPSTREAM_BREAKER_RESET": 0.2, "UPSTREAM_NEGATIVE_TTL": 0}
+        )
+        host = self.url.replace("http://", "")
+        upstream.get(self.url + "/error/1")
+        upstream.get(self.url + "/error/2")
+        self.assertEqual(upstream.breaker_stats()[host], {"state": "open", "failures": 2, "trips": 1})
+
+        # open, fail fast without a request
+        with self.assertRaises(upstream.UpstreamUnavailable):
+            upstream.get(self.url + "/timeseries")
+
+        # half open after the reset timeout, a successful trial closes it
+        time.sleep(0.25)
+        self.assertEqual(upstream.get(self.url + "/timeseries").status_code, 200)
+        self.assertEqual(upstream.breaker_stats()[host], {"state": "closed", "failures": 0, "trips": 1})
+
+    def test_deadline(self):
+        with upstream.deadline(0):
+            with self.assertRaises(upstream.UpstreamUnavailable):
+                upstream.get(self.url + "/timeseries")
+        self.assertEqual(upstream.get(self.url + "/timeseries").status_code, 200)
+
+    def test_deadline_in_other_thread(self):
+        with upstream.deadline(0):
+            get = upstream.with_deadline(upstream.get)
+        self.assertIsNone(upstream.remaining())
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(get, self.url + "/timeseries")
+            self.assertIsInstance(future.exception(), upstream.UpstreamUnavailable)
+
+    def test_hedged_get(self):
+        upstream.configure(
+            {"UPSTREAM_HEDGE": True, "UPSTREAM_HEDGE_MIN_SAMPLES": 3, "UPSTREAM_HEDGE_BUDGET": 0.3}
+        )
+        host = self.url.replace("http://", "")
+        for i in range(3):
+            upstream.hedged_get(self.url + "/timeseries", params={"page": i})
+
+        # the first request hangs, the duplicate sent after the p95 latency wins
+        JsonHandler.slow.add("/timeseries?page=slow")
+        start = time.time()
+        resp = upstream.hedged_get(self.url + "/timeseries", params={"page": "slow"})
+        self.assertEqual(resp.json()["path"], "/timeseries?page=slow")
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(upstream.hedge_stats()[host], {"requests": 4, "hedges": 1, "wins": 1})
+
+        # the budget of 0.3 hedges per request is used up
+        JsonHandler.slow.add("/timeseries?page=slow")
+        upstream.hedged_get(self.url + "/timeseries", params={"page": "slow"})
+        self.assertEqual(upstream.hedge_stats()[host]["hedges"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()